@@ -0,0 +1,262 @@
+import asyncio
+import glob
+import json
+import math
+import os
+import sys
+import time
+from collections import namedtuple
+from functools import partial
+from time import perf_counter
+
+import benchmark
+import deflate
+import dictionary
+import huffman
+import lz_77
+import pool
+
+# Batch front end: compresses every file named by a list of sources (glob
+# patterns, folders walked recursively, or "-" for paths read one per line
+# from stdin) with one codec, writing each output next to its input as
+# `main.py test` does.
+#
+#     python main.py batch 'logs/**/*.log' data/ --codec deflate --json run.json
+#     find . -name '*.json' | python main.py batch - --codec rfc1951
+#
+# An asyncio loop feeds the shared worker pool (pool.py). Files of at least
+# LARGE_FILE bytes are compressed one at a time in block parallel mode, the
+# codec spreading its blocks over the pool. Smaller files are grouped into
+# batches of up to BATCH_BYTES bytes and BATCH_FILES files, and a whole
+# batch is one pool task, so a small file does not pay a task round trip of
+# its own. At most `concurrency` large files and batches are in flight;
+# past that the loop stops listing inputs until one finishes. Listing and
+# stat calls run on threads while the pool compresses, and every worker
+# reads and writes its own files, so one batch's I/O overlaps another's CPU
+# work. The report gives the aggregate throughput and percentiles of the
+# per file latency, from the moment a file is queued to the moment its
+# output is written.
+
+LARGE_FILE = pool.PROCESS_THRESHOLD
+BATCH_BYTES = 1 << 20
+BATCH_FILES = 64
+PERCENTILES = (50, 90, 99)
+# suffixes of the codecs' outputs: a path ending in one is not compressed
+# again when the path without it exists, so walking a folder twice does
+# not pick up the first run's outputs
+OUTPUT_SUFFIXES = (".enc", ".deflate", ".dec", ".2")
+
+# seconds is the time the codec took on the file, latency also counts the
+# time it was queued; error is None when the file compressed
+FileResult = namedtuple('FileResult', 'path input_bytes output_bytes seconds latency error')
+
+
+def new_codec(name, window, lookahead, blocks, level=None, cache=None, preset=None):
+    # The compressor for a codec of benchmark.CODECS, with the method that
+    # compresses a file and the suffix of the output it writes
+    if name == "huffman":
+        codec = huffman.HuffmanCompressor(block_number=blocks, cache=cache, dictionary=preset)
+        return codec, codec.compress_bin, ".enc"
+    if name == "lz77":
+        codec = lz_77.LZ77Compressor(window, lookahead, blocks, level=level, cache=cache, dictionary=preset)
+        return codec, codec.compress, ".enc"
+    codec = deflate.DeflateCompressor(window, lookahead, blocks, rfc1951=name == "rfc1951", level=level, cache=cache,
+                                      dictionary=preset, pipeline=name == "deflate_pipeline")
+    return codec, codec.compress, ".deflate" if name == "rfc1951" else ".enc.enc"
+
+
+def is_output(path) -> bool:
+    # True when path is what a codec wrote for another file, not for names
+    # that just end the same way, such as libfoo.so.2
+    return any(path.endswith(suffix) and os.path.isfile(path[:-len(suffix)]) for suffix in OUTPUT_SUFFIXES)
+
+
+def iter_sources(sources):
+    # Paths of the files the sources name, in order, each once
+    seen = set()
+    for source in sources:
+        if source == "-":
+            paths = (line.strip() for line in sys.stdin)
+        elif os.path.isdir(source):
+            paths = (os.path.join(folder, name) for folder, folders, names in os.walk(source)
+                     for name in sorted(names))
+        else:
+            paths = sorted(glob.glob(source, recursive=True)) or [source]
+        for path in paths:
+            if path and path not in seen and not os.path.basename(path).startswith(".") and not is_output(path):
+                seen.add(path)
+                yield path
+
+
+def iter_inputs(sources):
+    # (path, size) of every input, None as the size when it cannot be read
+    for path in iter_sources(sources):
+        try:
+            yield path, os.path.getsize(path) if os.path.isfile(path) else None
+        except OSError:
+            yield path, None
+
+
+def compress_file(compress, suffix, path) -> tuple[int, float, str]:
+    # Worker side: output size, seconds and error of one file
+    folder, name = os.path.split(path)
+    start_time = perf_counter()
+    try:
+        compress(folder, name)
+        return os.path.getsize(path + suffix), perf_counter() - start_time, None
+    except (OSError, ValueError) as error:
+        return 0, perf_counter() - start_time, str(error)
+
+
+def compress_batch(compress, suffix, paths) -> list[tuple[int, float, str]]:
+    return [compress_file(compress, suffix, path) for path in paths]
+
+
+def percentile(values, percent) -> float:
+    # Nearest rank percentile of a sorted list
+    if not values:
+        return 0.0
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+class BatchCompressor:
+    # small is the (compress, suffix) pair used on files below LARGE_FILE,
+    # large the one for block parallel mode; small ones cross to worker
+    # processes with their batch, so they must pickle
+    def __init__(self, small, large, concurrency=None):
+        self.small = small
+        self.large = large
+        workers = os.cpu_count() or 1
+        self.concurrency = concurrency or 2 * workers
+        # a batch crosses to its worker as a list of paths, cheap at any
+        # batch size, so only a single core keeps batches on threads
+        self.executor = pool.get_executor("process" if workers > 1 else "thread")
+        self.results = []
+        self.batches = 0
+        self.large_files = 0
+        self.seconds = 0.0
+
+    async def run(self, sources):
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.concurrency)
+        running = set()
+        batch = []
+        batch_bytes = 0
+
+        def finished(task):
+            running.discard(task)
+            limit.release()
+
+        def start(job):
+            # the slot was taken by the caller, the task gives it back
+            task = asyncio.ensure_future(job)
+            running.add(task)
+            task.add_done_callback(finished)
+
+        start_time = perf_counter()
+        inputs = iter_inputs(sources)
+        while True:
+            # listing and stat calls can block on slow disks or stdin
+            item = await asyncio.to_thread(next, inputs, None)
+            if item is None:
+                break
+            path, size = item
+            if size is None:
+                self.results.append(FileResult(path, 0, 0, 0.0, 0.0, "not a readable file"))
+                continue
+            if size >= LARGE_FILE:
+                queued = perf_counter()
+                await limit.acquire()
+                start(self.compress_large(loop, path, size, queued))
+                continue
+            batch.append((path, size, perf_counter()))
+            batch_bytes += size
+            if batch_bytes >= BATCH_BYTES or len(batch) >= BATCH_FILES:
+                await limit.acquire()
+                start(self.compress_small(loop, batch))
+                batch = []
+                batch_bytes = 0
+        if batch:
+            await limit.acquire()
+            start(self.compress_small(loop, batch))
+        if running:
+            await asyncio.gather(*running)
+        self.seconds = perf_counter() - start_time
+        return self.results
+
+    async def compress_large(self, loop, path, size, queued):
+        # On a thread, the codec hands its blocks to the shared pool itself
+        compress, suffix = self.large
+        output_bytes, seconds, error = await loop.run_in_executor(None, compress_file, compress, suffix, path)
+        self.large_files += 1
+        self.results.append(FileResult(path, size, output_bytes, seconds, perf_counter() - queued, error))
+
+    async def compress_small(self, loop, batch):
+        compress, suffix = self.small
+        paths = [path for path, size, queued in batch]
+        results = await loop.run_in_executor(self.executor, partial(compress_batch, compress, suffix, paths))
+        done = perf_counter()
+        self.batches += 1
+        for (path, size, queued), (output_bytes, seconds, error) in zip(batch, results):
+            self.results.append(FileResult(path, size, output_bytes, seconds, done - queued, error))
+
+    def summary(self) -> dict:
+        compressed = [result for result in self.results if result.error is None]
+        input_bytes = sum(result.input_bytes for result in compressed)
+        output_bytes = sum(result.output_bytes for result in compressed)
+        latencies = sorted(result.latency for result in compressed)
+        return {
+            "files": len(compressed),
+            "failed": len(self.results) - len(compressed),
+            "large_files": self.large_files,
+            "batches": self.batches,
+            "input_bytes": input_bytes,
+            "output_bytes": output_bytes,
+            # input over output, as the detailed report and benchmark.py give it
+            "ratio": input_bytes / output_bytes if output_bytes else 0.0,
+            "seconds": self.seconds,
+            "mbps": input_bytes / self.seconds / 1e6 if self.seconds else 0.0,
+            "files_per_second": len(compressed) / self.seconds if self.seconds else 0.0,
+            "latency_ms": {**{f"p{percent}": percentile(latencies, percent) * 1000 for percent in PERCENTILES},
+                           "max": latencies[-1] * 1000 if latencies else 0.0},
+        }
+
+
+def print_summary(summary):
+    print(f"{summary['files']} files ({summary['failed']} failed), {summary['input_bytes'] / 1e6:.2f} MB -> "
+          f"{summary['output_bytes'] / 1e6:.2f} MB (ratio {summary['ratio']:.3f}) in {summary['seconds']:.2f} s")
+    print(f"{summary['mbps']:.2f} MB/s, {summary['files_per_second']:.1f} files/s; {summary['large_files']} large "
+          f"files in block parallel mode, the rest in {summary['batches']} batches")
+    print("latency ms  " + "  ".join(f"{name} {value:.1f}" for name, value in summary["latency_ms"].items()))
+
+
+def add_arguments(parser):
+    parser.add_argument("sources", nargs="+", help="glob patterns, folders, or - to read paths from stdin")
+    parser.add_argument("--codec", choices=sorted(benchmark.CODECS), default="deflate")
+    parser.add_argument("--window", type=int, default=8192)
+    parser.add_argument("--lookahead", type=int, default=20)
+    parser.add_argument("--blocks", type=int, default=os.cpu_count() or 1,
+                        help="blocks per file in block parallel mode, for files of at least "
+                             f"{LARGE_FILE} bytes")
+    parser.add_argument("--level", type=int, choices=range(1, 10), help="compression level, picks the LZ77 parser")
+    parser.add_argument("--dictionary", help="preset dictionary file, see dictionary.py")
+    parser.add_argument("--concurrency", type=int, help="large files and batches in flight, twice the cores by default")
+    parser.add_argument("--json", help="write the summary and every file's result to this JSON file")
+
+
+def run(args) -> int:
+    preset = dictionary.load_dictionary(args.dictionary) if args.dictionary else None
+    small = new_codec(args.codec, args.window, args.lookahead, 1, args.level, preset=preset)[1:]
+    large = new_codec(args.codec, args.window, args.lookahead, args.blocks, args.level, preset=preset)[1:]
+    batch = BatchCompressor(small, large, args.concurrency)
+    results = asyncio.run(batch.run(args.sources))
+    for result in results:
+        if result.error is not None:
+            print(f"{result.path}: {result.error}", file=sys.stderr)
+    summary = batch.summary()
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "summary": summary,
+                       "files": [result._asdict() for result in results]}, file, indent=2)
+    return 1 if summary["failed"] else 0
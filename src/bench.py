@@ -0,0 +1,866 @@
+import asyncio
+import io
+import os
+import struct
+import sys
+import sysconfig
+import tempfile
+import zlib
+from collections import Counter
+from time import perf_counter
+
+import batch
+import bitio
+import cache
+import deflate
+import dictionary
+import fileio
+import histogram
+import huffman
+import instrument
+import lz_77
+import pool
+import rfc1951
+from corpus import synthetic_json, synthetic_log, synthetic_text
+
+# Small benchmarks for the hot paths of each codec. Run from src/ with
+#     python bench.py [name ...]
+# to run the named benchmarks, or all of them with no arguments. The
+# corpus level benchmark matrix lives in benchmark.py.
+
+
+def throughput(f, *args, repeat=3):
+    # Best of `repeat` runs, returns (seconds, result of the last run)
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        ts = perf_counter()
+        result = f(*args)
+        best = min(best, perf_counter() - ts)
+    return best, result
+
+
+def report(rows):
+    print(f"{'name':<28}{'MB/s':>10}{'seconds':>12}{'output':>12}")
+    for name, seconds, input_size, output_size in rows:
+        print(f"{name:<28}{input_size / seconds / 1e6:>10.2f}{seconds:>12.4f}{output_size:>12}")
+
+
+def legacy_compress_block(search_buffer_size, lookup_buffer_size, data):
+    # The original single character match finder, kept as the baseline the
+    # hash chain finder is measured against
+    byte_data = bytearray()
+    i = 0
+    l = len(data)
+    dictionary = {}
+    while i < l:
+        longest_location = 0
+        longest_length = 0
+        current_char = data[i]
+        current_char_hash = hash(data[i])
+        if dictionary.get(current_char_hash):
+            for pos in dictionary[current_char_hash]:
+                if pos < i - search_buffer_size:
+                    dictionary[current_char_hash].remove(pos)
+                    if dictionary[current_char_hash] == []:
+                        del dictionary[current_char_hash]
+                else:
+                    current_length = 0
+                    j = pos
+                    temp_i = i
+                    while temp_i < l and current_length < lookup_buffer_size and data[temp_i] == data[j]:
+                        temp_i += 1
+                        j += 1
+                        current_length += 1
+                        if current_length >= longest_length:
+                            longest_length = current_length
+                            longest_location = temp_i - j
+            i += longest_length
+            if i == l:
+                byte_data.extend(lz_77.pack_tuple((longest_location, longest_length, 0)))
+            else:
+                byte_data.extend(lz_77.pack_tuple((longest_location, longest_length, ord(data[i]))))
+                i += 1
+            for k in range((i - longest_length - 1), i):
+                current_char = data[k]
+                current_char_hash = hash(current_char)
+                if dictionary.get(current_char_hash):
+                    dictionary[current_char_hash].append(k)
+                else:
+                    dictionary[current_char_hash] = [k]
+        else:
+            byte_data.extend(lz_77.pack_tuple((0, 0, ord(current_char[0]))))
+            dictionary[current_char_hash] = [i]
+            i += 1
+    return byte_data
+
+
+def bench_match_finder(size=64 * 1024, search_buffer_size=8192, lookup_buffer_size=20):
+    data = synthetic_text(size)
+    rows = []
+    seconds, out = throughput(legacy_compress_block, search_buffer_size, lookup_buffer_size, data, repeat=1)
+    rows.append(("single char (legacy)", seconds, size, len(out)))
+    for max_chain in (16, 128, 1024):
+        compressor = lz_77.LZ77Compressor(search_buffer_size, lookup_buffer_size, max_chain=max_chain,
+                                          token_format=lz_77.TUPLES)
+        seconds, (_, out) = throughput(compressor.compress_block, 0, data.encode())
+        rows.append((f"hash chain (chain={max_chain})", seconds, size, len(out)))
+    report(rows)
+
+
+def legacy_decompress_block(data):
+    # The original decoder, reslices the remaining tokens on every step
+    decompressed_string = []
+    while True:
+        chunk = data[:struct.calcsize('<HBB')]
+        data = data[struct.calcsize('<HBB'):]
+        if not chunk:
+            break
+        distance, length, next_char = struct.unpack('<HBB', chunk)
+        if next_char == 0:
+            match_start = len(decompressed_string) - distance
+            decompressed_string.extend(decompressed_string[match_start:match_start + length])
+        elif distance > 0 and length > 0:
+            match_start = len(decompressed_string) - distance
+            for i in range(length):
+                decompressed_string.append(decompressed_string[match_start + i])
+            decompressed_string.append(chr(next_char))
+        else:
+            decompressed_string.append(chr(next_char))
+    return decompressed_string
+
+
+def bench_lz77_decode(sizes=(16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024), legacy_max=256 * 1024):
+    # ns per output byte should stay flat as the block grows
+    compressor = lz_77.LZ77Compressor(8192, 20, token_format=lz_77.TUPLES)
+    compact = lz_77.LZ77Compressor(8192, 20)
+    rows = []
+    for size in sizes:
+        data = synthetic_text(size).encode()
+        tokens = compressor.compress_window(data)
+        if size <= legacy_max:
+            seconds, out = throughput(legacy_decompress_block, tokens, repeat=1)
+            rows.append((f"reslicing {size // 1024} KB", seconds, size, len(out)))
+        seconds, out = throughput(compressor.decompress_window, tokens)
+        assert out == data
+        rows.append((f"memoryview {size // 1024} KB", seconds, size, len(out)))
+        tokens = compact.compress_window(data)
+        seconds, out = throughput(compact.decompress_window, tokens)
+        assert out == data
+        rows.append((f"compact {size // 1024} KB", seconds, size, len(out)))
+    report(rows)
+
+
+def legacy_huffman_decode(compressor, enc_data):
+    # The original bit at a time tree walk, kept as the decode baseline
+    padding_length = enc_data[0]
+    enc_data = enc_data[1:]
+    pairs = list()
+    while enc_data[:4] != b'\x00\x00\x00\x00':
+        char, freq = struct.unpack('<BI', enc_data[:5])
+        enc_data = enc_data[5:]
+        pairs.append((char, freq))
+    enc_data = enc_data[4:]
+    tree = compressor.create_huffman_tree(pairs)
+    last_byte = enc_data[-1]
+    enc_data = enc_data[:-1]
+    node = tree
+    dec_output = bytearray()
+    for byte in enc_data:
+        for bit_pos in range(8):
+            bit = (byte >> (7 - bit_pos)) & 1
+            node = node.left if bit == 0 else node.right
+            if node.char is not None:
+                dec_output.append(node.char)
+                node = tree
+    for bit_pos in range(8 - padding_length):
+        bit = (last_byte >> (7 - bit_pos)) & 1
+        node = node.left if bit == 0 else node.right
+        if node.char is not None:
+            dec_output.append(node.char)
+            node = tree
+    return dec_output
+
+
+def legacy_huffman_encode(compressor, data):
+    # The original layout: pad byte, (symbol, frequency) table and codes
+    # read off the rebuilt tree
+    pairs = sorted(Counter(data).items(), key=lambda x: x[1])
+    tree = compressor.create_huffman_tree(pairs)
+    code_table = [None] * 256
+    for byte, code in compressor.create_code_table(compressor.create_encoding_table(tree, encoding_table={})).items():
+        code_table[byte] = code
+    writer = bitio.BitWriter()
+    writer.write_bytes(data, code_table)
+    # the original wrote 8 - nbits % 8, so 8 when the last byte is full
+    pad_amount = writer.flush() or 8
+    return bytes([pad_amount]) + compressor.serialize_huffman_tree(pairs) + writer.getvalue()
+
+
+def huffman_encode(data):
+    # Runs compress_bin on a scratch file and returns the encoded bytes
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, "input"), "wb") as file:
+            file.write(data)
+        huffman.HuffmanCompressor().compress_bin(folder, "input")
+        with open(os.path.join(folder, "input.enc"), "rb") as file:
+            return file.read()
+
+
+def legacy_huffman_pack(encoding_table, data):
+    # The original '0'/'1' string packing, kept as the encode baseline
+    bit_string = ''.join([encoding_table[byte] for byte in data])
+    byte_array = bytearray()
+    for i in range(0, len(bit_string), 8):
+        byte_chunk = bit_string[i:i + 8]
+        if len(byte_chunk) < 8:
+            byte_chunk = byte_chunk.ljust(8, '0')
+        byte_array.append(int(byte_chunk, 2))
+    return byte_array
+
+
+def bench_huffman_encode(size=1024 * 1024):
+    data = synthetic_text(size).encode()
+    compressor = huffman.HuffmanCompressor()
+    tree = compressor.create_huffman_tree(sorted(Counter(data).items(), key=lambda x: x[1]))
+    encoding_table = compressor.create_encoding_table(tree, encoding_table={})
+    code_table = [None] * 256
+    for byte, code in compressor.create_code_table(encoding_table).items():
+        code_table[byte] = code
+    pairs = bitio.pair_table(code_table)
+
+    def pack(pairs):
+        writer = bitio.BitWriter()
+        writer.write_bytes(data, code_table, pairs)
+        writer.flush()
+        return writer.getvalue()
+
+    rows = []
+    seconds, expected = throughput(legacy_huffman_pack, encoding_table, data, repeat=1)
+    rows.append(("bit string (legacy)", seconds, size, len(expected)))
+    seconds, out = throughput(pack, None)
+    assert out == expected
+    rows.append(("bit writer", seconds, size, len(out)))
+    seconds, out = throughput(pack, pairs)
+    assert out == expected
+    rows.append(("bit writer (pair table)", seconds, size, len(out)))
+    report(rows)
+
+
+def bench_huffman_decode(size=1024 * 1024):
+    data = synthetic_text(size).encode()
+    enc_data = huffman_encode(data)
+    compressor = huffman.HuffmanCompressor()
+    rows = []
+    seconds, out = throughput(legacy_huffman_decode, compressor, legacy_huffman_encode(compressor, data), repeat=1)
+    rows.append(("tree walk (legacy)", seconds, size, len(out)))
+    seconds, out = throughput(compressor.decode, enc_data, False)
+    assert out == data
+    rows.append(("lookup table", seconds, size, len(out)))
+    if huffman.np is not None:
+        seconds, out = throughput(compressor.decode, enc_data, True)
+        assert out == data
+        rows.append(("lookup table (numpy)", seconds, size, len(out)))
+    report(rows)
+
+
+def bench_huffman_streams(size=1024 * 1024):
+    # Decode throughput of the single stream layout against the four stream
+    # one, with the table decoder and the NumPy batch decoder
+    data = synthetic_text(size).encode()
+    rows = []
+    for name, compressor in (("1 stream", huffman.HuffmanCompressor()),
+                             ("4 streams", huffman.HuffmanCompressor(four_streams=True))):
+        enc_data = compressor.encode(data)
+        seconds, out = throughput(compressor.decode, enc_data, False)
+        assert out == data
+        rows.append((f"{name} lookup table", seconds, size, len(enc_data)))
+        if huffman.np is not None:
+            seconds, out = throughput(compressor.decode, enc_data, True)
+            assert out == data
+            rows.append((f"{name} numpy", seconds, size, len(enc_data)))
+    report(rows)
+
+
+def bench_huffman_adaptive(size=4 * 1024 * 1024):
+    # First byte latency (time until the first output chunk exists), total
+    # time and size of the static modes against the adaptive one, on text
+    # and on input whose statistics change halfway
+    inputs = {
+        "text": synthetic_text(size).encode(),
+        "log then random": synthetic_log(size // 2).encode() + os.urandom(size // 2),
+    }
+    static = huffman.HuffmanCompressor()
+    adaptive = huffman.HuffmanCompressor(adaptive=True)
+    print(f"{'input':<17}{'mode':<22}{'first ms':>10}{'total s':>10}{'output':>10}{'ratio':>8}")
+    for name, data in inputs.items():
+        def whole():
+            # compress_bin: nothing comes out before the whole input is counted
+            ts = perf_counter()
+            out = static.encode(data)
+            return perf_counter() - ts, [out]
+
+        def streamed(compressor):
+            ts = perf_counter()
+            chunks = compressor.compress_stream(io.BytesIO(data))
+            out = [next(chunks)]
+            first = perf_counter() - ts
+            out.extend(chunks)
+            return first, out
+
+        for mode, run in (("static, whole input", whole),
+                          ("static, 1 MB frames", lambda: streamed(static)),
+                          ("adaptive", lambda: streamed(adaptive))):
+            ts = perf_counter()
+            first, out = run()
+            seconds = perf_counter() - ts
+            output = sum(len(chunk) for chunk in out)
+            decoder = adaptive if mode == "adaptive" else static
+            restored = decoder.decode(out[0]) if len(out) == 1 else b''.join(decoder.decompress_stream(out))
+            assert restored == data
+            print(f"{name:<17}{mode:<22}{first * 1e3:>10.1f}{seconds:>10.3f}{output:>10}{len(data) / output:>8.3f}")
+
+
+def bench_huffman_header(sizes=(256, 1024, 4096, 16 * 1024), repeat=50):
+    # Header bytes and decoder setup time (header parse up to a ready
+    # DecodeTable) of the frequency table format against canonical code
+    # lengths, on small inputs where the header dominates
+    compressor = huffman.HuffmanCompressor()
+    print(f"{'input':>8}{'old header':>12}{'new header':>12}{'old setup us':>14}{'new setup us':>14}"
+          f"{'old total':>11}{'new total':>11}")
+    for size in sizes:
+        data = synthetic_text(size, seed=size).encode()
+        old = legacy_huffman_encode(compressor, data)
+        new = bytes(compressor.encode(data))
+        assert compressor.decode(old) == data and compressor.decode(new) == data
+        old_header = old.index(b'\x00\x00\x00\x00', 1) + 4
+        lengths, new_header = huffman.unpack_code_lengths(new, 1)
+
+        nbits = (len(new) - new_header) * 8
+
+        def old_setup():
+            codes, index = compressor.read_frequency_table(old, 1)
+            return huffman.DecodeTable(codes)
+
+        def new_setup():
+            lengths, index = huffman.unpack_code_lengths(new, 1)
+            return huffman.DecodeTable({symbol: (code, length) for symbol, (code, length)
+                                        in enumerate(zip(huffman.canonical_codes(lengths), lengths)) if length},
+                                       huffman.decode_table_bits(nbits))
+
+        old_seconds, _ = throughput(lambda: [old_setup() for _ in range(repeat)])
+        new_seconds, _ = throughput(lambda: [new_setup() for _ in range(repeat)])
+        print(f"{size:>8}{old_header:>12}{new_header:>12}{old_seconds / repeat * 1e6:>14.1f}"
+              f"{new_seconds / repeat * 1e6:>14.1f}{len(old):>11}{len(new):>11}")
+    # An .enc file of the original format whose last byte is full starts
+    # with the pad byte 8, next to STORED but not it
+    for seed in range(64):
+        data = synthetic_text(1000, seed=seed).encode()
+        old = legacy_huffman_encode(compressor, data)
+        if old[0] == 8:
+            break
+    with tempfile.TemporaryDirectory() as folder:
+        with open(fileio.join(folder, "legacy.enc"), "wb") as file:
+            file.write(old)
+        assert compressor.decompress(folder, "legacy") == data
+
+
+def bench_huffman_limit(size=256 * 1024, limits=(None, 20, 15, 12, 10, 9)):
+    # Payload size of length limited codes against the unbounded Huffman
+    # code, on text, on the LZ77 tuples DeflateCompressor's Huffman stage
+    # sees and on a steeply skewed distribution that gives deep trees
+    text = synthetic_text(size).encode()
+    inputs = {
+        "text": Counter(text),
+        "lz77 tuples": Counter(lz_77.LZ77Compressor(8192, 20, token_format=lz_77.TUPLES).compress_window(text)),
+        "skewed": Counter({byte: int(size / 1.6 ** byte) + 1 for byte in range(256)}),
+    }
+    print(f"{'input':<14}{'limit':>6}{'longest':>9}{'payload':>10}{'loss':>9}{'build ms':>10}")
+    for name, counts in inputs.items():
+        frequencies = [counts[byte] for byte in range(256)]
+        unbounded = None
+        for limit in limits:
+            seconds, lengths = throughput(huffman.code_lengths, frequencies, limit)
+            payload = (sum(freq * length for freq, length in zip(frequencies, lengths)) + 7) // 8
+            unbounded = unbounded or payload
+            print(f"{name:<14}{str(limit):>6}{max(lengths):>9}{payload:>10}{payload / unbounded - 1:>9.3%}"
+                  f"{seconds * 1e3:>10.2f}")
+
+
+def bench_histogram(size=16 * 1024 * 1024):
+    # Byte counting MB/s: Counter over the whole input (the old path) and
+    # the histogram stage with NumPy and without it
+    data = os.urandom(size // 2) + synthetic_text(size // 2).encode()
+    rows = []
+    seconds, counts = throughput(Counter, data, repeat=1)
+    rows.append(("Counter", seconds, size, len(counts)))
+    seconds, expected = throughput(histogram.byte_histogram, data)
+    assert expected == [counts[byte] for byte in range(256)]
+    rows.append(("bincount" if histogram.np is not None else "chunked Counter", seconds, size, 256))
+    if histogram.np is not None:
+        np, histogram.np = histogram.np, None
+        try:
+            seconds, out = throughput(histogram.byte_histogram, data, repeat=1)
+        finally:
+            histogram.np = np
+        assert out == expected
+        rows.append(("chunked Counter (no numpy)", seconds, size, 256))
+    report(rows)
+
+
+def evict(path):
+    # Drops the file from the page cache so the next read comes from disk
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_io(size=256 * 1024 * 1024, chunk=huffman.CHUNK_SIZE):
+    # The I/O pattern of compress_bin before the mapped input (two buffered
+    # read passes) against one pass over a mapping, and buffered writes
+    # against a preallocated OutputSink, each from a cold page cache.
+    # crc32 stands in for the per chunk work so only I/O differs.
+    def two_reads(path):
+        for _ in range(2):
+            with open(path, "rb") as file:
+                while (data := file.read(chunk)):
+                    zlib.crc32(data)
+
+    def mapped(path):
+        with fileio.map_input(path) as data:
+            for offset in range(0, len(data), chunk):
+                zlib.crc32(data[offset:offset + chunk])
+
+    def buffered_write(path):
+        with open(path, "wb") as file:
+            for offset in range(0, size, chunk):
+                file.write(block)
+
+    def sink_write(path):
+        with fileio.OutputSink(path, size) as sink:
+            for offset in range(0, size, chunk):
+                sink.write(block)
+
+    block = os.urandom(chunk)
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "input")
+        with open(path, "wb") as file:
+            for offset in range(0, size, chunk):
+                file.write(block)
+        for name, f in (("2 buffered read passes", two_reads), ("1 mapped pass", mapped)):
+            best = float("inf")
+            for _ in range(3):
+                evict(path)
+                seconds, _ = throughput(f, path, repeat=1)
+                best = min(best, seconds)
+            rows.append((name, best, size, 0))
+        output = os.path.join(folder, "output")
+        for name, f in (("buffered write", buffered_write), ("preallocated sink", sink_write)):
+            seconds, _ = throughput(lambda: (f(output), evict(output)))
+            rows.append((name, seconds, size, os.path.getsize(output)))
+    report(rows)
+
+
+def bench_rfc1951(size=256 * 1024):
+    # Our raw DEFLATE output against stock zlib at the same window, zlib is
+    # also the decoder that checks it
+    data = synthetic_text(size).encode()
+    rows = []
+    for max_chain in (8, 128):
+        seconds, out = throughput(lambda: rfc1951.deflate(data, max_chain=max_chain), repeat=1)
+        assert zlib.decompress(out, -15) == data
+        rows.append((f"rfc1951 (chain={max_chain})", seconds, size, len(out)))
+    for level in (1, 6, 9):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        seconds, out = throughput(lambda: compressor.compress(data) + compressor.flush(), repeat=1)
+        rows.append((f"zlib level {level}", seconds, size, len(out)))
+    report(rows)
+
+
+def bench_levels(size=128 * 1024, levels=(1, 3, 5, 7, 9)):
+    # Ratio and speed of every parser: RFC 1951 output and LZ77 tuples after
+    # the Huffman stage, per compression level
+    data = synthetic_text(size).encode()
+    codec = huffman.HuffmanCompressor()
+    rows = []
+    for level in levels:
+        parser = lz_77.LEVELS[level][0]
+        seconds, out = throughput(lambda: rfc1951.deflate(data, level=level), repeat=1)
+        assert zlib.decompress(out, -15) == data
+        rows.append((f"rfc1951 {level} ({parser})", seconds, size, len(out)))
+        compressor = lz_77.LZ77Compressor(8192, 20, level=level)
+        seconds, tokens = throughput(compressor.compress_window, data, repeat=1)
+        assert compressor.decompress_window(tokens) == data
+        rows.append((f"lz77 {level} ({parser})", seconds, size, len(b"".join(codec.compress_stream([bytes(tokens)])))))
+    report(rows)
+
+
+def bench_tokens(size=256 * 1024, levels=(1, 6, 9)):
+    # Token bytes, size after the Huffman stage and compress time of the
+    # tuple format against the compact one, on text and on binary data
+    inputs = {
+        "text": synthetic_text(size).encode(),
+        "log": synthetic_log(size).encode(),
+        "binary": bytes(size // 4) + os.urandom(size // 4) + synthetic_text(size // 2).encode(),
+    }
+    codec = huffman.HuffmanCompressor()
+    print(f"{'input':<8}{'level':>6}{'format':>9}{'tokens':>9}{'huffman':>9}{'compress s':>12}")
+    for name, data in inputs.items():
+        for level in levels:
+            for token_format in (lz_77.TUPLES, lz_77.COMPACT):
+                compressor = lz_77.LZ77Compressor(8192, 20, level=level, token_format=token_format)
+                seconds, tokens = throughput(compressor.compress_window, data, repeat=1)
+                assert compressor.decompress_window(tokens) == data
+                print(f"{name:<8}{level:>6}{token_format:>9}{len(tokens):>9}{len(codec.encode(tokens)):>9}"
+                      f"{seconds:>12.3f}")
+
+
+def bench_binary(size=1024 * 1024, read_size=16 * 1024 * 1024):
+    # LZ77 and Deflate file round trips on inputs the text mode path could
+    # not take (a binary artifact, UTF-8 outside Latin-1), then reading a
+    # text file the old way (decode, encode to Latin-1) against mapping it
+    # the interpreter's library is a real compiled binary on any machine
+    library = os.path.join(sysconfig.get_config_var("LIBDIR") or "", sysconfig.get_config_var("LDLIBRARY") or "")
+    with open(library if os.path.isfile(library) else sys.executable, "rb") as file:
+        artifact = file.read(size)
+    inputs = {
+        "libpython": artifact,
+        "utf-8 text": synthetic_text(size // 2).replace("the", "thé ✓").encode()[:size],
+    }
+    # Null bytes anywhere, the tuple format's no character marker included,
+    # round trip in both token formats, every parser and the stream API
+    for data in (b'hello\x00world', bytes(10), b'abc\x00', b'abcabc\x00', b'\x00', artifact[:4096]):
+        for token_format in (lz_77.TUPLES, lz_77.COMPACT):
+            for level in (None, 5, 9):
+                codec = lz_77.LZ77Compressor(8192, 20, level=level, token_format=token_format)
+                assert codec.decompress_window(codec.compress_window(data)) == data
+            assert b''.join(codec.decompress_stream(codec.compress_stream([data]))) == data
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, data in inputs.items():
+            with open(fileio.join(folder, "input"), "wb") as file:
+                file.write(data)
+            for codec_name, codec, output_suffix in (
+                    ("lz77", lz_77.LZ77Compressor(8192, 20), ".enc"),
+                    ("lz77 tuples", lz_77.LZ77Compressor(8192, 20, token_format=lz_77.TUPLES), ".enc"),
+                    ("deflate", deflate.DeflateCompressor(8192, 20, 1), ".enc.enc")):
+                seconds, _ = throughput(codec.compress, folder, "input", repeat=1)
+                codec.decompress(folder, "input")
+                with open(fileio.join(folder, "input.2"), "rb") as file:
+                    assert file.read() == data
+                rows.append((f"{codec_name} {name}", seconds, len(data),
+                             os.path.getsize(fileio.join(folder, f"input{output_suffix}"))))
+
+        path = fileio.join(folder, "text.txt")
+        with open(path, "w") as file:
+            file.write(synthetic_text(read_size))
+
+        def text_read():
+            with open(path, "r") as file:
+                return file.read().encode('latin-1')
+
+        def mapped_read():
+            with fileio.map_input(path) as data:
+                return bytes(data)
+
+        for name, read in (("read text + latin-1", text_read), ("mapped bytes", mapped_read)):
+            seconds, out = throughput(read)
+            rows.append((name, seconds, read_size, len(out)))
+    report(rows)
+
+
+def bench_cache(size=1024 * 1024, files=4):
+    # Deflate compress of unchanged inputs, cold (every input a miss) and
+    # warm (every input a hit), then the same files through a cache that
+    # only holds half of them, so every store evicts
+    rows = []
+    with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as cache_folder:
+        names = []
+        for i in range(files):
+            names.append(f"input{i}")
+            with open(fileio.join(folder, names[-1]), "wb") as file:
+                file.write(synthetic_text(size, seed=i).encode())
+        for codec_name, rfc in (("deflate", False), ("rfc1951", True)):
+            store = cache.CompressionCache(fileio.join(cache_folder, codec_name))
+            codec = deflate.DeflateCompressor(8192, 20, 1, rfc1951=rfc, cache=store)
+            cold, _ = throughput(lambda: [codec.compress(folder, name) for name in names], repeat=1)
+            warm, _ = throughput(lambda: [codec.compress(folder, name) for name in names])
+            codec.decompress(folder, names[0])
+            with open(fileio.join(folder, names[0]), "rb") as original, \
+                    open(fileio.join(folder, f"{names[0]}.2"), "rb") as restored:
+                assert original.read() == restored.read()
+            rows.append((f"{codec_name} cold", cold, size * files, store.size))
+            rows.append((f"{codec_name} warm x{cold / warm:.0f}", warm, size * files, store.size))
+            print(f"{codec_name}: {store.stats()}")
+        store = cache.CompressionCache(fileio.join(cache_folder, "small"), max_bytes=store.size // 2)
+        codec = deflate.DeflateCompressor(8192, 20, 1, rfc1951=True, cache=store)
+        seconds, _ = throughput(lambda: [codec.compress(folder, name) for name in names], repeat=2)
+        rows.append(("rfc1951 half size cache", seconds, size * files, store.size))
+        print(f"half size: {store.stats()}")
+    report(rows)
+
+
+def bench_dictionary(size=1024, files=100, samples=200, dictionary_size=16 * 1024):
+    # Many small files of one kind, each compressed on its own, with and
+    # without a dictionary trained on other files of that kind: total output
+    # bytes and milliseconds per file. lz77+huffman is the block format of
+    # DeflateCompressor (primed compact tokens, Huffman seeded with the
+    # token counts) without the container headers.
+    generators = {"json": synthetic_json, "log": synthetic_log}
+    print(f"{'input':<6}{'codec':<15}{'plain':>8}{'dict':>8}{'saved':>8}{'ms plain':>10}{'ms dict':>9}")
+    for kind, generate in generators.items():
+        training = [generate(size, seed=seed).encode() for seed in range(samples)]
+        seconds, trained = throughput(dictionary.train_dictionary, training, dictionary_size, repeat=1)
+        print(f"{kind}: trained {len(trained.content)} bytes from {samples} samples in {seconds:.2f}s")
+        inputs = [generate(size, seed=samples + seed).encode() for seed in range(files)]
+        zdict = trained.content
+
+        def zlib_compress(data, zdict=None):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=zdict) if zdict else \
+                zlib.compressobj(9, zlib.DEFLATED, -15)
+            return compressor.compress(data) + compressor.flush()
+
+        def lz77_huffman(lz, codec):
+            return lambda data: codec.encode(lz.encode_block(data))
+
+        codecs = {
+            "huffman": (huffman.HuffmanCompressor().encode,
+                        huffman.HuffmanCompressor(dictionary=trained).encode),
+            "lz77+huffman": (lz77_huffman(lz_77.LZ77Compressor(8192, 20), huffman.HuffmanCompressor()),
+                             lz77_huffman(lz_77.LZ77Compressor(8192, 20, dictionary=trained),
+                                          huffman.HuffmanCompressor(dictionary=trained,
+                                                                    dictionary_table=dictionary.TOKENS))),
+            "rfc1951": (rfc1951.deflate, lambda data: rfc1951.deflate(data, zdict=zdict)),
+            "zlib 9": (zlib_compress, lambda data: zlib_compress(data, zdict)),
+        }
+        for name, (plain, primed) in codecs.items():
+            plain_seconds, plain_out = throughput(lambda: [plain(data) for data in inputs], repeat=1)
+            primed_seconds, primed_out = throughput(lambda: [primed(data) for data in inputs], repeat=1)
+            plain_bytes = sum(map(len, plain_out))
+            primed_bytes = sum(map(len, primed_out))
+            print(f"{kind:<6}{name:<15}{plain_bytes:>8}{primed_bytes:>8}{1 - primed_bytes / plain_bytes:>8.1%}"
+                  f"{plain_seconds * 1000 / files:>10.2f}{primed_seconds * 1000 / files:>9.2f}")
+        print(f"{kind:<6}{'input':<15}{size * files:>8}")
+        # a primed LZ77 stream decodes with its own dictionary only
+        other = dictionary.train_dictionary(inputs, dictionary_size)
+        stream = b''.join(lz_77.LZ77Compressor(8192, 20, dictionary=trained).compress_stream([inputs[0]]))
+        assert b''.join(lz_77.LZ77Compressor(8192, 20, dictionary=trained).decompress_stream([stream])) == inputs[0]
+        for wrong in (None, other):
+            try:
+                b''.join(lz_77.LZ77Compressor(8192, 20, dictionary=wrong).decompress_stream([stream]))
+            except ValueError:
+                continue
+            raise AssertionError(f"stream decoded with dictionary {wrong and wrong.id}")
+
+
+def bench_instrument(size=256 * 1024, small=1024, files=500):
+    # Cost of the instrumentation hooks: the same work with instrumentation
+    # off, on, and on with the sampling profiler. The small inputs make the
+    # per call cost of the hooks show, the large ones the per byte cost
+    text = synthetic_text(size).encode()
+    inputs = [synthetic_log(small, seed=seed).encode() for seed in range(files)]
+    codec = huffman.HuffmanCompressor()
+    work = {
+        "rfc1951 level 6": lambda: rfc1951.deflate(text, level=6),
+        "lz77 level 9": lambda: lz_77.LZ77Compressor(8192, 20, level=9).compress_window(text),
+        f"huffman {files} x {small}": lambda: [codec.encode(data) for data in inputs],
+        f"rfc1951 {files} x {small}": lambda: [rfc1951.deflate(data) for data in inputs],
+    }
+    print(f"{'work':<24}{'off s':>9}{'on':>9}{'profiled':>10}")
+    for name, run in work.items():
+        # alternated so drift in the machine's speed hits every mode alike
+        best = {"off": float("inf"), "on": float("inf"), "profiled": float("inf")}
+        for _ in range(3):
+            for mode in best:
+                if mode != "off":
+                    instrument.enable(sample_interval=0.001 if mode == "profiled" else None)
+                seconds, _ = throughput(run, repeat=1)
+                instrument.disable()
+                best[mode] = min(best[mode], seconds)
+        print(f"{name:<24}{best['off']:>9.3f}{best['on'] / best['off']:>8.2f}x{best['profiled'] / best['off']:>9.2f}x")
+
+
+def bench_pipeline(size=2 * 1024 * 1024, block_size=256 * 1024):
+    # Deflate file compress and decompress, the two pass format (LZ77 to
+    # .enc on disk, then Huffman over that file) against the pipelined one,
+    # on threads and on processes. The stage columns are the time each
+    # stage took summed over blocks: the pipeline can at best bring the
+    # total down to the slower of the two, given a core per stage.
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        with open(fileio.join(folder, "input"), "wb") as file:
+            file.write(synthetic_text(size).encode())
+        print(f"{'mode':<28}{'compress s':>11}{'lz77 s':>9}{'huffman s':>10}{'decompress s':>13}{'output':>9}")
+        for name, pipeline, kind in (("two pass", False, "process"), ("pipelined threads", True, "thread"),
+                                     ("pipelined processes", True, "process")):
+            codec = deflate.DeflateCompressor(8192, 20, size // block_size, pipeline=pipeline,
+                                              pipeline_block_size=block_size)
+            original = pool.choose_executor
+            deflate.choose_executor = lz_77.choose_executor = huffman.choose_executor = \
+                lambda input_size, max_workers=None: pool.get_executor(kind, max_workers)
+            try:
+                metrics = instrument.enable()
+                compress_seconds = codec.compress(folder, "input")
+                instrument.disable()
+                decompress_seconds = codec.decompress(folder, "input")
+            finally:
+                deflate.choose_executor = lz_77.choose_executor = huffman.choose_executor = original
+            with open(fileio.join(folder, "input"), "rb") as source, \
+                    open(fileio.join(folder, "input.2"), "rb") as restored:
+                assert source.read() == restored.read()
+            stages = metrics.snapshot()["stages"]
+            lz77_seconds = sum(stages.get(stage, {}).get("seconds", 0) for stage in ("match_finding", "token_emit"))
+            huffman_seconds = sum(stages.get(stage, {}).get("seconds", 0)
+                                  for stage in ("histogram", "tree_build", "bit_packing"))
+            print(f"{name:<28}{compress_seconds:>11.3f}{lz77_seconds:>9.3f}{huffman_seconds:>10.3f}"
+                  f"{decompress_seconds:>13.3f}{os.path.getsize(codec.output_file(folder, 'input')):>9}")
+
+
+def bench_stored(size=512 * 1024, block_size=64 * 1024):
+    # File compress and decompress of every codec with and without stored
+    # blocks, on text, on already compressed data (zlib output of other
+    # text) and on the two alternating every block_size bytes
+    text = synthetic_text(size).encode()
+    packed = zlib.compress(synthetic_text(4 * size, seed=1).encode(), 9)[:size]
+    mixed = b''.join(text[start:start + block_size] + packed[start:start + block_size]
+                     for start in range(0, size // 2, block_size))
+    codecs = {
+        "huffman": lambda stored: huffman.HuffmanCompressor(block_number=8, stored_blocks=stored),
+        "lz77": lambda stored: lz_77.LZ77Compressor(8192, 20, 8, stored_blocks=stored),
+        "deflate": lambda stored: deflate.DeflateCompressor(8192, 20, 8, stored_blocks=stored),
+        "rfc1951": lambda stored: deflate.DeflateCompressor(8192, 20, 8, rfc1951=True, stored_blocks=stored),
+    }
+    print(f"{'codec':<10}{'input':<12}{'stored':<8}{'compress MB/s':>14}{'decompress MB/s':>16}{'output':>9}"
+          f"{'ratio':>7}")
+    with tempfile.TemporaryDirectory() as folder:
+        for input_name, data in (("text", text), ("compressed", packed), ("mixed", mixed)):
+            with open(fileio.join(folder, input_name), "wb") as file:
+                file.write(data)
+            for codec_name, factory in codecs.items():
+                for stored in (False, True):
+                    codec = factory(stored)
+                    if codec_name == "huffman":
+                        compress_seconds, _ = throughput(codec.compress_bin, folder, input_name, repeat=1)
+                        decompress_seconds, _ = throughput(codec.decompress, folder, input_name, repeat=1)
+                        output, restored = f"{input_name}.enc", f"{input_name}.dec"
+                    else:
+                        compress_seconds = codec.compress(folder, input_name)
+                        decompress_seconds = codec.decompress(folder, input_name)
+                        output = os.path.basename(codec.output_file(folder, input_name)) \
+                            if codec_name != "lz77" else f"{input_name}.enc"
+                        restored = f"{input_name}.2"
+                    with open(fileio.join(folder, restored), "rb") as file:
+                        assert file.read() == data
+                    output_size = os.path.getsize(fileio.join(folder, output))
+                    print(f"{codec_name:<10}{input_name:<12}{'on' if stored else 'off':<8}"
+                          f"{len(data) / compress_seconds / 1e6:>14.2f}{len(data) / decompress_seconds / 1e6:>16.2f}"
+                          f"{output_size:>9}{output_size / len(data):>7.3f}")
+
+
+def bench_batch(small=2 * 1024, files=400, large=2 * 1024 * 1024, large_files=2):
+    # Many small files and a few large ones compressed by the batch front
+    # end against one compress() call per file in a plain loop
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for index in range(files + large_files):
+            size = small if index < files else large
+            paths.append(fileio.join(folder, f"input{index}"))
+            with open(paths[-1], "wb") as file:
+                file.write(synthetic_json(size, seed=index).encode()[:size])
+        # ends like an output (.2) but nothing named libfoo.so exists, so it
+        # is an input like the others
+        paths.append(fileio.join(folder, "libfoo.so.2"))
+        with open(paths[-1], "wb") as file:
+            file.write(synthetic_json(small, seed=files + large_files).encode()[:small])
+        total = sum(os.path.getsize(path) for path in paths)
+        print(f"{files + 1} files of {small} bytes, {large_files} of {large}")
+        print(f"{'codec':<10}{'mode':<12}{'seconds':>9}{'MB/s':>8}{'files/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+        for codec_name in ("huffman", "rfc1951", "deflate"):
+            codec, compress, suffix = batch.new_codec(codec_name, 8192, 20, os.cpu_count() or 1)
+            start_time = perf_counter()
+            latencies = []
+            for path in paths:
+                batch.compress_file(compress, suffix, path)
+                latencies.append(perf_counter() - start_time)
+            seconds = perf_counter() - start_time
+            print(f"{codec_name:<10}{'loop':<12}{seconds:>9.2f}{total / seconds / 1e6:>8.2f}{len(paths) / seconds:>9.1f}"
+                  f"{batch.percentile(latencies, 50) * 1000:>9.1f}{batch.percentile(latencies, 99) * 1000:>9.1f}")
+            small_codec = batch.new_codec(codec_name, 8192, 20, 1)[1:]
+            large_codec = batch.new_codec(codec_name, 8192, 20, os.cpu_count() or 1)[1:]
+            front = batch.BatchCompressor(small_codec, large_codec)
+            asyncio.run(front.run([folder]))
+            summary = front.summary()
+            assert summary["files"] == len(paths) and not summary["failed"]
+            # JSON text shrinks, so the ratio (input over output) is above 1
+            assert summary["ratio"] == summary["input_bytes"] / summary["output_bytes"] > 1
+            print(f"{codec_name:<10}{'batch':<12}{summary['seconds']:>9.2f}{summary['mbps']:>8.2f}"
+                  f"{summary['files_per_second']:>9.1f}{summary['latency_ms']['p50']:>9.1f}"
+                  f"{summary['latency_ms']['p99']:>9.1f}")
+
+
+def bench_parallel(size=1024 * 1024):
+    # LZ77 and Huffman file compress/decompress with one block per worker,
+    # from 1 to N workers on the shared pool, speedup relative to a single
+    # worker. Huffman runs on a binary file of 4x the size.
+    cores = os.cpu_count() or 1
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        folder += "/"
+        with open(f"{folder}input.txt", "w") as file:
+            file.write(synthetic_text(size))
+        with open(f"{folder}input.bin", "wb") as file:
+            file.write(lz_77.LZ77Compressor(8192, 20).compress_window(synthetic_text(size).encode()))
+        codecs = [
+            ("lz77", "input.txt", size,
+             lambda workers: lz_77.LZ77Compressor(8192, 20, block_number=workers, max_workers=workers)),
+            ("huffman", "input.bin", os.path.getsize(f"{folder}input.bin"),
+             lambda workers: huffman.HuffmanCompressor(block_number=workers, max_workers=workers)),
+        ]
+        for name, input_file, input_size, factory in codecs:
+            baseline = None
+            for workers in range(1, cores + 1):
+                compressor = factory(workers)
+                compress = compressor.compress if name == "lz77" else compressor.compress_bin
+                compress(folder, input_file)  # warm up the pool
+                comp_seconds, _ = throughput(compress, folder, input_file, repeat=1)
+                decomp_seconds, _ = throughput(compressor.decompress, folder, input_file, repeat=1)
+                baseline = baseline or comp_seconds
+                rows.append((f"{name} compress {workers}w x{baseline / comp_seconds:.2f}", comp_seconds, input_size,
+                             os.path.getsize(f"{folder}{input_file}.enc")))
+                rows.append((f"{name} decompress {workers}w", decomp_seconds, input_size, input_size))
+    report(rows)
+
+
+BENCHMARKS = {
+    "match_finder": bench_match_finder,
+    "lz77_decode": bench_lz77_decode,
+    "huffman_encode": bench_huffman_encode,
+    "huffman_decode": bench_huffman_decode,
+    "huffman_streams": bench_huffman_streams,
+    "huffman_header": bench_huffman_header,
+    "huffman_adaptive": bench_huffman_adaptive,
+    "histogram": bench_histogram,
+    "huffman_limit": bench_huffman_limit,
+    "rfc1951": bench_rfc1951,
+    "levels": bench_levels,
+    "tokens": bench_tokens,
+    "binary": bench_binary,
+    "cache": bench_cache,
+    "dictionary": bench_dictionary,
+    "instrument": bench_instrument,
+    "pipeline": bench_pipeline,
+    "stored": bench_stored,
+    "batch": bench_batch,
+    "parallel": bench_parallel,
+    "io": bench_io,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"\n== {name}")
+        BENCHMARKS[name]()
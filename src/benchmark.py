@@ -0,0 +1,251 @@
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from time import perf_counter
+
+import deflate
+import huffman
+import lz_77
+from corpus import generate_corpus
+
+# Benchmark matrix: codecs x parameters x corpus files. Every case runs the
+# codec's file API on a private copy of the input, `warmup` untimed rounds
+# then `repeat` timed ones, checks the round trip and records the median
+# times. Cases run one per fresh worker process by default so the reported
+# peak RSS belongs to that case alone. Results go to JSON and/or CSV and can
+# be compared against an earlier JSON run to catch regressions.
+#
+#     python benchmark.py --window 4096,8192 --blocks 1,3 --json run.json
+#     python benchmark.py --codecs rfc1951 --levels default,1,6,9
+#     python benchmark.py --corpus ../text_encoded_files/ --compare run.json
+
+Case = namedtuple('Case', 'codec file window lookahead blocks level')
+
+FIELDS = ["codec", "file", "window", "lookahead", "blocks", "level", "input_bytes", "output_bytes", "ratio",
+          "compress_s", "decompress_s", "compress_mbps", "decompress_mbps", "peak_rss_kb", "ok"]
+
+# Fields that identify a case when comparing two runs
+KEY_FIELDS = ["codec", "file", "window", "lookahead", "blocks", "level"]
+
+
+def _huffman(case):
+    codec = huffman.HuffmanCompressor()
+    return codec.compress_bin, codec.decompress, ".enc", ".dec"
+
+
+def _lz77(case):
+    codec = lz_77.LZ77Compressor(case.window, case.lookahead, case.blocks, level=case.level)
+    return codec.compress, codec.decompress, ".enc", ".2"
+
+
+def _deflate(case):
+    codec = deflate.DeflateCompressor(case.window, case.lookahead, case.blocks, level=case.level)
+    return codec.compress, codec.decompress, ".enc.enc", ".2"
+
+
+def _deflate_pipeline(case):
+    codec = deflate.DeflateCompressor(case.window, case.lookahead, case.blocks, level=case.level, pipeline=True)
+    return codec.compress, codec.decompress, ".enc.enc", ".2"
+
+
+def _rfc1951(case):
+    codec = deflate.DeflateCompressor(case.window, case.lookahead, case.blocks, rfc1951=True, level=case.level)
+    return codec.compress, codec.decompress, ".deflate", ".2"
+
+
+# codec name -> (factory, whether it takes window/lookahead/blocks/level)
+CODECS = {
+    "huffman": (_huffman, False),
+    "lz77": (_lz77, True),
+    "deflate": (_deflate, True),
+    "deflate_pipeline": (_deflate_pipeline, True),
+    "rfc1951": (_rfc1951, True),
+}
+
+
+def build_cases(codecs, files, windows, lookaheads, blocks, levels=(None,)) -> list[Case]:
+    cases = []
+    for codec in codecs:
+        factory, parametrized = CODECS[codec]
+        grid = itertools.product(windows, lookaheads, blocks, levels) if parametrized else [(None, None, None, None)]
+        for window, lookahead, block_number, level in grid:
+            for file in files:
+                cases.append(Case(codec, file, window, lookahead, block_number, level))
+    return cases
+
+
+def run_case(case, warmup, repeat) -> dict:
+    compress, decompress, output_suffix, restored_suffix = CODECS[case.codec][0](case)
+    with tempfile.TemporaryDirectory() as folder:
+        folder += "/"
+        name = os.path.basename(case.file)
+        shutil.copyfile(case.file, f"{folder}{name}")
+        compress_times = []
+        decompress_times = []
+        for round_number in range(warmup + repeat):
+            ts = perf_counter()
+            compress(folder, name)
+            tm = perf_counter()
+            decompress(folder, name)
+            te = perf_counter()
+            if round_number >= warmup:
+                compress_times.append(tm - ts)
+                decompress_times.append(te - tm)
+        input_bytes = os.path.getsize(f"{folder}{name}")
+        output_bytes = os.path.getsize(f"{folder}{name}{output_suffix}")
+        with open(f"{folder}{name}", "rb") as original, open(f"{folder}{name}{restored_suffix}", "rb") as restored:
+            ok = original.read() == restored.read()
+
+    compress_s = statistics.median(compress_times)
+    decompress_s = statistics.median(decompress_times)
+    return {
+        **case._asdict(),
+        "file": name,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "ratio": input_bytes / output_bytes if output_bytes else 0.0,
+        "compress_s": compress_s,
+        "decompress_s": decompress_s,
+        "compress_mbps": input_bytes / compress_s / 1e6 if compress_s else 0.0,
+        "decompress_mbps": input_bytes / decompress_s / 1e6 if decompress_s else 0.0,
+        # kilobytes on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "ok": ok,
+    }
+
+
+def run_matrix(cases, warmup=1, repeat=3, isolate=True) -> list[dict]:
+    results = []
+    for case in cases:
+        if isolate:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+                result = executor.submit(run_case, case, warmup, repeat).result()
+        else:
+            result = run_case(case, warmup, repeat)
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def print_header():
+    print(f"{'codec':<9}{'file':<18}{'window':>7}{'look':>5}{'blk':>4}{'lvl':>4}{'ratio':>8}"
+          f"{'comp MB/s':>11}{'dec MB/s':>10}{'RSS MB':>8}  ok")
+
+
+def print_result(result):
+    def show(value):
+        return "-" if value is None else value
+    print(f"{result['codec']:<9}{result['file'][:17]:<18}{show(result['window']):>7}{show(result['lookahead']):>5}"
+          f"{show(result['blocks']):>4}{show(result['level']):>4}{result['ratio']:>8.3f}{result['compress_mbps']:>11.3f}"
+          f"{result['decompress_mbps']:>10.3f}{result['peak_rss_kb'] / 1024:>8.1f}  {result['ok']}")
+
+
+def metadata() -> dict:
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_json(path, results):
+    with open(path, "w") as file:
+        json.dump({"meta": metadata(), "results": results}, file, indent=2)
+
+
+def write_csv(path, results):
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow({field: result[field] for field in FIELDS})
+
+
+def compare(path, results, threshold=0.1) -> int:
+    # Prints the change of every case also found in an earlier JSON run,
+    # returns how many got slower or compress worse by more than threshold
+    with open(path) as file:
+        # runs from before levels existed have no level field
+        baseline = {tuple(row.get(field) for field in KEY_FIELDS): row for row in json.load(file)["results"]}
+    regressions = 0
+    print(f"\nChange against {path}")
+    for result in results:
+        old = baseline.get(tuple(result[field] for field in KEY_FIELDS))
+        if old is None:
+            continue
+        changes = {field: result[field] / old[field] - 1 if old[field] else 0.0
+                   for field in ("ratio", "compress_mbps", "decompress_mbps")}
+        regressed = any(change < -threshold for change in changes.values())
+        regressions += regressed
+        print(f"{result['codec']:<9}{result['file'][:17]:<18}"
+              + "".join(f"{field} {change:+.1%}  " for field, change in changes.items())
+              + ("REGRESSION" if regressed else ""))
+    return regressions
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def level_list(value):
+    # "default" keeps the codec's own settings
+    return [None if item == "default" else int(item) for item in value.split(",")]
+
+
+def add_arguments(parser):
+    parser.add_argument("--corpus", help="folder of input files, a synthetic corpus is generated when omitted")
+    parser.add_argument("--synthetic-size", type=int, default=256 * 1024, help="bytes per synthetic file")
+    parser.add_argument("--codecs", default=",".join(CODECS), help="comma separated, any of " + ", ".join(CODECS))
+    parser.add_argument("--window", type=int_list, default=[8192], help="search buffer sizes")
+    parser.add_argument("--lookahead", type=int_list, default=[20], help="lookup buffer sizes")
+    parser.add_argument("--blocks", type=int_list, default=[1], help="parallel block counts")
+    parser.add_argument("--levels", type=level_list, default=[None], help="compression levels 1-9 or default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--no-isolate", action="store_true", help="run every case in this process")
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--csv", help="write results to this CSV file")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative drop reported as a regression")
+
+
+def run(args) -> int:
+    with tempfile.TemporaryDirectory() as synthetic_folder:
+        if args.corpus:
+            folder = args.corpus
+            files = sorted(name for name in os.listdir(folder)
+                           if os.path.isfile(os.path.join(folder, name)) and not name.startswith("."))
+        else:
+            folder = synthetic_folder
+            files = generate_corpus(folder, args.synthetic_size)
+        files = [os.path.join(folder, name) for name in files]
+        cases = build_cases(args.codecs.split(","), files, args.window, args.lookahead, args.blocks, args.levels)
+        print_header()
+        results = run_matrix(cases, args.warmup, args.repeat, isolate=not args.no_isolate)
+
+    if args.json:
+        write_json(args.json, results)
+    if args.csv:
+        write_csv(args.csv, results)
+    failures = sum(not result["ok"] for result in results)
+    if args.compare:
+        failures += compare(args.compare, results, args.threshold)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compression benchmark matrix")
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,174 @@
+# MSB first bit packing for the Huffman coders. Codes are kept in an integer
+# accumulator and only whole bytes are moved to the output, so memory tracks
+# the size of the packed output rather than one character per bit.
+
+import sys
+
+FLUSH_BITS = 128
+
+
+def pair_table(table):
+    # Joins the (code, length) entries of a 256 entry byte table into a 65536
+    # entry table indexed by two bytes read as a native endian 'H', which
+    # halves the iterations of write_symbols on byte input
+    pairs = [None] * 65536
+    little = sys.byteorder == 'little'
+    present = [(byte, entry) for byte, entry in enumerate(table) if entry is not None]
+    for first, (first_code, first_length) in present:
+        for second, (second_code, second_length) in present:
+            index = first | (second << 8) if little else (first << 8) | second
+            pairs[index] = ((first_code << second_length) | second_code, first_length + second_length)
+    return pairs
+
+
+class BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.acc_bits = 0
+
+    def __len__(self):
+        # number of bits written so far
+        return len(self.data) * 8 + self.acc_bits
+
+    def write(self, code: int, length: int):
+        self.acc = (self.acc << length) | code
+        self.acc_bits += length
+        if self.acc_bits >= FLUSH_BITS:
+            self._flush_bytes()
+
+    def write_symbols(self, symbols, table):
+        # table[symbol] is a (code, length) pair, inlined for the hot loop
+        acc = self.acc
+        acc_bits = self.acc_bits
+        data = self.data
+        for symbol in symbols:
+            code, length = table[symbol]
+            acc = (acc << length) | code
+            acc_bits += length
+            if acc_bits >= FLUSH_BITS:
+                extra = acc_bits & 7
+                data += (acc >> extra).to_bytes(acc_bits >> 3, 'big')
+                acc &= (1 << extra) - 1
+                acc_bits = extra
+        self.acc = acc
+        self.acc_bits = acc_bits
+
+    def write_bytes(self, data, table, pairs=None):
+        # Packs a bytes-like object, two bytes per step when a pair table is given
+        if pairs is None:
+            self.write_symbols(data, table)
+            return
+        even = len(data) & ~1
+        self.write_symbols(memoryview(data)[:even].cast('H'), pairs)
+        if even != len(data):
+            self.write_symbols(data[even:], table)
+
+    def _flush_bytes(self):
+        extra = self.acc_bits & 7
+        self.data += (self.acc >> extra).to_bytes(self.acc_bits >> 3, 'big')
+        self.acc &= (1 << extra) - 1
+        self.acc_bits = extra
+
+    def flush(self) -> int:
+        # Pad the last byte with zero bits, returns how many were added
+        pad_amount = -self.acc_bits % 8
+        self.acc <<= pad_amount
+        self.acc_bits += pad_amount
+        self._flush_bytes()
+        return pad_amount
+
+    def getvalue(self) -> bytearray:
+        return self.data
+
+    def take(self) -> bytes:
+        # Returns and forgets the whole bytes written so far, a partial byte
+        # stays in the accumulator
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+class BitReader:
+    def __init__(self, data, bit_position=0):
+        self.data = data
+        self.pos = bit_position >> 3
+        self.acc = 0
+        self.acc_bits = 0
+        if bit_position & 7:
+            self.read(bit_position & 7)
+
+    def bit_position(self) -> int:
+        return self.pos * 8 - self.acc_bits
+
+    def _refill(self, count: int):
+        # Bits past the end of data read as zero
+        while self.acc_bits < count:
+            chunk = self.data[self.pos:self.pos + 7]
+            self.acc = ((self.acc & ((1 << self.acc_bits) - 1)) << 56) | (int.from_bytes(chunk, 'big') << (8 * (7 - len(chunk))))
+            self.pos += 7
+            self.acc_bits += 56
+
+    def peek(self, count: int) -> int:
+        if self.acc_bits < count:
+            self._refill(count)
+        return (self.acc >> (self.acc_bits - count)) & ((1 << count) - 1)
+
+    def skip(self, count: int):
+        if self.acc_bits < count:
+            self._refill(count)
+        self.acc_bits -= count
+
+    def read(self, count: int) -> int:
+        value = self.peek(count)
+        self.acc_bits -= count
+        return value
+
+
+class LSBBitWriter:
+    # LSB first packing as used by DEFLATE (RFC 1951 section 3.1.1). Huffman
+    # codes have to be passed bit reversed, see reverse_bits.
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.acc_bits = 0
+
+    def write(self, value: int, length: int):
+        self.acc |= value << self.acc_bits
+        self.acc_bits += length
+        if self.acc_bits >= FLUSH_BITS:
+            count = self.acc_bits >> 3
+            self.data += (self.acc & ((1 << (count * 8)) - 1)).to_bytes(count, 'little')
+            self.acc >>= count * 8
+            self.acc_bits &= 7
+
+    def align(self):
+        # Zero bits up to the next byte boundary, then move everything to data
+        count = (self.acc_bits + 7) >> 3
+        self.data += self.acc.to_bytes(count, 'little')
+        self.acc = 0
+        self.acc_bits = 0
+
+    def write_raw(self, data):
+        self.align()
+        self.data += data
+
+    def take(self) -> bytes:
+        # Returns and forgets the whole bytes written so far, a partial byte
+        # stays in the accumulator
+        count = self.acc_bits >> 3
+        if count:
+            self.data += (self.acc & ((1 << (count * 8)) - 1)).to_bytes(count, 'little')
+            self.acc >>= count * 8
+            self.acc_bits &= 7
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+def reverse_bits(code: int, length: int) -> int:
+    result = 0
+    for _ in range(length):
+        result = (result << 1) | (code & 1)
+        code >>= 1
+    return result
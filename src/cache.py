@@ -0,0 +1,148 @@
+import hashlib
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+
+from fileio import join, map_input
+
+# Content addressed store for compressed outputs, so compressing an input
+# that was compressed before with the same settings just copies the stored
+# outputs back. The key is a SHA-256 over the codec name, its parameters
+# and the input bytes; the entry holds every file the codec writes (which
+# includes the Huffman code lengths, they are the header of its output).
+# Entries are files in one folder and their mtime is the LRU order: a hit
+# touches the entry, and storing evicts the least recently used entries
+# until the folder fits max_bytes again.
+#
+# Entry file: for every output file
+#     2 bytes length of the file's suffix, the suffix (e.g. b'.enc.enc')
+#     8 bytes length of the file, the file
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/compression-tester")
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+ENTRY_SUFFIX = ".entry"
+NAME_LENGTH = struct.Struct('>H')
+FILE_LENGTH = struct.Struct('>Q')
+
+
+def pack_entry(files) -> bytes:
+    # files maps output suffixes to their contents
+    out = bytearray()
+    for suffix, data in files.items():
+        name = suffix.encode()
+        out += NAME_LENGTH.pack(len(name)) + name
+        out += FILE_LENGTH.pack(len(data))
+        out += data
+    return bytes(out)
+
+
+def unpack_entry(data) -> dict:
+    files = {}
+    pos = 0
+    while pos < len(data):
+        (name_length,) = NAME_LENGTH.unpack_from(data, pos)
+        pos += NAME_LENGTH.size
+        suffix = bytes(data[pos:pos + name_length]).decode()
+        pos += name_length
+        (length,) = FILE_LENGTH.unpack_from(data, pos)
+        pos += FILE_LENGTH.size
+        files[suffix] = data[pos:pos + length]
+        pos += length
+    return files
+
+
+class CompressionCache:
+    def __init__(self, folder=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        # key -> entry size, least recently used first
+        self.entries = OrderedDict()
+        found = []
+        for name in os.listdir(folder):
+            if name.endswith(ENTRY_SUFFIX):
+                stat = os.stat(join(folder, name))
+                found.append((stat.st_mtime_ns, name[:-len(ENTRY_SUFFIX)], stat.st_size))
+        for mtime, key, size in sorted(found):
+            self.entries[key] = size
+        self.size = sum(self.entries.values())
+        self.evict()
+
+    def key(self, codec, params, path) -> str:
+        digest = hashlib.sha256(f"{codec} {sorted(params.items())!r}\n".encode())
+        with map_input(path) as data:
+            digest.update(data)
+        return digest.hexdigest()
+
+    def entry_path(self, key) -> str:
+        return join(self.folder, key + ENTRY_SUFFIX)
+
+    def restore(self, key, folder_path, input_file) -> bool:
+        # Writes the stored outputs next to the input, False on a miss
+        if key not in self.entries:
+            # stored by another process sharing the folder
+            if not os.path.exists(self.entry_path(key)):
+                self.misses += 1
+                return False
+            self.entries[key] = os.path.getsize(self.entry_path(key))
+            self.size += self.entries[key]
+        try:
+            with open(self.entry_path(key), "rb") as file:
+                data = memoryview(file.read())
+            for suffix, contents in unpack_entry(data).items():
+                with open(join(folder_path, f"{input_file}{suffix}"), "wb") as file:
+                    file.write(contents)
+            os.utime(self.entry_path(key))
+        except FileNotFoundError:
+            # evicted by another process sharing the folder
+            self.size -= self.entries.pop(key)
+            self.misses += 1
+            return False
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def store(self, key, folder_path, input_file, suffixes):
+        files = {}
+        for suffix in suffixes:
+            with open(join(folder_path, f"{input_file}{suffix}"), "rb") as file:
+                files[suffix] = file.read()
+        entry = pack_entry(files)
+        if len(entry) > self.max_bytes:
+            return
+        # written aside and renamed, a reader never sees half an entry
+        fd, temp_path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, "wb") as file:
+            file.write(entry)
+        os.replace(temp_path, self.entry_path(key))
+        self.size += len(entry) - self.entries.pop(key, 0)
+        self.entries[key] = len(entry)
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.entry_path(key))
+            except FileNotFoundError:
+                pass
+
+    def compress(self, codec, params, folder_path, input_file, suffixes, compress) -> bool:
+        # Restores the outputs of an earlier identical run, or runs
+        # compress() and stores the outputs it wrote; True on a hit
+        key = self.key(codec, params, join(folder_path, input_file))
+        if self.restore(key, folder_path, input_file):
+            return True
+        compress()
+        self.store(key, folder_path, input_file, suffixes)
+        return False
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.size}
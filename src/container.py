@@ -0,0 +1,71 @@
+import struct
+from collections import namedtuple
+
+import instrument
+
+# Block index container shared by the codecs that split their input into
+# independently coded blocks:
+#     4 bytes magic, one per codec
+#     4 bytes number of blocks
+#     block index, one entry per block:
+#         8 bytes offset of the block's payload, counted from the end of the index
+#         4 bytes length of the block's payload
+#         4 bytes uncompressed size of the block
+#     payload of every block, each block decodes on its own
+
+CONTAINER_HEADER = struct.Struct('>4sI')
+INDEX_ENTRY = struct.Struct('>QII')
+
+# offset is absolute in the file, start is where the block begins in the
+# uncompressed data
+BlockEntry = namedtuple('BlockEntry', 'offset length size start')
+
+
+def write_container(file, magic, blocks):
+    # blocks are (payload, uncompressed size) pairs
+    file.write(CONTAINER_HEADER.pack(magic, len(blocks)))
+    offset = 0
+    for payload, size in blocks:
+        file.write(INDEX_ENTRY.pack(offset, len(payload), size))
+        offset += len(payload)
+    for payload, size in blocks:
+        file.write(payload)
+
+
+def write_container_streaming(file, magic, sizes, payloads):
+    # For payloads that are produced one by one: they are written as they
+    # come and the index, left blank until then, last. sizes are the
+    # uncompressed block sizes, known up front; file must be seekable.
+    file.write(CONTAINER_HEADER.pack(magic, len(sizes)))
+    index_at = file.tell()
+    file.write(bytes(INDEX_ENTRY.size * len(sizes)))
+    index = bytearray()
+    offset = 0
+    for payload, size in zip(payloads, sizes):
+        file.write(payload)
+        index += INDEX_ENTRY.pack(offset, len(payload), size)
+        offset += len(payload)
+    end = file.tell()
+    file.seek(index_at)
+    file.write(index)
+    file.seek(end)
+
+
+def read_index(file, magic) -> list[BlockEntry]:
+    found, block_number = CONTAINER_HEADER.unpack(file.read(CONTAINER_HEADER.size))
+    if found != magic:
+        raise ValueError(f"Not a {magic.decode()} container: {file.name}")
+    data_start = CONTAINER_HEADER.size + block_number * INDEX_ENTRY.size
+    entries = []
+    start = 0
+    for offset, length, size in INDEX_ENTRY.iter_unpack(file.read(block_number * INDEX_ENTRY.size)):
+        entries.append(BlockEntry(data_start + offset, length, size, start))
+        start += size
+    return entries
+
+
+def read_block(path, offset, length) -> bytes:
+    # Workers read their own block, only the index crosses processes
+    with instrument.stage("io"), open(path, 'rb') as file:
+        file.seek(offset)
+        return file.read(length)
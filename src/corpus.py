@@ -0,0 +1,104 @@
+import json
+import os
+import random
+import sys
+
+# Deterministic synthetic corpus, so benchmarks can run offline and give the
+# same input on every machine. Every generator takes a size in bytes and a
+# seed and returns text, written out as ASCII files.
+
+WORDS = ("the", "of", "and", "compression", "window", "block", "huffman", "tree",
+         "match", "length", "distance", "literal", "symbol", "stream", "buffer",
+         "encode", "decode", "table", "code", "bit", "byte", "data", "file", "a")
+LEVELS = ("DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR")
+SERVICES = ("scheduler", "worker", "api", "cache", "storage")
+
+
+def synthetic_text(size, seed=0):
+    # Deterministic word salad with punctuation and line breaks, repetitive
+    # enough to give LZ77 real matches to find
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        if rng.random() < 0.08:
+            word += rng.choice((".\n", ", ", ";\n"))
+        else:
+            word += " "
+        words.append(word)
+        length += len(word)
+    return ''.join(words)[:size]
+
+
+def synthetic_log(size, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    timestamp = 1_700_000_000
+    while length < size:
+        timestamp += rng.randrange(0, 5)
+        line = (f"{timestamp} {rng.choice(LEVELS):<7} [{rng.choice(SERVICES)}] "
+                f"request={rng.randrange(1 << 20):06x} took {rng.randrange(1, 2000)}ms "
+                f"{rng.choice(WORDS)} {rng.choice(WORDS)}\n")
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)[:size]
+
+
+def synthetic_json(size, seed=0):
+    rng = random.Random(seed)
+    records = []
+    length = 0
+    while length < size:
+        record = json.dumps({
+            "id": rng.randrange(1 << 31),
+            "service": rng.choice(SERVICES),
+            "level": rng.choice(LEVELS),
+            "tags": rng.sample(WORDS, 3),
+            "value": round(rng.random() * 1000, 3),
+        }) + "\n"
+        records.append(record)
+        length += len(record)
+    return ''.join(records)[:size]
+
+
+def synthetic_random(size, seed=0):
+    # Printable but close to incompressible
+    rng = random.Random(seed)
+    return ''.join(chr(rng.randrange(33, 127)) for _ in range(size))
+
+
+def synthetic_repetitive(size, seed=0):
+    rng = random.Random(seed)
+    phrase = ' '.join(rng.choice(WORDS) for _ in range(12)) + "\n"
+    return (phrase * (size // len(phrase) + 1))[:size]
+
+
+GENERATORS = {
+    "text": synthetic_text,
+    "log": synthetic_log,
+    "json": synthetic_json,
+    "random": synthetic_random,
+    "repetitive": synthetic_repetitive,
+}
+
+
+def generate_corpus(folder, size=256 * 1024, kinds=None, seed=0) -> list[str]:
+    # Writes one {kind}.txt per generator into folder, returns the file names
+    os.makedirs(folder, exist_ok=True)
+    names = []
+    for kind in kinds or GENERATORS:
+        name = f"{kind}.txt"
+        with open(os.path.join(folder, name), "w") as file:
+            file.write(GENERATORS[kind](size, seed))
+        names.append(name)
+    return names
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python corpus.py FOLDER [SIZE_BYTES]")
+        sys.exit(1)
+    for name in generate_corpus(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 256 * 1024):
+        print(os.path.join(sys.argv[1], name))
@@ -2,47 +2,192 @@ import huffman
 import lz_77
 import os
 import glob
-from time import time
-from functools import wraps
+import zlib
+from functools import partial
+from time import perf_counter
+import instrument
+import rfc1951
+from container import read_block, read_index, write_container_streaming
+from dictionary import TOKENS
+from fileio import OutputSink, join, map_input
+from pipeline import run_pipeline
+from pool import choose_executor
+from stream import StreamCodec, iter_chunks
 from utils import detailed_report
 
-def timing(f):
-    @wraps(f)
-    def wrap(*args, **kw):
-        ts = time()
-        f(*args, **kw)
-        te = time()
-        execution_time = te - ts
-        return execution_time
-    return wrap
+# Pipelined format (pipeline=True): one block index container (container.py)
+# in {input_file}.enc.enc, every block the Huffman coding (an encode()
+# output) of one LZ77 block. The magic tells the LZ77 block format, as the
+# LZ77 container magics do.
+PIPELINE_MAGICS = {lz_77.COMPACT: b'DFLV', lz_77.TUPLES: b'DFLI', lz_77.PRIMED: b'DFLD'}
+PIPELINE_BLOCK_SIZE = 1 << 18
 
 
-class DeflateCompressor:
+class DeflateCompressor(StreamCodec):
 
-    def __init__(self, search_buffer_size, lookup_buffer_size, block_number):
-        self.huffman = huffman.HuffmanCompressor()
-        self.lz_77 = lz_77.LZ77Compressor(search_buffer_size, lookup_buffer_size, block_number)
-    
+    # rfc1951=True writes standard raw DEFLATE (readable by zlib with
+    # wbits=-15) to {input_file}.deflate instead of the LZ77 token + Huffman
+    # container. level (1-9, see lz_77.LEVELS) picks the LZ77 parser and
+    # match search effort for either format. With a cache
+    # (cache.CompressionCache) compress restores every output of an earlier
+    # run on the same bytes with the same settings instead of redoing both
+    # stages. A dictionary (dictionary.Dictionary) primes the LZ77 window
+    # and seeds the Huffman tables with its token counts; with rfc1951 it is
+    # a zlib preset dictionary and the output is wrapped as RFC 1950 (zlib
+    # format) so the header records which dictionary it needs.
+    # pipeline=True cuts the input into pipeline_block_size blocks and codes
+    # them through both stages on the shared pool, the LZ77 stage of one
+    # block running while the Huffman stage codes the one before, with
+    # nothing written in between (see PIPELINE_MAGICS); block_number is
+    # then unused. decompress reads either format.
+    # stored_blocks lets both stages store blocks that would not shrink
+    # instead of coding them, and the LZ77 stage skip their match search
+    # (see lz_77.LZ77Compressor, huffman.STORED_FLAG); in the rfc1951 format
+    # such blocks become DEFLATE stored blocks without being parsed.
+    def __init__(self, search_buffer_size, lookup_buffer_size, block_number, rfc1951=False, level=None, cache=None,
+                 dictionary=None, pipeline=False, pipeline_block_size=PIPELINE_BLOCK_SIZE, stored_blocks=True):
+        self.huffman = huffman.HuffmanCompressor(block_number=block_number, dictionary=dictionary,
+                                                 dictionary_table=TOKENS, stored_blocks=stored_blocks)
+        self.lz_77 = lz_77.LZ77Compressor(search_buffer_size, lookup_buffer_size, block_number, level=level,
+                                          dictionary=dictionary, stored_blocks=stored_blocks)
+        self.stored_blocks = stored_blocks
+        self.dictionary = dictionary
+        self.rfc1951 = rfc1951
+        self.pipeline = pipeline
+        self.pipeline_block_size = pipeline_block_size
+        self.cache = cache
+        self.level = level
+        self.search_buffer_size = search_buffer_size
+        self.lookup_buffer_size = lookup_buffer_size
 
+    def output_file(self, folder_path, input_file):
+        return join(folder_path, f"{input_file}.deflate") if self.rfc1951 else join(folder_path, f"{input_file}.enc.enc")
 
-    @timing
+    def compress_stream(self, source):
+        if self.rfc1951:
+            return self._deflate_stream(source)
+        # LZ77 frames feed straight into the Huffman stage, nothing touches disk
+        return self.huffman.compress_stream(self.lz_77.compress_stream(source))
+
+    def decompress_stream(self, source):
+        if self.rfc1951:
+            return self._inflate_stream(source)
+        return self.lz_77.decompress_stream(self.huffman.decompress_stream(source))
+
+    def _deflate_stream(self, source):
+        if self.dictionary is None:
+            encoder = rfc1951.DeflateEncoder(self.search_buffer_size, self.lookup_buffer_size, level=self.level,
+                                             stored_blocks=self.stored_blocks)
+            for chunk in iter_chunks(source):
+                if (data := encoder.compress(chunk)):
+                    yield data
+            yield encoder.flush()
+            return
+        zdict = self.dictionary.content
+        encoder = rfc1951.DeflateEncoder(self.search_buffer_size, self.lookup_buffer_size, level=self.level,
+                                         zdict=zdict, stored_blocks=self.stored_blocks)
+        yield rfc1951.zlib_header(zdict)
+        adler = zlib.adler32(b'')
+        for chunk in iter_chunks(source):
+            adler = zlib.adler32(chunk, adler)
+            if (data := encoder.compress(chunk)):
+                yield data
+        yield encoder.flush() + rfc1951.zlib_trailer(adler)
+
+    def _inflate_stream(self, source):
+        if self.dictionary is None:
+            decoder = zlib.decompressobj(-15)
+        else:
+            decoder = zlib.decompressobj(15, zdict=self.dictionary.content)
+        for chunk in iter_chunks(source):
+            if (data := decoder.decompress(chunk)):
+                yield data
+        if (data := decoder.flush()):
+            yield data
+
+    def output_suffixes(self) -> tuple:
+        # every file compress writes
+        if self.rfc1951:
+            return (".deflate",)
+        return (".enc.enc",) if self.pipeline else (".enc", ".enc.enc")
+
+    def cache_params(self) -> dict:
+        return {"rfc1951": self.rfc1951, "pipeline": self.pipeline, "pipeline_block_size": self.pipeline_block_size,
+                **self.lz_77.cache_params(),
+                **{f"huffman_{name}": value for name, value in self.huffman.cache_params().items()}}
+
+    @instrument.timed("deflate.compress")
     def compress(self, folder_path, input_file):
-        lz_77_comp = self.lz_77.compress(folder_path, input_file)
-        huffman = self.huffman.compress_bin(folder_path, f"{input_file}.enc")
-        comp_time = lz_77_comp + huffman
-        return comp_time
-    
-    @timing
+        # Returns the time taken in seconds
+        start_time = perf_counter()
+        if self.cache is None:
+            self._compress(folder_path, input_file)
+        else:
+            self.cache.compress("deflate", self.cache_params(), folder_path, input_file, self.output_suffixes(),
+                                lambda: self._compress(folder_path, input_file))
+        return perf_counter() - start_time
+
+    def _compress(self, folder_path, input_file):
+        if self.rfc1951:
+            self.compress_file(join(folder_path, input_file), self.output_file(folder_path, input_file))
+            return
+        if self.pipeline:
+            self.compress_pipelined(folder_path, input_file)
+            return
+        self.lz_77.compress(folder_path, input_file)
+        self.huffman.compress_bin(folder_path, f"{input_file}.enc")
+
+    @instrument.timed("deflate.decompress")
     def decompress(self, folder_path, input_file):
-        huffman_decomp = self.huffman.decompress(folder_path, f"{input_file}.enc")
-        lz_77_decomp = self.lz_77.decompress(folder_path, f"{input_file}")
-        # decomp_time = lz_77_decomp + huffman_decomp
-        # return decomp_time
+        # Returns the time taken in seconds
+        start_time = perf_counter()
+        if self.rfc1951:
+            self.decompress_file(self.output_file(folder_path, input_file), join(folder_path, f"{input_file}.2"))
+            return perf_counter() - start_time
+        with open(self.output_file(folder_path, input_file), 'rb') as file:
+            magic = file.read(4)
+        if magic in PIPELINE_MAGICS.values():
+            self.decompress_pipelined(folder_path, input_file)
+            return perf_counter() - start_time
+        self.huffman.decompress(folder_path, f"{input_file}.enc")
+        # the LZ77 stage reads the tokens the Huffman stage just restored
+        self.lz_77.decompress(folder_path, f"{input_file}", source_path=join(folder_path, f"{input_file}.enc.dec"))
+        return perf_counter() - start_time
+
+    def compress_pipelined(self, folder_path, input_file):
+        path = join(folder_path, input_file)
+        size = os.path.getsize(path)
+        bounds = [(start, min(start + self.pipeline_block_size, size))
+                  for start in range(0, size, self.pipeline_block_size)]
+        token_format = lz_77.PRIMED if self.dictionary else self.lz_77.token_format
+        executor = choose_executor(size, self.lz_77.max_workers)
+        with map_input(path) as data, open(self.output_file(folder_path, input_file), 'wb') as file:
+            # blocks are cut from the mapping only as the pipeline takes them
+            blocks = (bytes(data[start:end]) for start, end in bounds)
+            payloads = run_pipeline(executor, [self.lz_77.encode_block, self.huffman.encode], blocks)
+            write_container_streaming(file, PIPELINE_MAGICS[token_format], [end - start for start, end in bounds],
+                                      payloads)
+
+    def decompress_pipelined(self, folder_path, input_file):
+        # The mirror image: Huffman decoding of block k+1 runs while the
+        # LZ77 stage decodes block k
+        path = self.output_file(folder_path, input_file)
+        with open(path, 'rb') as file:
+            magic = file.read(4)
+            file.seek(0)
+            entries = read_index(file, magic)
+        token_format = {format_magic: name for name, format_magic in PIPELINE_MAGICS.items()}[magic]
+        total = sum(entry.size for entry in entries)
+        executor = choose_executor(total, self.lz_77.max_workers)
+        payloads = (read_block(path, entry.offset, entry.length) for entry in entries)
+        stages = [self.huffman.decode, partial(self.lz_77.decode_block, token_format=token_format)]
+        with OutputSink(join(folder_path, f"{input_file}.2"), total) as sink:
+            for block in run_pipeline(executor, stages, payloads):
+                sink.write(block)
 
     def test(self, folder_path, input_file):
         comp_time = self.compress(folder_path, input_file)
-        decomp_time = 0
         decomp_time = self.decompress(folder_path, input_file)
-        detailed_report("Deflate", f"{folder_path}{input_file}", comp_time, decomp_time, output_file=f"{folder_path}{input_file}.enc.enc")    
+        detailed_report("Deflate", join(folder_path, input_file), comp_time, decomp_time, output_file=self.output_file(folder_path, input_file))    
         # for hgx in glob.glob(f"{folder_path}{input_file}.*"):
         #     os.remove(hgx)
\ No newline at end of file
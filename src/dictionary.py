@@ -0,0 +1,159 @@
+import heapq as hq
+import os
+import struct
+import sys
+import zlib
+from collections import Counter
+
+from histogram import byte_histogram
+
+# Preset dictionaries for corpora of small, similar files. A dictionary is
+# content that primes the LZ77 window, so the first bytes of a file already
+# find matches, plus byte statistics that seed Huffman tables, so a file
+# needs no table of its own: one of the raw bytes (BYTES) and one of the
+# compact LZ77 tokens the primed window gives (TOKENS). Outputs record the
+# dictionary's id, and decoding with another dictionary is an error.
+#
+# Dictionary file:
+#     4 bytes magic b'CTDI'
+#     4 bytes content length, the content
+#     256 x 2 bytes byte counts, 256 x 2 bytes token counts
+# The id is the CRC-32 of everything after the magic.
+
+MAGIC = b'CTDI'
+LENGTH = struct.Struct('>I')
+COUNTS = struct.Struct('>256H')
+DICTIONARY_ID = struct.Struct('>I')
+BYTES = 0
+TOKENS = 1
+
+DICTIONARY_SIZE = 16 * 1024
+# Training looks at substrings of KMER bytes, and picks SEGMENT byte pieces
+# of the samples that hold the most substrings found in other samples too
+KMER = 8
+SEGMENT = 64
+# LZ77 settings the token counts are collected with, the main.py defaults
+TOKEN_WINDOW = 8192
+TOKEN_LOOKAHEAD = 20
+
+
+class Dictionary:
+    def __init__(self, content, byte_counts, token_counts):
+        self.content = bytes(content)
+        self.counts = (list(byte_counts), list(token_counts))
+        self.id = zlib.crc32(self.serialize()[len(MAGIC):])
+        self._lengths = {}
+
+    def serialize(self) -> bytes:
+        return (MAGIC + LENGTH.pack(len(self.content)) + self.content
+                + COUNTS.pack(*self.counts[BYTES]) + COUNTS.pack(*self.counts[TOKENS]))
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.serialize())
+
+    def code_lengths(self, table, max_length) -> list[int]:
+        # Code lengths seeded from one of the count tables. Every byte value
+        # gets a code, so the table fits any input.
+        key = (table, max_length)
+        if key not in self._lengths:
+            # imported here, huffman imports this module
+            from huffman import code_lengths
+            self._lengths[key] = code_lengths([count + 1 for count in self.counts[table]], max_length)
+        return self._lengths[key]
+
+    def check(self, dictionary_id):
+        if dictionary_id != self.id:
+            raise ValueError(f"Data needs dictionary {dictionary_id:08x}, this one is {self.id:08x}")
+
+
+def load_dictionary(path) -> Dictionary:
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"Not a dictionary file: {path}")
+    (length,) = LENGTH.unpack_from(data, len(MAGIC))
+    start = len(MAGIC) + LENGTH.size
+    content = data[start:start + length]
+    byte_counts = COUNTS.unpack_from(data, start + length)
+    token_counts = COUNTS.unpack_from(data, start + length + COUNTS.size)
+    return Dictionary(content, byte_counts, token_counts)
+
+
+def scale_counts(counts) -> list[int]:
+    # Fits counts into 16 bits keeping their proportions, a count that is
+    # not 0 stays at least 1
+    top = max(counts, default=0)
+    if top <= 0xFFFF:
+        return list(counts)
+    return [max(1, count * 0xFFFF // top) if count else 0 for count in counts]
+
+
+def select_segments(samples, size) -> list[bytes]:
+    # Greedy cover (as zstd's COVER trainer): a segment scores the number of
+    # samples each of its distinct substrings occurs in, for substrings
+    # found in at least two samples; once a segment is picked its
+    # substrings score nothing, so the next picks cover something new
+    frequency = Counter()
+    for sample in samples:
+        frequency.update({sample[i:i + KMER] for i in range(len(sample) - KMER + 1)})
+
+    def score(segment):
+        return sum(frequency[kmer] for kmer in {segment[i:i + KMER] for i in range(len(segment) - KMER + 1)}
+                   if frequency[kmer] > 1)
+
+    heap = []
+    for sample in samples:
+        for start in range(0, max(len(sample) - SEGMENT, 0) + 1, SEGMENT // 2):
+            segment = sample[start:start + SEGMENT]
+            heap.append((-score(segment), len(heap), segment))
+    hq.heapify(heap)
+    chosen = []
+    total = 0
+    while heap and total < size:
+        old_score, index, segment = hq.heappop(heap)
+        current = score(segment)
+        if current == 0:
+            continue
+        # scores only drop, so a segment still ahead of the best stored
+        # score is the best one
+        if heap and current < -heap[0][0]:
+            hq.heappush(heap, (-current, index, segment))
+            continue
+        chosen.append(segment)
+        total += len(segment)
+        for i in range(len(segment) - KMER + 1):
+            frequency[segment[i:i + KMER]] = 0
+    return chosen
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE) -> Dictionary:
+    # samples is a list of bytes, typically whole small files
+    from lz_77 import LZ77Compressor
+    chosen = select_segments(samples, size)
+    # the best segment goes last, closest to the data, with the shortest
+    # distances
+    content = b''.join(reversed(chosen))[-size:]
+    byte_counts = byte_histogram(b''.join(samples))
+    lz_77 = LZ77Compressor(TOKEN_WINDOW, TOKEN_LOOKAHEAD)
+    token_counts = [0] * 256
+    for sample in samples:
+        for byte, count in enumerate(byte_histogram(lz_77.compress_window(content + sample, len(content)))):
+            token_counts[byte] += count
+    return Dictionary(content, scale_counts(byte_counts), scale_counts(token_counts))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: python dictionary.py SAMPLE_FOLDER OUTPUT [SIZE_BYTES]")
+        sys.exit(1)
+    folder = sys.argv[1]
+    samples = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and not name.startswith("."):
+            with open(path, "rb") as file:
+                samples.append(file.read())
+    dictionary = train_dictionary(samples, int(sys.argv[3]) if len(sys.argv) > 3 else DICTIONARY_SIZE)
+    dictionary.save(sys.argv[2])
+    print(f"{sys.argv[2]}: id {dictionary.id:08x}, {len(dictionary.content)} bytes from {len(samples)} samples")
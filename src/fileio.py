@@ -0,0 +1,72 @@
+import mmap
+import os
+from contextlib import contextmanager
+
+import instrument
+
+# File access for the codecs. Inputs are memory mapped, so a codec can scan
+# one as often as it needs (and every worker can map the same file) without
+# reading it into Python bytes; the page cache holds the only copy. Outputs
+# go through OutputSink, which writes into a preallocated mapping when the
+# output size is known up front and into a buffered file otherwise.
+
+
+def join(folder_path, name) -> str:
+    # folder_path may or may not end with a separator
+    return os.path.join(folder_path, name)
+
+
+@contextmanager
+def map_input(path):
+    # Read only memoryview of the whole file. Views taken from it must not
+    # outlive the block; empty files cannot be mapped and give b''.
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield memoryview(b'')
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+class OutputSink:
+    # With a size (exact or an upper bound) the file is extended once and
+    # written through a mapping, growing it if the bound was short, and
+    # close() trims it to what was written. Without one writes go to a
+    # buffered file.
+    def __init__(self, path, size=None):
+        self.file = open(path, 'w+b' if size else 'wb')
+        self.mapping = None
+        self.position = 0
+        if size:
+            self.file.truncate(size)
+            self.mapping = mmap.mmap(self.file.fileno(), size)
+
+    def write(self, data):
+        with instrument.stage("io"):
+            if self.mapping is None:
+                self.file.write(data)
+                self.position += len(data)
+                return
+            end = self.position + len(data)
+            if end > len(self.mapping):
+                self.mapping.resize(max(end, 2 * len(self.mapping)))
+            self.mapping[self.position:end] = data
+            self.position = end
+
+    def close(self):
+        with instrument.stage("io"):
+            if self.mapping is not None:
+                self.mapping.close()
+                self.mapping = None
+                self.file.truncate(self.position)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,91 @@
+import math
+from collections import Counter
+
+import instrument
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Byte histogram stage shared by the Huffman and Deflate coders. With NumPy
+# every chunk is counted by np.bincount over a frombuffer view, so the input
+# never becomes Python objects and memory stays bounded by the chunk size;
+# without it Counter does the same chunk by chunk.
+
+# bincount widens every chunk to int64 first, chunks that stay in cache are
+# about twice as fast as 4 MB ones
+HISTOGRAM_CHUNK = 1 << 16
+
+
+def byte_histogram(data, chunk_size=HISTOGRAM_CHUNK) -> list[int]:
+    # Counts of the 256 byte values of any bytes-like object
+    view = memoryview(data).cast('B')
+    with instrument.stage("histogram"):
+        if np is None:
+            counts = Counter()
+            for start in range(0, len(view), chunk_size):
+                counts.update(view[start:start + chunk_size])
+            return [counts[byte] for byte in range(256)]
+        total = np.zeros(256, dtype=np.int64)
+        for start in range(0, len(view), chunk_size):
+            total += np.bincount(np.frombuffer(view[start:start + chunk_size], dtype=np.uint8), minlength=256)
+        return total.tolist()
+
+
+def entropy_bits(counts) -> float:
+    # Order 0 entropy in bits of data with these counts, what a Huffman only
+    # coding of it costs at best
+    total = sum(counts)
+    return sum(count * math.log2(total / count) for count in counts if count)
+
+
+# Incompressible data check run on a block before a codec parses it. SAMPLES
+# slices of SAMPLE_SIZE bytes spread over the block are looked at, so it
+# costs the same for any block size. A block is incompressible when the
+# samples are close to 8 bits a byte of order 0 entropy (a Huffman stage
+# gains nothing) and hardly any of their MATCH_LENGTH byte strings occur
+# twice (an LZ77 stage finds nothing). Already compressed or encrypted data
+# is both; text and tables are far from either limit.
+SAMPLES = 8
+SAMPLE_SIZE = 4096
+# lz_77.MIN_MATCH, the shortest match the parsers emit
+MATCH_LENGTH = 3
+INCOMPRESSIBLE_ENTROPY = 7.9
+INCOMPRESSIBLE_MATCH_RATE = 0.02
+
+
+def sample(data, samples=SAMPLES, size=SAMPLE_SIZE) -> bytes:
+    # The whole of a block of up to samples * size bytes, evenly spaced
+    # slices of a bigger one
+    view = memoryview(data).cast('B')
+    if len(view) <= samples * size:
+        return bytes(view)
+    step = (len(view) - size) // (samples - 1)
+    return b''.join(view[i * step:i * step + size] for i in range(samples))
+
+
+def match_rate(data, length=MATCH_LENGTH) -> float:
+    # Share of the positions of data whose next length bytes occur at an
+    # earlier position too
+    positions = len(data) - length + 1
+    if positions <= 0:
+        return 0.0
+    if np is None:
+        distinct = len({data[i:i + length] for i in range(positions)})
+    else:
+        values = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+        keys = values[:positions].copy()
+        for i in range(1, length):
+            keys = (keys << 8) | values[i:i + positions]
+        distinct = len(np.unique(keys))
+    return 1 - distinct / positions
+
+
+def incompressible(data) -> bool:
+    with instrument.stage("histogram"):
+        sampled = sample(data)
+        if not sampled:
+            return False
+        bits_per_byte = entropy_bits(byte_histogram(sampled)) / len(sampled)
+        return bits_per_byte >= INCOMPRESSIBLE_ENTROPY and match_rate(sampled) <= INCOMPRESSIBLE_MATCH_RATE
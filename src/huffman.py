@@ -3,30 +3,27 @@ import pickle
 import os
 import time
 import struct
-from collections import Counter
-from functools import wraps
+from operator import itemgetter
+from bitio import BitReader, BitWriter, pair_table
+from container import read_block, read_index, write_container
+from dictionary import BYTES
+from fileio import OutputSink, join, map_input
+from histogram import byte_histogram
+import instrument
+from pool import attach_shared, choose_executor, create_shared, release_shared
+from stream import StreamCodec, frame, iter_blocks, iter_frames
 from utils import detailed_report
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-import cProfile
-import pstats
-
-def timing_and_profiling(f):
-    @wraps(f)
-    def wrap(*args, **kw):
-        profiler = cProfile.Profile()
-        profiler.enable()
-        ts = time.time()
-        result = f(*args, **kw)
-        te = time.time()
-        profiler.disable()
-        execution_time = te - ts
-        stats = pstats.Stats(profiler)
-        stats.strip_dirs()
-        stats.sort_stats("cumulative")
-        stats.print_stats()
-        return execution_time
-    return wrap
+CHUNK_SIZE = 1 << 16
+# Input bytes per independently coded block in the streaming format
+STREAM_BLOCK_SIZE = 1 << 20
+# Building the two byte table only pays off on inputs at least this long
+PAIR_TABLE_MIN = 1 << 14
 
 
 class huffman_node:
@@ -68,7 +65,558 @@ def print_huffman_tree(node, indent="", is_left=True):
         print_huffman_tree(node.left, indent, True)
         print_huffman_tree(node.right, indent, False)
 
-class HuffmanCompressor:
+# Width of the primary decode table, codes longer than this go through a
+# second level subtable indexed by the bits after the first DECODE_TABLE_BITS
+DECODE_TABLE_BITS = 12
+# Small payloads get a narrower table, building all 4096 entries would take
+# longer than decoding them; the width grows with the payload from this one
+MIN_DECODE_TABLE_BITS = 8
+NUMPY_MAX_CODE_LENGTH = 20
+NUMPY_CHUNK_BITS = 1 << 22
+NUMPY_STEP_SHIFT = 6
+
+
+def decode_table_bits(nbits):
+    # Primary table width for a payload of nbits, about one entry per 64 bits
+    return min(DECODE_TABLE_BITS, max(MIN_DECODE_TABLE_BITS, nbits.bit_length() - 6))
+
+
+class DecodeTable:
+    # Table driven decoder for any prefix code given as {symbol: (code, length)}
+    # with codes read MSB first. Every primary entry is (output, bits) and holds
+    # as many whole symbols as fit in the peeked window; entries for codes
+    # longer than the window are (subtable, -subtable_bits) instead.
+    def __init__(self, codes, table_bits=DECODE_TABLE_BITS):
+        self.codes = codes
+        self.bits = table_bits
+        self.max_length = max(length for code, length in codes.values())
+        single = [None] * (1 << table_bits)
+        long_codes = {}
+        for symbol, (code, length) in codes.items():
+            if length <= table_bits:
+                shift = table_bits - length
+                entry = (bytes([symbol]), length)
+                for w in range(code << shift, (code + 1) << shift):
+                    single[w] = entry
+            else:
+                long_codes.setdefault(code >> (length - table_bits), []).append((symbol, code, length))
+
+        for prefix, group in long_codes.items():
+            sub_bits = max(length for symbol, code, length in group) - table_bits
+            subtable = [None] * (1 << sub_bits)
+            for symbol, code, length in group:
+                rest = length - table_bits
+                shift = sub_bits - rest
+                low = code & ((1 << rest) - 1)
+                entry = (bytes([symbol]), rest)
+                for w in range(low << shift, (low + 1) << shift):
+                    subtable[w] = entry
+            single[prefix] = (subtable, -sub_bits)
+        self.single = single
+
+        # Pack further symbols into each entry while their codes fit in the window
+        mask = (1 << table_bits) - 1
+        multi = list(single)
+        for w, entry in enumerate(single):
+            if entry is None or entry[1] < 0:
+                continue
+            output, used = entry
+            while True:
+                following = single[(w << used) & mask]
+                if following is None or not 0 < following[1] <= table_bits - used:
+                    break
+                output += following[0]
+                used += following[1]
+            multi[w] = (output, used)
+        self.multi = multi
+
+    def decode(self, data, nbits, start=0):
+        # data is MSB first and holds nbits of codes followed by padding,
+        # decoding begins start bits in
+        data = bytes(data[:(nbits + 7) // 8]) + bytes(8)
+        out = bytearray()
+        bits = self.bits
+        mask = (1 << bits) - 1
+        multi = self.multi
+        need = max(bits, self.max_length)
+        acc = 0
+        acc_bits = 0
+        pos = start >> 3
+        if start & 7:
+            acc = data[pos]
+            acc_bits = 8 - (start & 7)
+            pos += 1
+        # Fast path, only whole bytes of real data are loaded so any code that
+        # fits in the accumulator is a real one
+        fast_end = nbits // 8 - 7
+        while pos <= fast_end:
+            acc = ((acc & ((1 << acc_bits) - 1)) << 56) | int.from_bytes(data[pos:pos + 7], 'big')
+            pos += 7
+            acc_bits += 56
+            while acc_bits >= need:
+                output, used = multi[(acc >> (acc_bits - bits)) & mask]
+                if used > 0:
+                    out += output
+                    acc_bits -= used
+                else:
+                    acc_bits -= bits
+                    output, used = output[(acc >> (acc_bits + used)) & ((1 << -used) - 1)]
+                    out += output
+                    acc_bits -= used
+        # Tail, one symbol at a time and stop at the first code cut by padding
+        single = self.single
+        reader = BitReader(data, pos * 8 - acc_bits)
+        while reader.bit_position() < nbits:
+            entry = single[reader.peek(bits)]
+            if entry is None:
+                break
+            output, used = entry
+            length = used
+            if used < 0:
+                output, used = output[reader.peek(bits - used) & ((1 << -used) - 1)]
+                length = bits + used
+            if reader.bit_position() + length > nbits:
+                break
+            out += output
+            reader.skip(length)
+        return out
+
+    def decode_streams(self, streams, counts):
+        # decode over several streams in one loop, counts[i] symbols from
+        # streams[i]. Every round loads the next 7 bytes of each stream into
+        # its own accumulator and drains them in turn, so all the cursors
+        # move together and share one byte position. Once the shortest
+        # stream is that close to its end, each one finishes through decode
+        # from the bit it got to.
+        datas = [bytes(stream) for stream in streams]
+        outs = [bytearray() for _ in streams]
+        accs = [0] * len(streams)
+        acc_bits_list = [0] * len(streams)
+        bits = self.bits
+        mask = (1 << bits) - 1
+        multi = self.multi
+        need = max(bits, self.max_length)
+        pos = 0
+        fast_end = min(len(data) for data in datas) - 7
+        lanes = list(zip(range(len(streams)), datas, outs))
+        while pos <= fast_end:
+            for k, data, out in lanes:
+                acc_bits = acc_bits_list[k]
+                acc = ((accs[k] & ((1 << acc_bits) - 1)) << 56) | int.from_bytes(data[pos:pos + 7], 'big')
+                acc_bits += 56
+                while acc_bits >= need:
+                    output, used = multi[(acc >> (acc_bits - bits)) & mask]
+                    if used > 0:
+                        out += output
+                        acc_bits -= used
+                    else:
+                        acc_bits -= bits
+                        output, used = output[(acc >> (acc_bits + used)) & ((1 << -used) - 1)]
+                        out += output
+                        acc_bits -= used
+                accs[k] = acc
+                acc_bits_list[k] = acc_bits
+            pos += 7
+        result = bytearray()
+        # Padding can decode as a few extra symbols, the counts cut them off
+        for data, out, acc_bits, count in zip(datas, outs, acc_bits_list, counts):
+            if len(out) < count:
+                out += self.decode(data, len(data) * 8, max(pos * 8 - acc_bits, 0))
+            result += out[:count]
+        return result
+
+    def numpy_tables(self):
+        # Symbol and code length for every max_length bit window
+        width = self.max_length
+        symbols = np.zeros(1 << width, dtype=np.uint8)
+        lengths = np.zeros(1 << width, dtype=np.int32)
+        for symbol, (code, length) in self.codes.items():
+            shift = width - length
+            symbols[code << shift:(code + 1) << shift] = symbol
+            lengths[code << shift:(code + 1) << shift] = length
+        return symbols, lengths
+
+    def decode_numpy(self, data, nbits):
+        # Batch path: look up the code starting at every bit offset of a chunk
+        # at once, then follow the chain of code starts by pointer jumping so
+        # Python only steps once every 2**NUMPY_STEP_SHIFT symbols
+        width = self.max_length
+        symbols, lengths = self.numpy_tables()
+        raw = np.frombuffer(bytes(data[:(nbits + 7) // 8]) + bytes(width // 8 + 2), dtype=np.uint8)
+        pieces = []
+        start = 0
+        while start < nbits:
+            count = min(NUMPY_CHUNK_BITS, nbits - start)
+            bit_offset = start % 8
+            chunk_bits = np.unpackbits(raw[start // 8:(start + count + width) // 8 + 1])
+            windows = np.zeros(count, dtype=np.int32)
+            for k in range(width):
+                windows <<= 1
+                windows |= chunk_bits[bit_offset + k:bit_offset + k + count]
+            step = lengths[windows]
+            ends = np.arange(count, dtype=np.int32) + step
+            # a code cut off by the padding ends the chain
+            valid = (step > 0) & (ends <= nbits - start)
+            nxt = np.append(np.where(valid, np.minimum(ends, count), count), count).astype(np.int32)
+            jump = nxt
+            for _ in range(NUMPY_STEP_SHIFT):
+                jump = jump[jump]
+            anchors = []
+            p = 0
+            while p < count:
+                anchors.append(p)
+                p = int(jump[p])
+            row = np.array(anchors, dtype=np.int32)
+            rows = []
+            for _ in range(1 << NUMPY_STEP_SHIFT):
+                rows.append(row)
+                row = nxt[row]
+            positions = np.stack(rows, axis=1).ravel()
+            positions = positions[positions < count]
+            positions = positions[valid[positions]]
+            if len(positions) == 0:
+                break
+            pieces.append(symbols[windows[positions]].tobytes())
+            last = int(positions[-1])
+            start += last + int(step[last])
+        return bytearray(b''.join(pieces))
+
+    def decode_numpy_streams(self, streams, counts):
+        # decode_numpy over several streams in lockstep: every round takes the
+        # next bits of each stream into one array, so the window, table and
+        # pointer jumping passes run once for all of them and the anchor walk
+        # moves every stream's cursor with one lookup. counts[i] symbols are
+        # decoded from streams[i].
+        width = self.max_length
+        symbols, lengths = self.numpy_tables()
+        bits = [np.unpackbits(np.frombuffer(bytes(stream) + bytes(width // 8 + 2), dtype=np.uint8))
+                for stream in streams]
+        nbits = [len(stream) * 8 for stream in streams]
+        done = [0] * len(streams)
+        decoded = [0] * len(streams)
+        pieces = [[] for _ in streams]
+        share = max(NUMPY_CHUNK_BITS // len(streams), 1)
+        while True:
+            active = [i for i in range(len(streams)) if decoded[i] < counts[i] and done[i] < nbits[i]]
+            if not active:
+                break
+            sizes = [min(share, nbits[i] - done[i]) for i in active]
+            starts = np.cumsum([0] + sizes[:-1]).astype(np.int32)
+            total = sum(sizes)
+            windows = np.zeros(total, dtype=np.int32)
+            for k in range(width):
+                windows <<= 1
+                windows |= np.concatenate([bits[i][done[i] + k:done[i] + k + size] for i, size in zip(active, sizes)])
+            step = lengths[windows]
+            ends = np.arange(total, dtype=np.int32) + step
+            valid = np.empty(total, dtype=bool)
+            nxt = np.empty(total + 1, dtype=np.int32)
+            nxt[total] = total
+            for i, start, size in zip(active, starts, sizes):
+                # a code may run past its segment into the rest of its stream
+                # but not past the stream, the chain ends at the segment
+                # either way
+                segment = slice(start, start + size)
+                valid[segment] = (step[segment] > 0) & (ends[segment] <= start + nbits[i] - done[i])
+                nxt[segment] = np.where(valid[segment] & (ends[segment] < start + size), ends[segment], total)
+            jump = nxt
+            for _ in range(NUMPY_STEP_SHIFT):
+                jump = jump[jump]
+            anchors = []
+            cursors = starts
+            while (cursors < total).any():
+                anchors.append(cursors)
+                cursors = jump[cursors]
+            row = np.stack(anchors)
+            rows = []
+            for _ in range(1 << NUMPY_STEP_SHIFT):
+                rows.append(row)
+                row = nxt[row]
+            # (segment, anchor, step) order is each segment's chain in order
+            chains = np.stack(rows, axis=2).transpose(1, 0, 2).reshape(len(active), -1)
+            for i, start, chain in zip(active, starts, chains):
+                positions = chain[chain < total]
+                positions = positions[valid[positions]][:counts[i] - decoded[i]]
+                if len(positions) == 0:
+                    # only padding left
+                    done[i] = nbits[i]
+                    continue
+                pieces[i].append(symbols[windows[positions]].tobytes())
+                decoded[i] += len(positions)
+                last = int(positions[-1])
+                done[i] += last - int(start) + int(step[last])
+        return bytearray(b''.join(b''.join(piece) for piece in pieces))
+
+
+def code_lengths(frequencies, max_length=None):
+    # Huffman code length for every symbol of frequencies (a list indexed by
+    # symbol), 0 for symbols that never occur. With max_length set, a tree
+    # that comes out deeper is replaced by the best code whose lengths all
+    # fit, see package_merge.
+    lengths = [0] * len(frequencies)
+    heap = [(freq, symbol) for symbol, freq in enumerate(frequencies) if freq]
+    if len(heap) == 1:
+        lengths[heap[0][1]] = 1
+    if len(heap) <= 1:
+        return lengths
+    used = [symbol for freq, symbol in heap]
+    hq.heapify(heap)
+    parent = {}
+    next_node = len(frequencies)
+    while len(heap) > 1:
+        left_freq, left = hq.heappop(heap)
+        right_freq, right = hq.heappop(heap)
+        parent[left] = parent[right] = next_node
+        hq.heappush(heap, (left_freq + right_freq, next_node))
+        next_node += 1
+    for symbol in used:
+        node = symbol
+        while node in parent:
+            node = parent[node]
+            lengths[symbol] += 1
+
+    if max_length is None or max(lengths) <= max_length:
+        return lengths
+    return package_merge(frequencies, max_length)
+
+
+def package_merge(frequencies, max_length):
+    # Optimal code lengths of at most max_length bits (Larmore and
+    # Hirschberg). Every level pairs up the cheapest items of the level
+    # below into packages and merges them with the leaves again; the 2n - 2
+    # cheapest items after max_length levels are the chosen coins, and a
+    # symbol's code length is how many of them it appears in.
+    leaves = sorted((freq, symbol) for symbol, freq in enumerate(frequencies) if freq)
+    n = len(leaves)
+    if n > 1 << max_length:
+        raise ValueError(f"{n} symbols do not fit in codes of at most {max_length} bits")
+    lengths = [0] * len(frequencies)
+    if n == 1:
+        lengths[leaves[0][1]] = 1
+    if n <= 1:
+        return lengths
+    # a leaf is (weight, symbol), a package (weight, None, first, second)
+    items = leaves
+    for _ in range(max_length - 1):
+        packages = [(items[i][0] + items[i + 1][0], None, items[i], items[i + 1])
+                    for i in range(0, len(items) - 1, 2)]
+        # a stable sort of the two sorted runs is a merge done in C, leaves
+        # stay ahead of packages of the same weight
+        items = sorted(leaves + packages, key=itemgetter(0))
+    stack = items[:2 * n - 2]
+    while stack:
+        item = stack.pop()
+        if item[1] is None:
+            stack.append(item[2])
+            stack.append(item[3])
+        else:
+            lengths[item[1]] += 1
+    return lengths
+
+
+def canonical_codes(lengths):
+    # Canonical code for every symbol from its code length (RFC 1951 3.2.2):
+    # shorter codes first, symbols of equal length in increasing order
+    max_length = max(lengths, default=0)
+    bl_count = [0] * (max_length + 1)
+    for length in lengths:
+        if length:
+            bl_count[length] += 1
+    next_code = [0] * (max_length + 2)
+    code = 0
+    for bits in range(1, max_length + 1):
+        code = (code + bl_count[bits - 1]) << 1
+        next_code[bits] = code
+    codes = [0] * len(lengths)
+    for symbol, length in enumerate(lengths):
+        if length:
+            codes[symbol] = next_code[length]
+            next_code[length] += 1
+    return codes
+
+
+# The pad byte of the canonical format has this bit set. Without it the
+# header is the old (symbol, frequency) table and the tree is rebuilt from it.
+CANONICAL_FLAG = 0x80
+# Code length header: one byte per entry, a byte below RUN_FLAG is the next
+# code length, one with RUN_FLAG set repeats the previous length
+# (byte & 0x7F) + 1 more times. 256 lengths, one per byte value.
+RUN_FLAG = 0x80
+ALPHABET_SIZE = 256
+# Default limit on code lengths, as in DEFLATE
+MAX_CODE_LENGTH = 15
+# Set next to CANONICAL_FLAG on blocks in the four stream layout: the input
+# is cut in STREAMS equal segments (the last one takes the rest) coded into
+# separate bitstreams that share one table, like Zstandard's Huff0. After the
+# code lengths a jump table gives the symbol count and the byte length of
+# every stream but the last, then the streams follow back to back. Symbol
+# counts tell every stream where to stop, so the pad bits are unused.
+STREAMS_FLAG = 0x40
+STREAMS = 4
+JUMP_TABLE = struct.Struct('>I' + 'I' * (STREAMS - 1))
+
+
+def pack_code_lengths(lengths) -> bytearray:
+    out = bytearray()
+    i = 0
+    n = len(lengths)
+    while i < n:
+        length = lengths[i]
+        out.append(length)
+        i += 1
+        run = 0
+        while i + run < n and run < 128 and lengths[i + run] == length:
+            run += 1
+        if run:
+            out.append(RUN_FLAG | (run - 1))
+            i += run
+    return out
+
+
+def unpack_code_lengths(data, index=0, count=ALPHABET_SIZE) -> tuple[list[int], int]:
+    # Returns the lengths and the index just past the header
+    lengths = []
+    while len(lengths) < count:
+        byte = data[index]
+        index += 1
+        if byte & RUN_FLAG:
+            lengths.extend([lengths[-1]] * ((byte & 0x7F) + 1))
+        else:
+            lengths.append(byte)
+    return lengths, index
+
+
+# Blocks coded with a table seeded from a preset dictionary (dictionary.py)
+# carry DICTIONARY_FLAG instead of CANONICAL_FLAG, and instead of the code
+# lengths one byte for the dictionary's count table (BYTES or TOKENS), one
+# for the code length limit (0 for none) and the 4 byte dictionary id; the
+# lengths are rebuilt from the dictionary's counts, so small inputs pay 6
+# bytes for their table instead of a header of lengths.
+DICTIONARY_FLAG = 0x10
+DICTIONARY_HEADER = struct.Struct('>BBI')
+
+# A block whose code would not come out shorter than the block is stored:
+# STORED (STORED_FLAG next to CANONICAL_FLAG, ADAPTIVE_FLAG in adaptive
+# frames) as the pad byte, then the bytes as they are, which decoding
+# copies back out. STORED_FLAG alone would be the pad byte 8 of the
+# frequency table format, written when the last byte is full. The coded
+# size is known from the byte counts before anything is packed, so nothing
+# is spent on bit packing data that does not shrink, and no block grows by
+# more than its pad byte.
+STORED_FLAG = 0x08
+STORED = CANONICAL_FLAG | STORED_FLAG
+
+
+def packed_size(counts, code_table) -> int:
+    # Bytes the codes of a block with these byte counts take
+    return (sum(count * code_table[byte][1] for byte, count in enumerate(counts) if count) + 7) // 8
+
+
+def stored_block(data, flag=CANONICAL_FLAG) -> bytearray:
+    enc_data = bytearray([STORED_FLAG | flag])
+    enc_data += data
+    return enc_data
+
+
+# compress_bin with block_number > 1 writes a block index container
+# (container.py) with this magic, every block being one encode() output
+CONTAINER_MAGIC = b'HUFI'
+
+# Adaptive mode: one pass and no stored table. The input is cut into frames
+# of ADAPTIVE_FIRST_FRAME bytes doubling up to ADAPTIVE_INTERVAL, each coded
+# with the code built from the byte counts of all frames before it; every
+# count starts at 1, so the first frame gets a flat 8 bit code and no byte
+# ever lacks a code. Both ends need the same max_code_length. A frame
+# boundary is the rebuild marker: both ends add the frame to the counts and
+# rebuild there. Counts are halved once their total passes
+# ADAPTIVE_HALVE_AT, so the code follows input whose statistics drift. The
+# pad byte of a frame carries ADAPTIVE_FLAG.
+ADAPTIVE_FLAG = 0x20
+ADAPTIVE_FIRST_FRAME = 1 << 12
+ADAPTIVE_INTERVAL = 1 << 16
+ADAPTIVE_HALVE_AT = 1 << 20
+# compress_bin in adaptive mode writes this magic followed by stream frames
+ADAPTIVE_MAGIC = b'HUFA'
+
+
+class AdaptiveModel:
+    # The code both ends of the adaptive mode derive from the frames so far
+    def __init__(self, max_code_length=MAX_CODE_LENGTH):
+        self.max_code_length = max_code_length
+        self.counts = [1] * ALPHABET_SIZE
+        self.rebuild()
+
+    def rebuild(self):
+        with instrument.stage("tree_build"):
+            lengths = code_lengths(self.counts, self.max_code_length)
+            self.code_table = list(zip(canonical_codes(lengths), lengths))
+            self.codes = dict(enumerate(self.code_table))
+
+    def update(self, frame_counts):
+        self.counts = [count + new for count, new in zip(self.counts, frame_counts)]
+        if sum(self.counts) > ADAPTIVE_HALVE_AT:
+            self.counts = [(count + 1) // 2 for count in self.counts]
+        self.rebuild()
+
+
+def _encode_mapped(compressor, path, start, end) -> bytes:
+    # Worker side of the block mode: encodes bytes [start, end) of the file
+    # with its own table
+    with map_input(path) as data:
+        return bytes(compressor.encode(data[start:end]))
+
+
+def _decode_shared(compressor, path, offset, length, output_name, start):
+    # Worker side of the block mode: decodes one block into output[start:]
+    sink = attach_shared(output_name)
+    try:
+        block = compressor.decode(read_block(path, offset, length))
+        sink.buf[start:start + len(block)] = block
+    finally:
+        sink.close()
+
+
+class HuffmanCompressor(StreamCodec):
+
+    # max_code_length bounds every code so the table decoder needs at most
+    # one subtable lookup per symbol, None builds the plain unbounded code.
+    # block_number > 1 makes compress_bin code that many blocks in parallel
+    # on the shared pool, like LZ77Compressor.
+    # four_streams picks the Huff0 style layout (see STREAMS_FLAG) for every
+    # block, so the decoder can work on four streams at once.
+    # adaptive codes in one pass (see ADAPTIVE_FLAG): output starts after
+    # the first ADAPTIVE_FIRST_FRAME bytes instead of after the whole input.
+    # With a cache (cache.CompressionCache) compress_bin restores the output
+    # of an earlier run on the same bytes with the same settings.
+    # A dictionary (dictionary.Dictionary) seeds the table of every block
+    # from its dictionary_table counts (see DICTIONARY_FLAG), decoding needs
+    # the same one; adaptive frames build their own codes and ignore it.
+    # stored_blocks stores blocks and frames that coding would not shrink
+    # (see STORED_FLAG).
+    def __init__(self, max_code_length=MAX_CODE_LENGTH, block_number=1, max_workers=None, four_streams=False,
+                 adaptive=False, cache=None, dictionary=None, dictionary_table=BYTES, stored_blocks=True):
+        self.max_code_length = max_code_length
+        self.stored_blocks = stored_blocks
+        self.four_streams = four_streams
+        self.adaptive = adaptive
+        self.dictionary = dictionary
+        self.dictionary_table = dictionary_table
+        self.cache = cache
+        self.block_number = block_number
+        # size of the shared worker pool, None for one worker per core
+        self.max_workers = max_workers
+
+    def __getstate__(self):
+        # workers get a copy of the compressor but never use the cache
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def cache_params(self) -> dict:
+        return {"max_code_length": self.max_code_length, "block_number": self.block_number,
+                "four_streams": self.four_streams, "adaptive": self.adaptive,
+                "dictionary": self.dictionary.id if self.dictionary else None,
+                "dictionary_table": self.dictionary_table, "stored_blocks": self.stored_blocks}
 
     def create_huffman_tree(self, huffman_table):
         heap = [huffman_node(char, freq) for char, freq in huffman_table]
@@ -91,35 +639,13 @@ class HuffmanCompressor:
 
     def create_encoding_table(self, node, bit='', encoding_table={}):
         if (node.char is not None): # base case
-            encoding_table[node.char] = bit
+            encoding_table[node.char] = bit or '0' # a lone symbol still needs one bit
         if (node.left is not None):
             self.create_encoding_table(node.left, bit = f'{bit}0', encoding_table=encoding_table)
         if (node.right is not None):
             self.create_encoding_table(node.right, bit = f'{bit}1', encoding_table=encoding_table)
         return encoding_table
 
-    def resolve_same_frequency(self, incomplete_table):
-        current_freq = 0
-        current_pairs = list()
-        resolved_table = list()
-        for entry in incomplete_table:
-            if entry[1] != current_freq: # handle frequency not being the same as the current frequency
-                if not current_pairs: # handle empty current_pairs list
-                    current_pairs.append(entry)
-                    current_freq = entry[1]
-                else: # handle adding current pairs to resolved pairs and clearing the list
-                    current_pairs.sort(key=lambda tup: tup[0])
-                    resolved_table.extend(current_pairs) # sorts in place
-                    current_pairs.clear()
-                    current_pairs.append(entry)
-                    current_freq = entry[1]
-            else:
-                current_pairs.append(entry)
-        
-        current_pairs.sort(key=lambda tup: tup[0])
-        resolved_table.extend(current_pairs) # sorts in place
-        return resolved_table
-
     def serialize_huffman_tree(self, pairs):
         serialized_end = b'\x00\x00\x00\x00'
         serialzed_tree = bytearray()
@@ -139,86 +665,214 @@ class HuffmanCompressor:
         right, next_index = self.deserialize_huffman_tree(data, next_index)
         return huffman_node(char=None, freq=0, left=left, right=right), next_index
 
-    # @timing_and_profiling
+    def create_code_table(self, encoding_table):
+        # '0'/'1' code strings to (code, length) pairs for the bit writer
+        return {char: (int(code, 2), len(code)) for char, code in encoding_table.items()}
+
+    def create_byte_code_table(self, counts):
+        # Returns the canonical code length of every byte value and a 256
+        # entry table of (code, length) for the bit writer
+        with instrument.stage("tree_build"):
+            lengths = code_lengths([counts[byte] for byte in range(ALPHABET_SIZE)], self.max_code_length)
+            code_table = [(code, length) if length else None
+                          for code, length in zip(canonical_codes(lengths), lengths)]
+        return lengths, code_table
+
+    def block_code(self, counts) -> tuple[int, bytes, list]:
+        # The flag and header describing the code of a block with these byte
+        # counts, and the (code, length) table for the bit writer
+        if self.dictionary is None:
+            lengths, code_table = self.create_byte_code_table(counts)
+            return CANONICAL_FLAG, pack_code_lengths(lengths), code_table
+        lengths = self.dictionary.code_lengths(self.dictionary_table, self.max_code_length)
+        code_table = list(zip(canonical_codes(lengths), lengths))
+        header = DICTIONARY_HEADER.pack(self.dictionary_table, self.max_code_length or 0, self.dictionary.id)
+        return DICTIONARY_FLAG, header, code_table
+
+    def encode(self, data) -> bytearray:
+        # In memory counterpart of compress_bin, same layout as its .enc file
+        counts = byte_histogram(data)
+        if self.four_streams:
+            return self.encode_streams(data, counts)
+        flag, header, code_table = self.block_code(counts)
+        if self.stored_blocks and len(header) + packed_size(counts, code_table) >= len(data):
+            instrument.count("stored_blocks")
+            return stored_block(data)
+        writer = BitWriter()
+        with instrument.stage("bit_packing"):
+            writer.write_bytes(data, code_table, pair_table(code_table) if len(data) >= PAIR_TABLE_MIN else None)
+            pad_amount = writer.flush()
+        enc_data = bytearray([pad_amount | flag])
+        enc_data += header
+        enc_data += writer.getvalue()
+        return enc_data
+
+    def encode_streams(self, data, counts) -> bytearray:
+        flag, header, code_table = self.block_code(counts)
+        # every stream may end in a partly used byte
+        if self.stored_blocks and \
+                len(header) + JUMP_TABLE.size + packed_size(counts, code_table) + STREAMS >= len(data):
+            instrument.count("stored_blocks")
+            return stored_block(data)
+        pairs = pair_table(code_table) if len(data) >= PAIR_TABLE_MIN else None
+        segment = -(-len(data) // STREAMS)
+        streams = []
+        with instrument.stage("bit_packing"):
+            for i in range(STREAMS):
+                writer = BitWriter()
+                writer.write_bytes(data[i * segment:(i + 1) * segment], code_table, pairs)
+                writer.flush()
+                streams.append(writer.getvalue())
+        enc_data = bytearray([flag | STREAMS_FLAG])
+        enc_data += header
+        enc_data += JUMP_TABLE.pack(len(data), *(len(stream) for stream in streams[:-1]))
+        for stream in streams:
+            enc_data += stream
+        return enc_data
+
+    def encode_adaptive(self, data, model) -> bytearray:
+        # One adaptive frame, then model moves on past it
+        counts = byte_histogram(data)
+        if self.stored_blocks and packed_size(counts, model.code_table) >= len(data):
+            instrument.count("stored_blocks")
+            enc_data = stored_block(data, ADAPTIVE_FLAG)
+        else:
+            writer = BitWriter()
+            with instrument.stage("bit_packing"):
+                writer.write_bytes(data, model.code_table)
+                pad_amount = writer.flush()
+            enc_data = bytearray([pad_amount | ADAPTIVE_FLAG])
+            enc_data += writer.getvalue()
+        model.update(counts)
+        return enc_data
+
+    def decode_adaptive(self, enc_data, model) -> bytearray:
+        if enc_data[0] & STORED_FLAG:
+            out = bytearray(memoryview(enc_data)[1:])
+        else:
+            nbits = (len(enc_data) - 1) * 8 - enc_data[0] % 8
+            with instrument.stage("bit_unpacking"):
+                out = DecodeTable(model.codes, decode_table_bits(nbits)).decode(memoryview(enc_data)[1:], nbits)
+        model.update(byte_histogram(out))
+        return out
+
+    def compress_stream(self, source, block_size=None):
+        if self.adaptive:
+            model = AdaptiveModel(self.max_code_length)
+            for block in iter_blocks(source, block_size or ADAPTIVE_INTERVAL, ADAPTIVE_FIRST_FRAME):
+                yield frame(self.encode_adaptive(block, model))
+            return
+        # Every block is coded with its own tree, so memory stays at one block
+        for block in iter_blocks(source, block_size or STREAM_BLOCK_SIZE):
+            yield frame(self.encode(block))
+
+    def decompress_stream(self, source):
+        model = None
+        for payload in iter_frames(source):
+            if payload[0] & ADAPTIVE_FLAG:
+                model = model or AdaptiveModel(self.max_code_length)
+                yield bytes(self.decode_adaptive(payload, model))
+            else:
+                yield bytes(self.decode(payload))
+
+    @instrument.timed("huffman.compress")
     def compress_bin(self, folder_path, input_file):
-        start_time = time.time()
-        # Count byte frequencies
-        d = dict()
-        with open(f"{folder_path}/{input_file}", 'rb') as file:
-            pairs = list(Counter(file.read()).items())
-        pairs.sort(key=lambda x: x[1]) 
-
-        # Create tree and encoding table
-        tree = self.create_huffman_tree(pairs)
-        encoding_table = self.create_encoding_table(tree)
-        # Serialize the Huffman tree
-        serialized_tree = self. serialize_huffman_tree(pairs)
-
-        # Generate bit string
-        bit_list = []
-        with open(f"{folder_path}/{input_file}", 'rb') as file:
-            while (chunk := file.read(4096)):  # Read in chunks
-                for byte in chunk:
-                    bit_list.append(encoding_table[byte])
-
-        bit_string = ''.join(bit_list)
-        # Add byte at beginning to indicate padding amount
-        pad_amount = 8 - (len(bit_string) % 8)
-        pad_byte = bytearray()
-        pad_byte.extend(struct.pack('B', pad_amount))
-        byte_array = bytearray()
-
-        for i in range(0, len(bit_string), 8):
-            byte_chunk = bit_string[i:i + 8]
-            if len(byte_chunk) < 8:
-                byte_chunk = byte_chunk.ljust(8, '0')  # Pad the last byte if necessary
-            byte_array.append(int(byte_chunk, 2))
-
-        # Write the serialized tree and compressed data to file
-        with open(f"{folder_path}/{input_file}.enc", 'wb') as file:
-            file.write(pad_byte)  # Write the padding byte
-            file.write(serialized_tree)  # Write the serialized tree
-            file.write(byte_array)  # Write the compressed data
-
-        total_time = time.time() - start_time
+        if self.cache is None:
+            return self._compress_bin(folder_path, input_file)
+        start_time = time.perf_counter()
+        self.cache.compress("huffman", self.cache_params(), folder_path, input_file, (".enc",),
+                            lambda: self._compress_bin(folder_path, input_file))
+        return time.perf_counter() - start_time
+
+    def _compress_bin(self, folder_path, input_file):
+        if self.adaptive:
+            return self.compress_adaptive(folder_path, input_file)
+        if self.block_number > 1:
+            return self.compress_blocks(folder_path, input_file)
+        start_time = time.perf_counter()
+        # The input is mapped once, counted and packed straight from the
+        # mapping, and the output size is known before anything is written
+        with map_input(join(folder_path, input_file)) as data:
+            if self.four_streams or self.dictionary is not None:
+                # the stream bounds depend on the input size, and seeded
+                # tables are for inputs small enough to code in memory
+                enc_data = self.encode(data)
+                with OutputSink(join(folder_path, f"{input_file}.enc"), len(enc_data)) as sink:
+                    sink.write(enc_data)
+                return time.perf_counter() - start_time
+
+            # Count byte frequencies
+            counts = byte_histogram(data)
+            lengths, code_table = self.create_byte_code_table(counts)
+            # Only the code lengths are stored, the codes are canonical
+            header = pack_code_lengths(lengths)
+            nbits = sum(counts[byte] * length for byte, length in enumerate(lengths))
+            pad_amount = -nbits % 8
+            if self.stored_blocks and len(header) + (nbits + 7) // 8 >= len(data):
+                instrument.count("stored_blocks")
+                with OutputSink(join(folder_path, f"{input_file}.enc"), 1 + len(data)) as sink:
+                    sink.write(bytes([STORED]))
+                    sink.write(data)
+                return time.perf_counter() - start_time
+
+            # Pack the codes, each chunk goes to the output as soon as it is done
+            writer = BitWriter()
+            pairs = pair_table(code_table)
+            with OutputSink(join(folder_path, f"{input_file}.enc"), 1 + len(header) + (nbits + 7) // 8) as sink:
+                sink.write(struct.pack('B', pad_amount | CANONICAL_FLAG))  # Write the padding byte
+                sink.write(header)  # Write the code lengths
+                for offset in range(0, len(data), CHUNK_SIZE):
+                    with instrument.stage("bit_packing"):
+                        writer.write_bytes(data[offset:offset + CHUNK_SIZE], code_table, pairs)
+                    sink.write(writer.take())
+                writer.flush()
+                sink.write(writer.take())
+
+        total_time = time.perf_counter() - start_time
         return total_time
 
-    def compress(self,folder_path, input_file):
-        start_time = time.time()
-        # Count character frequencies
-        with open(f"{folder_path}{input_file}", 'r') as file:
-            pairs = list(Counter(file.read()).items())
-        pairs.sort(key=lambda x: x[1]) 
+    def compress_blocks(self, folder_path, input_file):
+        # Every block gets its own table, so blocks encode and decode in
+        # parallel and a skewed region does not bloat the codes of the rest.
+        # Workers map the input file themselves, nothing is copied to them.
+        start_time = time.perf_counter()
+        path = join(folder_path, input_file)
+        size = os.path.getsize(path)
+        bounds = [(i * size // self.block_number, (i + 1) * size // self.block_number)
+                  for i in range(0, self.block_number)]
 
-        # Create tree and encoding table
-        tree = self.create_huffman_tree(pairs)
-        encoding_table = self.create_encoding_table(tree)
-
-        serialized_tree = self.serialize_huffman_tree(pairs)
-
-        # Generate bit string
-        bit_string = ''
-        with open(f"{folder_path}/{input_file}", 'r') as file:
-            for line in file:
-                for char in line:
-                    bit_string += encoding_table[char]
-
-        # Convert to byte array
-        byte_array = bytearray()
-        for i in range(0, len(bit_string), 8):
-            byte_chunk = bit_string[i:i + 8]
-            if len(byte_chunk) < 8:
-                byte_chunk = byte_chunk.ljust(8, '0')  # Pad the last byte if necessary
-            byte_array.append(int(byte_chunk, 2))
-
-        # Write the serialized tree and enc data to file
-        with open(f"{folder_path}/{input_file}.enc", 'wb') as file:
-            file.write(serialized_tree)  # Write the serialized tree
-            file.write(byte_array)  # Write the enc data
-
-        total_time = time.time() - start_time
+        executor = choose_executor(size, self.max_workers)
+        payloads = instrument.pool_map(executor, _encode_mapped, \
+            [self] * len(bounds), \
+            [path] * len(bounds), \
+            [start for start, end in bounds], \
+            [end for start, end in bounds])
+
+        with OutputSink(join(folder_path, f"{input_file}.enc")) as sink:
+            write_container(sink, CONTAINER_MAGIC,
+                            [(payload, end - start) for payload, (start, end) in zip(payloads, bounds)])
+
+        total_time = time.perf_counter() - start_time
+        return total_time
+
+    def compress_adaptive(self, folder_path, input_file):
+        # The file is read once front to back, every frame is written as
+        # soon as it is coded
+        start_time = time.perf_counter()
+        with open(join(folder_path, input_file), 'rb') as source, \
+                OutputSink(join(folder_path, f"{input_file}.enc")) as sink:
+            sink.write(ADAPTIVE_MAGIC)
+            for chunk in self.compress_stream(source):
+                sink.write(chunk)
+        total_time = time.perf_counter() - start_time
         return total_time
 
+    def compress(self, folder_path, input_file):
+        # Text files are coded as the bytes they hold, like any other file:
+        # reading them as text lost CRLF line endings and every character
+        # past U+00FF
+        return self.compress_bin(folder_path, input_file)
+
 
         # except Exception as e:
         #     print(f"An error occurred during encoding: {e}")
@@ -256,63 +910,127 @@ class HuffmanCompressor:
     #     with open(f"{folder_path}{enc_file}.dec", 'w') as file:
     #         file.write(''.join(dec_output))
     
-    def decompress(self, folder_path, enc_file):
-        # Read the serialized tree and enc data from the file
-        with open(os.path.join(folder_path, f"{enc_file}.enc"), 'rb') as file:
-            enc_data = file.read()  # Read the rest of the file (enc data)
+    @instrument.timed("huffman.decompress")
+    def decompress(self, folder_path, enc_file, use_numpy=False):
+        path = join(folder_path, f"{enc_file}.enc")
+        with map_input(path) as enc_data:
+            if enc_data[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC:
+                dec_output = self.decompress_blocks(path)
+            elif enc_data[:len(ADAPTIVE_MAGIC)] == ADAPTIVE_MAGIC:
+                dec_output = b''.join(self.decompress_stream([enc_data[len(ADAPTIVE_MAGIC):]]))
+            else:
+                # Decoded straight from the mapping
+                dec_output = self.decode(enc_data, use_numpy)
 
+        # Write the decompressed data to a file
+        with OutputSink(join(folder_path, f"{enc_file}.dec"), len(dec_output)) as sink:
+            sink.write(dec_output)
 
-        # Read padding length
-        padding_length = enc_data[0]
-        enc_data = enc_data[1:]
+        return dec_output
 
-        pairs = list()
-        # Deserialize the Huffman tree
-        while enc_data[:4] != b'\x00\x00\x00\x00':
-            char, freq = struct.unpack('<BI', enc_data[:5])
-            enc_data = enc_data[5:]
-            pairs.append((char, freq))
+    def decompress_blocks(self, path) -> bytes:
+        # Every block is decoded straight into its place in shared memory
+        with open(path, 'rb') as file:
+            entries = read_index(file, CONTAINER_MAGIC)
+        total = sum(entry.size for entry in entries)
+        sink = create_shared(total)
+        try:
+            executor = choose_executor(total, self.max_workers)
+            instrument.pool_map(executor, _decode_shared, \
+                [self] * len(entries), \
+                [path] * len(entries), \
+                [entry.offset for entry in entries], \
+                [entry.length for entry in entries], \
+                [sink.name] * len(entries), \
+                [entry.start for entry in entries])
+            return bytes(sink.buf[:total])
+        finally:
+            release_shared(sink)
 
-        enc_data = enc_data[4:]  # Skip the serialized tree end marker
+    def decode(self, enc_data, use_numpy=False):
+        if enc_data[0] & ADAPTIVE_FLAG:
+            raise ValueError("Adaptive frames depend on the frames before them, decode them with decompress_stream")
+        if enc_data[0] & STORED == STORED:
+            return bytearray(memoryview(enc_data)[1:])
+        # Read padding length, 8 is written when the last byte is full
+        padding_length = (enc_data[0] & ~CANONICAL_FLAG) % 8
+        if enc_data[0] & DICTIONARY_FLAG:
+            codes, index = self.read_dictionary_table(enc_data, 1)
+        elif enc_data[0] & CANONICAL_FLAG:
+            # The codes follow from the lengths alone
+            lengths, index = unpack_code_lengths(enc_data, 1)
+            codes = {symbol: (code, length)
+                     for symbol, (code, length) in enumerate(zip(canonical_codes(lengths), lengths)) if length}
+        else:
+            codes, index = self.read_frequency_table(enc_data, 1)
+        if enc_data[0] & STREAMS_FLAG:
+            return self.decode_streams(enc_data, index, codes, use_numpy)
+        payload = memoryview(enc_data)[index:]
+        nbits = len(payload) * 8 - padding_length
+        if not codes:
+            return bytearray()
 
-        # Create Huffman tree from pairs
-        tree = self.create_huffman_tree(pairs)
+        with instrument.stage("bit_unpacking"):
+            table = DecodeTable(codes, decode_table_bits(nbits))
 
-        last_byte = enc_data[-1]
-        enc_data = enc_data[:-1]  # Remove the last byte
-        
-        # Decompress the data
-        node = tree
-        dec_output = bytearray()
-        for byte in enc_data:
-            for bit_pos in range(8):
-                bit = (byte >> (7 - bit_pos)) & 1
-                node = node.left if bit == 0 else node.right
-                if node.char is not None:
-                    dec_output.append(node.char)
-                    node = tree
-        
-        for bit_pos in range(8 - padding_length):
-            bit = (last_byte >> (7 - bit_pos)) & 1
-            node = node.left if bit == 0 else node.right
-            if node.char is not None:
-                dec_output.append(node.char)
-                node = tree
+            # the NumPy path is opt-in, bench.py huffman_decode has it slower
+            # than the table decoder at every payload size
+            if use_numpy and np is not None and table.max_length <= NUMPY_MAX_CODE_LENGTH:
+                return table.decode_numpy(payload, nbits)
+            return table.decode(payload, nbits)
 
-        # Write the decompressed data to a file
-        with open(os.path.join(folder_path, f"{enc_file}.dec"), 'wb') as file:
-            file.write(dec_output)
+    def decode_streams(self, enc_data, index, codes, use_numpy=False):
+        total, *sizes = JUMP_TABLE.unpack_from(enc_data, index)
+        index += JUMP_TABLE.size
+        if not codes:
+            return bytearray()
+        payload = memoryview(enc_data)[index:]
+        bounds = [0]
+        for size in sizes:
+            bounds.append(bounds[-1] + size)
+        bounds.append(len(payload))
+        streams = [payload[start:end] for start, end in zip(bounds, bounds[1:])]
+        segment = -(-total // STREAMS)
+        counts = [max(0, min(segment, total - i * segment)) for i in range(STREAMS)]
 
-        return dec_output
+        with instrument.stage("bit_unpacking"):
+            table = DecodeTable(codes, decode_table_bits(len(payload) * 8 // STREAMS))
+            # opt-in as in decode, the lockstep table decoder is faster
+            if use_numpy and np is not None and table.max_length <= NUMPY_MAX_CODE_LENGTH:
+                return table.decode_numpy_streams(streams, counts)
+            return table.decode_streams(streams, counts)
+
+    def read_dictionary_table(self, enc_data, index):
+        table, max_length, dictionary_id = DICTIONARY_HEADER.unpack_from(enc_data, index)
+        if self.dictionary is None:
+            raise ValueError(f"Data needs dictionary {dictionary_id:08x}")
+        self.dictionary.check(dictionary_id)
+        lengths = self.dictionary.code_lengths(table, max_length or None)
+        codes = {symbol: (code, length) for symbol, (code, length) in enumerate(zip(canonical_codes(lengths), lengths))}
+        return codes, index + DICTIONARY_HEADER.size
+
+    def read_frequency_table(self, enc_data, index):
+        # Header of files written before canonical codes: (symbol, frequency)
+        # pairs up to a zero terminator, the tree is rebuilt from them
+        pairs = list()
+        while enc_data[index:index + 4] != b'\x00\x00\x00\x00':
+            char, freq = struct.unpack('<BI', enc_data[index:index + 5])
+            index += 5
+            pairs.append((char, freq))
+        index += 4  # Skip the serialized tree end marker
+        if not pairs:
+            return {}, index
+        tree = self.create_huffman_tree(pairs)
+        encoding_table = self.create_encoding_table(tree, encoding_table={})
+        return self.create_code_table(encoding_table), index
 
     def test(self, folder_path, input_file):
         # if input_file.endswith('.enc'):
         #     print("File already compressd.")
         #     return
-        if input_file.endswith('.txt'):
-            compression_time = self.compress(folder_path, input_file)
-            decompression_time = self.decompress(folder_path, input_file)
-        else:   
-            compression_time = self.compress_bin(folder_path, input_file)
-            decompression_time = self.decompress(folder_path, input_file)
-        detailed_report("Huffman", f"{folder_path}{input_file}", compression_time, 0)    
+        compression_time = self.compress_bin(folder_path, input_file)
+        # decompress returns the decoded bytes, not its time
+        start_time = time.perf_counter()
+        self.decompress(folder_path, input_file)
+        decompression_time = time.perf_counter() - start_time
+        detailed_report("Huffman", join(folder_path, input_file), compression_time, decompression_time)    
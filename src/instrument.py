@@ -0,0 +1,268 @@
+import json
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+from time import perf_counter
+
+# Instrumentation shared by the codecs: stage timers, counters and an opt in
+# sampling profiler. Everything is off until enable(); then stage() hands
+# back one shared no-op context manager and count() returns right away, and
+# the hooks sit at block or chunk granularity, never per symbol, so the
+# disabled cost is a global lookup per block. Counters that take work to
+# compute (token statistics) are only computed when enabled() is true.
+#
+#     metrics = instrument.enable(sample_interval=0.001)
+#     ... compress things ...
+#     instrument.disable()
+#     print(metrics.prometheus())
+#
+# Stages the codecs time:
+#     io             reading sources and blocks, writing outputs
+#     histogram      byte counting
+#     tree_build     Huffman code lengths, canonical codes, DEFLATE headers
+#     match_finding  LZ77 parsing (match search and the literal/match choice)
+#     token_emit     optimal parse paths and serializing tokens to bytes
+#     bit_packing    writing Huffman codes
+#     bit_unpacking  Huffman decoding
+#     token_decode   LZ77 decoding
+# plus one span per codec call, e.g. "lz77.compress". Counters: matches,
+# match_bytes (their total length), literals, chain_steps (candidates the
+# match finder compared) and stored_blocks (blocks stored as they are
+# instead of coded). Stage time adds up over pool workers (pool_map brings
+# back what worker processes record), so with several blocks a stage can
+# take longer than the codec call around it.
+
+STAGES = ("io", "histogram", "tree_build", "match_finding", "token_emit", "bit_packing", "bit_unpacking",
+          "token_decode")
+DEFAULT_PREFIX = "compression_tester"
+
+
+class Metrics:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.profiler = None
+        # thread pool workers record into the same metrics
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def merge(self, state):
+        # state as returned by state(), from a worker process
+        seconds, calls, counters = state
+        with self.lock:
+            for name, value in seconds.items():
+                self.seconds[name] += value
+            self.calls.update(calls)
+            self.counters.update(counters)
+
+    def state(self) -> tuple:
+        with self.lock:
+            return dict(self.seconds), dict(self.calls), dict(self.counters)
+
+    def snapshot(self) -> dict:
+        seconds, calls, counters = self.state()
+        snapshot = {
+            "stages": {name: {"seconds": seconds[name], "calls": calls[name]} for name in sorted(seconds)},
+            "counters": dict(sorted(counters.items())),
+        }
+        if counters.get("matches"):
+            snapshot["average_match_length"] = counters.get("match_bytes", 0) / counters["matches"]
+        if self.profiler is not None:
+            snapshot["profile"] = self.profiler.top()
+        return snapshot
+
+    def json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def prometheus(self, prefix=DEFAULT_PREFIX) -> str:
+        # Text exposition format, for a node exporter textfile collector or
+        # a scrape endpoint
+        seconds, calls, counters = self.state()
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter"]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {seconds[name]:.9f}' for name in sorted(seconds)]
+        lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+        lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {calls[name]}' for name in sorted(calls)]
+        for name in sorted(counters):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {counters[name]}")
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    # Samples the stack of one thread every interval seconds from a
+    # background thread, so the profiled code runs unmodified (cProfile
+    # hooks every call and would distort the hot loops it is meant to
+    # find). Stacks are kept collapsed, "outer;inner;leaf" -> samples, the
+    # input format of flamegraph.pl and speedscope.
+    def __init__(self, interval=0.001, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def top(self, limit=20) -> list[dict]:
+        # Functions by samples they were running in (self) and on the
+        # stack at all (total)
+        own = Counter()
+        total = Counter()
+        for stack, samples in self.stacks.items():
+            functions = stack.split(";")
+            own[functions[-1]] += samples
+            for function in set(functions):
+                total[function] += samples
+        return [{"function": function, "self": samples, "total": total[function]}
+                for function, samples in own.most_common(limit)]
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {samples}\n" for stack, samples in self.stacks.most_common())
+
+
+_metrics = None
+
+
+def enable(metrics=None, sample_interval=None) -> Metrics:
+    # Starts recording into metrics (a new Metrics by default), with a
+    # sampling profiler on the calling thread when sample_interval is given
+    global _metrics
+    _metrics = metrics or Metrics()
+    if sample_interval:
+        _metrics.profiler = SamplingProfiler(sample_interval)
+        _metrics.profiler.start()
+    return _metrics
+
+
+def disable() -> Metrics:
+    global _metrics
+    metrics, _metrics = _metrics, None
+    if metrics is not None and metrics.profiler is not None:
+        metrics.profiler.stop()
+    return metrics
+
+
+def enabled() -> bool:
+    return _metrics is not None
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, perf_counter() - self.start)
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+def stage(name):
+    # with stage("histogram"): ... times the block under name
+    if _metrics is None:
+        return NO_STAGE
+    return _Stage(_metrics, name)
+
+
+def count(name, value=1):
+    if _metrics is not None:
+        _metrics.count(name, value)
+
+
+def timed(name):
+    # Decorator version of stage() for a whole call, the result is passed
+    # through
+    def decorate(f):
+        @wraps(f)
+        def wrap(*args, **kw):
+            if _metrics is None:
+                return f(*args, **kw)
+            with _Stage(_metrics, name):
+                return f(*args, **kw)
+        return wrap
+    return decorate
+
+
+class _Collected:
+    # Runs a pool function in a worker process with its own metrics and
+    # hands them back with the result
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, *args):
+        metrics = enable()
+        try:
+            return self.f(*args), metrics.state()
+        finally:
+            disable()
+
+
+def pool_task(executor, f):
+    # f as it should be submitted to executor: worker processes record into
+    # their own metrics, which pool_result merges into the caller's, thread
+    # workers record into the caller's directly
+    if _metrics is None or not isinstance(executor, ProcessPoolExecutor):
+        return f
+    return _Collected(f)
+
+
+def pool_result(task, result):
+    # The result of f from what the task returned
+    if not isinstance(task, _Collected):
+        return result
+    result, state = result
+    if _metrics is not None:
+        _metrics.merge(state)
+    return result
+
+
+def pool_map(executor, f, *iterables) -> list:
+    # executor.map as a list, see pool_task
+    task = pool_task(executor, f)
+    return [pool_result(task, result) for result in executor.map(task, *iterables)]
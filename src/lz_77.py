@@ -1,186 +1,762 @@
 import os as os
 from utils import detailed_report
+import math
 import struct
 from collections import deque
-from functools import wraps
-from time import time
-import concurrent.futures
-
-# Data will be compressed to this format:
-#     4 bytes of "\x00\x00\x00\x00 to seperate blocks for each parallel
-#     1 byte for number of blocks to split into for parallel processing
-#     encoded data:
+from functools import lru_cache
+from time import perf_counter
+import instrument
+from container import BlockEntry, read_block, read_index, write_container
+from dictionary import DICTIONARY_ID
+from fileio import OutputSink, join, map_input
+from histogram import byte_histogram, incompressible
+from pool import attach_shared, choose_executor, create_shared, release_shared
+from stream import StreamCodec, frame, iter_blocks, iter_frames
+from tokens import TokenBuffer, compact_costs, decode_tokens, literal_block, varint
+# Data will be compressed to this format (the block container of container.py):
+#     4 bytes magic, b'LZ7V' for compact tokens or b'LZ7I' for tuples, b'LZ7D'
+#     for compact tokens against a preset dictionary
+#     4 bytes for number of blocks the input was split into for parallel processing
+#     block index, one entry per block:
+#         8 bytes offset of the block's tokens, counted from the end of the index
+#         4 bytes length of the block's tokens
+#         4 bytes uncompressed size of the block
+#     encoded data of every block, each block decodes on its own, either
+#     compact tokens (see tokens.py) or one tuple per match:
 #         2 bytes for distance
 #         1 byte for length
-#         1 byte for next character (null byte for no character)
+#         1 byte for next character, in the last tuple of a block a null
+#         byte means no character; a block whose last next character is a
+#         real null byte ends in an extra (0, 0, 0) tuple
+#     with a dictionary (dictionary.py) every block starts with its 4 byte id,
+#     and matches may reach back into the dictionary content
+#     a compact block that samples as incompressible (histogram.incompressible),
+#     or whose tokens would come out longer than the data, is stored as a
+#     single run of literals, see tokens.literal_block
     
 
-def timing(f):
-    @wraps(f)
-    def wrap(*args, **kw):
-        ts = time()
-        f(*args, **kw)
-        te = time()
-        execution_time = te - ts
-        print(f'Function {f.__name__} executed in: {execution_time:.8f}s')
-        return execution_time
-    return wrap
-
 # Pack tuple into bytes
 def pack_tuple(tuple: tuple) -> bytes:
     return struct.pack('HBB', tuple[0], tuple[1], tuple[2])
 
 
-class LZ77Compressor:
+# The extra last tuple of a block that ends in a null next character
+END_TUPLE = pack_tuple((0, 0, 0))
+
+
+# Positions are chained on their first MIN_MATCH characters, so shorter
+# repeats are always emitted as literals
+MIN_MATCH = 3
+# limits of the tuple format
+MAX_DISTANCE = 65535
+MAX_LENGTH = 255
+
+# Token formats: compact varint sequences (tokens.py) with any distance and
+# length, or the original fixed 4 byte tuples
+COMPACT = "compact"
+TUPLES = "tuples"
+CONTAINER_MAGICS = {COMPACT: b'LZ7V', TUPLES: b'LZ7I'}
+CONTAINER_MAGIC = CONTAINER_MAGICS[TUPLES]
+# Block format of compact tokens primed with a dictionary, read_index
+# reports it as the token format of such files
+PRIMED = "primed"
+DICTIONARY_MAGIC = b'LZ7D'
+
+# Input bytes per frame in the streaming format
+STREAM_BLOCK_SIZE = 1 << 16
+# First frame of a stream primed with a dictionary: DICTIONARY_MAGIC and the
+# dictionary id. A token frame this short never starts with the magic.
+DICTIONARY_FRAME = struct.Struct('>4sI')
+
+
+class HashChain:
+    # head maps a 3 character prefix to the most recent position it was seen at,
+    # prev[pos & mask] links every position to the previous one with the same
+    # prefix. Chains are walked newest first, so the walk simply stops at the
+    # first position that has slid out of the window instead of removing it.
+    # prev is a ring of at least window slots, as in zlib: a slot is only
+    # reused once its position is out of the window, so memory follows the
+    # window rather than the block.
+    def __init__(self, data, window, max_length, max_chain, good_length):
+        self.data = data
+        self.window = window
+        self.max_length = max_length
+        self.max_chain = max_chain
+        self.good_length = good_length
+        self.head = {}
+        size = 1 << max(window - 1, 0).bit_length()
+        self.mask = size - 1
+        self.prev = [-1] * size
+        # every position below this one is in the chain
+        self.inserted = 0
+        # candidates compared, for the chain_steps counter
+        self.steps = 0
+
+    def insert(self, pos: int):
+        key = self.data[pos:pos + MIN_MATCH]
+        if len(key) == MIN_MATCH:
+            self.prev[pos & self.mask] = self.head.get(key, -1)
+            self.head[key] = pos
+
+    def advance(self, pos: int):
+        # Inserts the positions before pos that are not in the chain yet, so
+        # parsers can look ahead without inserting anything twice
+        data = self.data
+        head = self.head
+        prev = self.prev
+        mask = self.mask
+        for k in range(self.inserted, min(pos, len(data) - MIN_MATCH + 1)):
+            key = data[k:k + MIN_MATCH]
+            prev[k & mask] = head.get(key, -1)
+            head[key] = k
+        self.inserted = max(self.inserted, pos)
+
+    def prime(self, length: int):
+        # Inserts data[:length], a preset dictionary, from a chain built
+        # once per dictionary instead of hashing it again for every input
+        head, prev = prefix_chain(bytes(self.data[:length]))
+        self.head = dict(head)
+        size = len(self.prev)
+        if len(prev) <= size:
+            self.prev[:len(prev)] = prev
+        else:
+            # only the last size positions fit, rotated to their slots
+            split = len(prev) & self.mask
+            self.prev[split:] = prev[len(prev) - size:len(prev) - split]
+            self.prev[:split] = prev[len(prev) - split:]
+        self.inserted = len(prev)
+
+    def find(self, pos: int) -> tuple[int, int]:
+        # longest_match with everything before pos inserted, (0, 0) when
+        # fewer than MIN_MATCH characters are left
+        self.advance(pos)
+        if pos + MIN_MATCH > len(self.data):
+            return 0, 0
+        return self.longest_match(pos)
+
+    def longest_match(self, pos: int) -> tuple[int, int]:
+        data = self.data
+        candidate = self.head.get(data[pos:pos + MIN_MATCH], -1)
+        limit = pos - self.window
+        max_length = min(self.max_length, len(data) - pos)
+        best_distance = 0
+        best_length = 0
+        chain = self.max_chain
+        while candidate >= limit and candidate >= 0 and chain > 0:
+            chain -= 1
+            # cheap reject: a longer match has to agree at best_length first
+            if best_length == 0 or data[candidate + best_length] == data[pos + best_length]:
+                length = MIN_MATCH
+                # compare 8 characters at a time, then finish one by one
+                while length + 8 <= max_length and \
+                        data[candidate + length:candidate + length + 8] == data[pos + length:pos + length + 8]:
+                    length += 8
+                while length < max_length and data[candidate + length] == data[pos + length]:
+                    length += 1
+                if length > best_length:
+                    best_length = length
+                    best_distance = pos - candidate
+                    if length >= self.good_length or length == max_length:
+                        break
+            candidate = self.prev[candidate & self.mask]
+        self.steps += self.max_chain - chain
+        return best_distance, best_length
+
+
+def count_tokens(tokens, chain):
+    # Instrumentation counters of one parse, tokens being a TokenBuffer or
+    # a list of literals and (length, distance) matches
+    if isinstance(tokens, TokenBuffer):
+        matches = len(tokens.lengths)
+        match_bytes = sum(tokens.lengths)
+        literals = len(tokens.literals)
+    else:
+        lengths = [token[0] for token in tokens if type(token) is not int]
+        matches = len(lengths)
+        match_bytes = sum(lengths)
+        literals = len(tokens) - matches
+    instrument.count("matches", matches)
+    instrument.count("match_bytes", match_bytes)
+    instrument.count("literals", literals)
+    instrument.count("chain_steps", chain.steps)
+
+
+def count_tuples(byte_data, chain):
+    # Same for the tuple format, where every tuple also carries a literal
+    # unless it ends the input
+    lengths = [length for distance, length, next_char in struct.iter_unpack('<HBB', byte_data) if length]
+    instrument.count("matches", len(lengths))
+    instrument.count("match_bytes", sum(lengths))
+    instrument.count("literals", len(byte_data) // 4)
+    instrument.count("chain_steps", chain.steps)
+
+
+@lru_cache(maxsize=4)
+def prefix_chain(prefix) -> tuple[dict, list[int]]:
+    # head and prev of every position whose key lies within prefix, the
+    # last MIN_MATCH - 1 positions also need the bytes that follow it. A
+    # window as long as prefix keeps every position in its own slot.
+    chain = HashChain(prefix, len(prefix), 0, 0, 0)
+    chain.advance(len(prefix) - MIN_MATCH + 1)
+    return chain.head, chain.prev[:chain.inserted]
+
+
+# Parsing strategies. parse() splits data into literals and matches:
+#   greedy   takes the longest match at every position
+#   lazy     before taking a match, checks whether the next position has a
+#            longer one and emits a literal instead if so, like zlib
+#   lazy2    looks two positions ahead
+#   optimal  finds the longest match at every position, then picks the
+#            cheapest path through literals and (shortened) matches under
+#            a cost model in bits
+GREEDY = "greedy"
+LAZY = "lazy"
+LAZY2 = "lazy2"
+OPTIMAL = "optimal"
+PARSERS = (GREEDY, LAZY, LAZY2, OPTIMAL)
+
+# Compression levels as in zlib, level -> (parser, max_chain, good_length).
+# good_length is capped by each codec's longest match anyway.
+LEVELS = {
+    1: (GREEDY, 4, 8),
+    2: (GREEDY, 16, 16),
+    3: (GREEDY, 64, 32),
+    4: (LAZY, 16, 16),
+    5: (LAZY, 64, 32),
+    6: (LAZY, 128, 128),
+    7: (LAZY2, 256, 258),
+    8: (OPTIMAL, 256, 258),
+    9: (OPTIMAL, 1024, 258),
+}
+
+# The optimal parse tries every length of a match up to this one, longer
+# matches only at their full length
+OPTIMAL_ALL_LENGTHS = 32
+
+
+def parse(chain, start, parser=GREEDY, literal_cost=None, length_cost=None, distance_cost=None, tokens=None):
+    # Tokens for chain.data[start:] (bytes), a literal byte as int or a
+    # (length, distance) match of at least MIN_MATCH characters, appended to
+    # tokens (a new list by default, or a TokenBuffer) which is returned.
+    # The costs in bits (per literal byte, per length and per distance) are
+    # only used by the optimal parser.
+    if tokens is None:
+        tokens = []
+    if parser == GREEDY:
+        return _parse_greedy(chain, start, tokens)
+    if parser in (LAZY, LAZY2):
+        return _parse_lazy(chain, start, 1 if parser == LAZY else 2, tokens)
+    if parser == OPTIMAL:
+        matches = match_graph(chain, start)
+        return shortest_path(chain.data, start, matches, literal_cost, length_cost, distance_cost, tokens)
+    raise ValueError(f"unknown parser {parser!r}, expected one of {', '.join(PARSERS)}")
+
+
+def _parse_greedy(chain, start, tokens):
+    data = chain.data
+    i = start
+    l = len(data)
+    while i < l:
+        distance, length = chain.find(i)
+        if length >= MIN_MATCH:
+            tokens.append((length, distance))
+            i += length
+        else:
+            tokens.append(data[i])
+            i += 1
+    return tokens
+
+
+def _parse_lazy(chain, start, steps, tokens):
+    data = chain.data
+    i = start
+    l = len(data)
+    # a match the lookahead already found at i
+    ahead = None
+    while i < l:
+        if ahead is not None:
+            distance, length = ahead
+            ahead = None
+        else:
+            distance, length = chain.find(i)
+        if length < MIN_MATCH:
+            tokens.append(data[i])
+            i += 1
+            continue
+        deferred = 0
+        # matches of good_length or more are taken right away
+        if length < chain.good_length:
+            for k in range(1, steps + 1):
+                match = chain.find(i + k)
+                # k literals have to buy more than k extra characters
+                if match[1] > length + k - 1:
+                    deferred = k
+                    ahead = match
+                    break
+        if deferred:
+            tokens.extend(data[i:i + deferred])
+            i += deferred
+        else:
+            tokens.append((length, distance))
+            i += length
+    return tokens
+
+
+def match_graph(chain, start) -> list[tuple[int, int]]:
+    # (distance, length) of the longest match at every position from start
+    return [chain.find(i) for i in range(start, len(chain.data))]
+
+
+def shortest_path(data, start, matches, literal_cost, length_cost, distance_cost, tokens=None):
+    # Cheapest parse of data[start:] given the longest match at every
+    # position, found backwards: cost[i] is the cheapest way to encode
+    # everything from i on. A match may be cut to any shorter length at the
+    # same distance.
+    n = len(matches)
+    cost = [0.0] * (n + 1)
+    step = [1] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        best = cost[i + 1] + literal_cost[data[start + i]]
+        best_step = 1
+        distance, length = matches[i]
+        if length >= MIN_MATCH:
+            base = distance_cost[distance]
+            for candidate in range(MIN_MATCH, min(length, OPTIMAL_ALL_LENGTHS) + 1):
+                candidate_cost = cost[i + candidate] + length_cost[candidate] + base
+                if candidate_cost < best:
+                    best = candidate_cost
+                    best_step = candidate
+            if length > OPTIMAL_ALL_LENGTHS:
+                candidate_cost = cost[i + length] + length_cost[length] + base
+                if candidate_cost < best:
+                    best = candidate_cost
+                    best_step = length
+        cost[i] = best
+        step[i] = best_step
+    if tokens is None:
+        tokens = []
+    i = 0
+    while i < n:
+        # MIN_MATCH > 1, so a step of 1 is always a literal
+        if step[i] == 1:
+            tokens.append(data[start + i])
+        else:
+            tokens.append((step[i], matches[i][0]))
+        i += step[i]
+    return tokens
+
+
+def tuple_path(data, start, matches, byte_cost=None) -> bytearray:
+    # Cheapest tuple encoding of data[start:] given the longest match at
+    # every position. A tuple covers its match and the character after it,
+    # the match may be cut to any length (0 makes it a plain literal) and
+    # costs are the bits its four bytes take at byte_cost each.
+    n = len(data) - start
+    byte_cost = byte_cost or [8] * 256
+    literal_base = byte_cost[0] * 3
+    end_cost = byte_cost[0]
+    cost = [0.0] * (n + 1)
+    choice = [0] * n
+    for i in range(n - 1, -1, -1):
+        best = literal_base + byte_cost[data[start + i]] + cost[i + 1]
+        best_length = 0
+        distance, length = matches[i]
+        if length:
+            base = byte_cost[distance & 0xFF] + byte_cost[distance >> 8]
+            for candidate in range(1, length + 1):
+                j = i + candidate
+                if j < n:
+                    candidate_cost = base + byte_cost[candidate] + byte_cost[data[start + j]] + cost[j + 1]
+                else:
+                    candidate_cost = base + byte_cost[candidate] + end_cost
+                if candidate_cost < best:
+                    best = candidate_cost
+                    best_length = candidate
+        cost[i] = best
+        choice[i] = best_length
+    byte_data = bytearray()
+    i = 0
+    while i < n:
+        length = choice[i]
+        j = i + length
+        byte_data.extend(pack_tuple((matches[i][0] if length else 0, length, data[start + j] if j < n else 0)))
+        i = j + 1
+    if n and j == n - 1 and data[start + j] == 0:
+        byte_data += END_TUPLE
+    return byte_data
+
+
+def byte_costs(byte_data) -> list[float]:
+    # -log2 of every byte value's frequency, the cost a byte wise Huffman
+    # stage would roughly give it; unseen values cost 16 bits
+    counts = byte_histogram(byte_data)
+    total = len(byte_data)
+    return [math.log2(total / counts[byte]) if counts[byte] else 16.0 for byte in range(256)]
+
+
+def _compress_shared(compressor, path, start, end, output_name, offset) -> int:
+    # Worker side of compress: encodes bytes [start, end) of the file, mapped
+    # by the worker itself, to output[offset:] and returns the length of the
+    # tokens
+    sink = attach_shared(output_name)
+    try:
+        with map_input(path) as data:
+            tokens = compressor.encode_block(data[start:end])
+        sink.buf[offset:offset + len(tokens)] = tokens
+        return len(tokens)
+    finally:
+        sink.close()
+
+
+def _decompress_shared(compressor, path, offset, length, output_name, start, token_format):
+    # Worker side of decompress: decodes one block into output[start:]
+    sink = attach_shared(output_name)
+    try:
+        block = compressor.decompress_block_at(path, offset, length, token_format)
+        sink.buf[start:start + len(block)] = block
+    finally:
+        sink.close()
+
+
+class LZ77Compressor(StreamCodec):
     SPECIAL_BYTE = 0
-    PARALLEL_SEPERATOR_BYTES = b'\x00\x00\x00\x00'
-    PARALLEL_SEPERATOR_AMOUNT = 4
 
-    def __init__(self, search_buffer_size, lookup_buffer_size, block_number=1):
+    # token_format picks the block encoding, COMPACT or TUPLES; decompress
+    # reads either, the streaming API only the configured one.
+    # With a cache (cache.CompressionCache) compress restores the output of
+    # an earlier run on the same bytes with the same settings.
+    # A dictionary (dictionary.Dictionary) primes the window of every block
+    # and stream, decoding needs the same one.
+    # stored_blocks skips the match search on compact blocks that sample as
+    # incompressible and stores them as they are; tuples have no stored form.
+    # Compact blocks whose tokens come out longer are stored either way.
+    def __init__(self, search_buffer_size, lookup_buffer_size, block_number=1, max_chain=128, good_length=None,
+                 max_workers=None, level=None, token_format=COMPACT, cache=None, dictionary=None, stored_blocks=True):
         self.search_buffer_size = search_buffer_size
         self.lookup_buffer_size = lookup_buffer_size
         self.block_number = block_number
-    
-    def hash_substring(self, substring: str) -> int:
-        return hash(substring)
-    
-    
-    def compress_block(self, index: int, data: str) -> tuple[int, bytearray]:
+        # size of the shared worker pool, None for one worker per core
+        self.max_workers = max_workers
+        # max_chain bounds how many earlier positions are tried per match,
+        # good_length stops the search early once a match is long enough
+        self.max_chain = max_chain
+        self.good_length = good_length if good_length is not None else lookup_buffer_size
+        # a level (1-9, see LEVELS) picks the parser and overrides both
+        self.level = level
+        self.parser = GREEDY
+        if level is not None:
+            self.parser, self.max_chain, self.good_length = LEVELS[level]
+        if token_format not in CONTAINER_MAGICS:
+            raise ValueError(f"unknown token format {token_format!r}, expected one of {', '.join(CONTAINER_MAGICS)}")
+        self.token_format = token_format
+        if dictionary is not None and token_format != COMPACT:
+            raise ValueError("dictionaries need the compact token format")
+        self.dictionary = dictionary
+        self.stored_blocks = stored_blocks
+        self.cache = cache
+
+    def __getstate__(self):
+        # workers get a copy of the compressor but never use the cache
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def cache_params(self) -> dict:
+        return {"search_buffer_size": self.search_buffer_size, "lookup_buffer_size": self.lookup_buffer_size,
+                "block_number": self.block_number, "parser": self.parser, "max_chain": self.max_chain,
+                "good_length": self.good_length, "token_format": self.token_format,
+                "dictionary": self.dictionary.id if self.dictionary else None, "stored_blocks": self.stored_blocks}
+
+    def compress_block(self, index: int, data) -> tuple[int, bytearray]:
+        return (index, self.encode_block(data))
+
+    def dictionary_window(self) -> bytes:
+        # The part of the dictionary matches can reach, its end is nearest
+        return self.dictionary.content[-self.window():] if self.dictionary else b''
+
+    def encode_block(self, data) -> bytearray:
+        # One block of the container, starting with the dictionary id when
+        # the window is primed with one
+        if self.dictionary is None:
+            return self.compress_window(data)
+        history = self.dictionary_window()
+        return bytearray(DICTIONARY_ID.pack(self.dictionary.id)) + \
+            self.compress_window(history + bytes(data), len(history), len(history))
+
+    def max_block_size(self, size) -> int:
+        # Longest encode_block output for size input bytes. Every tuple
+        # covers at least one byte and END_TUPLE may follow the last; a
+        # compact block is never longer than its stored form.
+        if self.token_format == TUPLES:
+            return 4 * size + len(END_TUPLE)
+        return len(varint(size)) + size + 1 + (DICTIONARY_ID.size if self.dictionary else 0)
+
+    def decode_block(self, data, token_format=None) -> bytearray:
+        if (token_format or (PRIMED if self.dictionary else self.token_format)) != PRIMED:
+            return self.decompress_window(data, token_format=token_format)
+        (dictionary_id,) = DICTIONARY_ID.unpack_from(data)
+        if self.dictionary is None:
+            raise ValueError(f"Data needs dictionary {dictionary_id:08x}")
+        self.dictionary.check(dictionary_id)
+        history = self.dictionary.content
+        with instrument.stage("token_decode"):
+            return decode_tokens(memoryview(data)[DICTIONARY_ID.size:], history)[len(history):]
+
+    def compress_window(self, data, start=0, primed=0) -> bytearray:
+        # Encodes data[start:], data[:start] is history that matches may
+        # reach back into. data is any bytes-like object, matches are found
+        # on a bytes copy of it. The first primed bytes of the history are a
+        # dictionary, see HashChain.prime.
+        if self.stored_blocks and self.token_format == COMPACT and incompressible(memoryview(data)[start:]):
+            # matches into the history are given up too, data that samples
+            # as random rarely has any
+            instrument.count("stored_blocks")
+            return literal_block(memoryview(data)[start:])
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if self.token_format == COMPACT:
+            out = self.compress_compact(data, start, primed)
+            # short matches far back can cost more than the bytes they cover,
+            # the stored form is the fallback so no block grows past it
+            if len(out) > len(data) - start + len(varint(len(data) - start)) + 1:
+                instrument.count("stored_blocks")
+                return literal_block(memoryview(data)[start:])
+            return out
         byte_data = bytearray()
-        for i in range(0, self.PARALLEL_SEPERATOR_AMOUNT):
-            byte_data.extend(self.PARALLEL_SEPERATOR_BYTES)
-        i = 0
         l = len(data)
-        dictionary = {}
-        while i < l:
-            longest_location = 0
-            longest_length = 0
-            current_char = data[i]
-            current_char_hash = self.hash_substring(data[i])
-            # If the hash is found in the dictionary, we need to deal with out of bounds before
-            if dictionary.get(current_char_hash):
-                for pos in dictionary[current_char_hash]:
-                    # make sure to remove locations that are out of bounds
-                    if pos < i - self.search_buffer_size:
-                        dictionary[current_char_hash].remove(pos)
-                        if dictionary[current_char_hash] == []:
-                            del dictionary[current_char_hash]
-                            # del temp_dict[current_char]
-                    # if the location is within bounds, we need to find the longest prefix
-                    else:
-                        current_length = 0
-                        j = pos
-                        temp_i = i
-                        while temp_i < l and current_length < self.lookup_buffer_size and data[temp_i] == data[j]:
-                            temp_i += 1
-                            j += 1
-                            current_length += 1
-                            if current_length >= longest_length:
-                                longest_length = current_length
-                                longest_location = temp_i - j
+        if self.parser == OPTIMAL:
+            chain = HashChain(data, min(self.search_buffer_size, MAX_DISTANCE),
+                             min(self.lookup_buffer_size, MAX_LENGTH), self.max_chain, self.good_length)
+            if primed:
+                chain.prime(primed)
+            with instrument.stage("match_finding"):
+                matches = match_graph(chain, start)
+            # first pass counts tuples, the second prices the bytes of the
+            # first one's output, which is what the Huffman stage of
+            # DeflateCompressor sees
+            with instrument.stage("token_emit"):
+                byte_data = tuple_path(data, start, matches, byte_costs(tuple_path(data, start, matches)))
+            if instrument.enabled():
+                count_tuples(byte_data, chain)
+            return byte_data
+        # Every tuple carries the character after its match, so deferring a
+        # match can only add tuples: lazy levels parse greedily here and only
+        # keep their match search settings
+        chain = HashChain(data, min(self.search_buffer_size, MAX_DISTANCE),
+                         min(self.lookup_buffer_size, MAX_LENGTH), self.max_chain, self.good_length)
+        if primed:
+            chain.prime(primed)
+        i = start
+        # tuples are packed as they are found
+        with instrument.stage("match_finding"):
+            while i < l:
+                longest_location, longest_length = chain.find(i)
                 i += longest_length
                 if i == l:
                     byte_data.extend(pack_tuple((longest_location, longest_length, 0)))
                 else:
-                    byte_data.extend(pack_tuple((longest_location, longest_length, ord(data[i]))))
+                    byte_data.extend(pack_tuple((longest_location, longest_length, data[i])))
                     i += 1
-                # Add the characters in the substring to the dictionary
-                for k in range((i - longest_length - 1), i):
-                    current_char = data[k]
-                    current_char_hash = self.hash_substring(current_char)
-                    if dictionary.get(current_char_hash):
-                        dictionary[current_char_hash].append(k)
-                    else:
-                        dictionary[current_char_hash] = [k]
-            # If we dont find the hash in the dictionary, we need to add it and return the 0,0,char tuple
-            else:
-                byte_data.extend(pack_tuple((0, 0, ord(current_char[0]))))
-                dictionary[current_char_hash] = [i]
-                i += 1
-        return (index, byte_data)
-    
-    @timing
+                    if i == l and data[i - 1] == 0:
+                        byte_data += END_TUPLE
+        if instrument.enabled():
+            count_tuples(byte_data, chain)
+        return byte_data
+
+    def compress_compact(self, data, start=0, primed=0) -> bytearray:
+        # Every parser applies here, tokens carry no next character
+        chain = HashChain(data, self.search_buffer_size, self.lookup_buffer_size, self.max_chain, self.good_length)
+        if primed:
+            chain.prime(primed)
+        if self.parser != OPTIMAL:
+            with instrument.stage("match_finding"):
+                tokens = parse(chain, start, self.parser, tokens=TokenBuffer())
+        else:
+            with instrument.stage("match_finding"):
+                matches = match_graph(chain, start)
+            # first pass prices every output byte at 8 bits, the second at
+            # what the first one's output says the Huffman stage will make
+            # of it
+            with instrument.stage("token_emit"):
+                costs = compact_costs([8] * 256, self.lookup_buffer_size, self.search_buffer_size)
+                first = shortest_path(data, start, matches, *costs, TokenBuffer()).encode()
+                costs = compact_costs(byte_costs(first), self.lookup_buffer_size, self.search_buffer_size)
+                tokens = shortest_path(data, start, matches, *costs, TokenBuffer())
+        with instrument.stage("token_emit"):
+            out = tokens.encode()
+        if instrument.enabled():
+            count_tokens(tokens, chain)
+        return out
+
+    def compress_stream(self, source, block_size=STREAM_BLOCK_SIZE):
+        # One frame of tokens per block, each block may match into the last
+        # search_buffer_size bytes of the one before. With a dictionary a
+        # DICTIONARY_FRAME comes first.
+        window = self.window()
+        history = self.dictionary_window()
+        # only the first frame's history is the dictionary alone
+        primed = len(history)
+        if self.dictionary:
+            yield frame(DICTIONARY_FRAME.pack(DICTIONARY_MAGIC, self.dictionary.id))
+        for block in iter_blocks(source, block_size):
+            data = history + block
+            yield frame(self.compress_window(data, len(history), primed))
+            history = data[-window:]
+            primed = 0
+
+    @instrument.timed("lz77.compress")
     def compress(self, folder_path, input_file):
-        data_list = []
-        with open(f"{folder_path}{input_file}", "r") as file:
-            data = file.read()
-            for i in range(0, self.block_number):
-                data_list.append(data[i * len(data) // self.block_number:(i + 1) * len(data) // self.block_number])
-                
-        compressed_data = bytearray()
-        indexed_blocks = [(i, block) for i, block in enumerate(data_list)]
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            results = list(executor.map(self.compress_block, \
-                [i for i, block in indexed_blocks], \
-                [block for i, block in indexed_blocks]))
-        
-        results.sort(key=lambda x: x[0])
-        for result in results:
-            compressed_data.extend(result[1])
-            
-        compressed_data = struct.pack('>I', self.block_number) + compressed_data
-        with open(f"{folder_path}{input_file}.enc", "wb") as file:
-            file.write(compressed_data)
+        # Returns the time taken in seconds
+        start_time = perf_counter()
+        if self.cache is None:
+            self._compress(folder_path, input_file)
+        else:
+            self.cache.compress("lz77", self.cache_params(), folder_path, input_file, (".enc",),
+                                lambda: self._compress(folder_path, input_file))
+        return perf_counter() - start_time
+
+    def _compress(self, folder_path, input_file):
+        # Any file. Workers map the input themselves, so the page cache holds
+        # the only copy of it, and write their tokens to shared memory
+        path = join(folder_path, input_file)
+        size = os.path.getsize(path)
+        bounds = [(i * size // self.block_number, (i + 1) * size // self.block_number)
+                  for i in range(0, self.block_number)]
+
+        # every block gets the slot its tokens can take at most
+        offsets = [0]
+        for start, end in bounds:
+            offsets.append(offsets[-1] + self.max_block_size(end - start))
+        sink = create_shared(offsets.pop())
+        try:
+            executor = choose_executor(size, self.max_workers)
+            lengths = instrument.pool_map(executor, _compress_shared, \
+                [self] * len(bounds), \
+                [path] * len(bounds), \
+                [start for start, end in bounds], \
+                [end for start, end in bounds], \
+                [sink.name] * len(bounds), \
+                offsets)
+
+            blocks = [(bytes(sink.buf[offset:offset + length]), end - start)
+                      for (start, end), offset, length in zip(bounds, offsets, lengths)]
+        finally:
+            release_shared(sink)
+
+        magic = DICTIONARY_MAGIC if self.dictionary else CONTAINER_MAGICS[self.token_format]
+        with instrument.stage("io"), open(join(folder_path, f"{input_file}.enc"), "wb") as file:
+            write_container(file, magic, blocks)
     
     
-    def decompress_block (self, index: int, data: bytearray) -> tuple[int, str]:
-        decompressed_string = []
-        while True:
-            chunk = data[:struct.calcsize('<HBB')]
-            data = data[struct.calcsize('<HBB'):]
-            if not chunk:
-                break
-            distance, length, next_char = struct.unpack('<HBB', chunk)
-            if next_char == self.SPECIAL_BYTE:
-                # Special case: entire remaining string is a match
-                match_start = len(decompressed_string) - distance
-                match_string = decompressed_string[match_start:match_start + length]
-                decompressed_string.extend(match_string)
-            elif distance > 0 and length > 0:
-                # Match found
-                match_start = len(decompressed_string) - distance
-                for i in range(length):
-                    decompressed_string.append(decompressed_string[match_start + i])
-                if next_char != 0:
-                    decompressed_string.append(chr(next_char))
-            else:
-                # Literal character
-                decompressed_string.append(chr(next_char))
-
-        return index, decompressed_string
-                
-    def decompress(self, folder_path, input_file):
-        
-        data_list = []
-
-        with open(f"{folder_path}{input_file}.enc", 'rb') as f:
-            data = f.read()
-            block_number = struct.unpack('>I', data[:4])[0]
-        
-        data = data[4:]
-        block_size = len(data) // block_number
-        for i in range(0, self.block_number):
-            data_list.append(data[i * len(data) // self.block_number:(i + 1) * len(data) // self.block_number])
-
-        indexed_blocks = [(i, block) for i, block in enumerate(data_list)]
-        
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            results = list(executor.map(self.decompress_block, \
-                [i for i, block in indexed_blocks], \
-                [block for i, block in indexed_blocks]))
-
-        decompressed_data = []
-        # print(results)
-        for i in range(0, block_number):
-            decompressed_data.extend(results[i][1])
-        
-        with open(f"{folder_path}{input_file}.2", "w") as file:
-            file.write(''.join(decompressed_data))
+    def decompress_block(self, index: int, data) -> tuple[int, bytearray]:
+        return index, self.decode_block(data)
+
+    def window(self) -> int:
+        return self.search_buffer_size if self.token_format == COMPACT else min(self.search_buffer_size, MAX_DISTANCE)
+
+    def decompress_window(self, data, history=b'', token_format=None) -> bytearray:
+        # Decodes a token stream into bytes, back references may reach into
+        # history. Tokens are read in place through a memoryview and every
+        # match is appended with a single slice, so the work is linear in the
+        # size of the output.
+        with instrument.stage("token_decode"):
+            if (token_format or self.token_format) == COMPACT:
+                return decode_tokens(data, history)
+            output = bytearray(history)
+            for distance, length, next_char in struct.iter_unpack('<HBB', memoryview(data)):
+                if length:
+                    match_start = len(output) - distance
+                    if distance >= length:
+                        output += output[match_start:match_start + length]
+                    else:
+                        # overlapping match, the last `distance` bytes repeat,
+                        # so repeat that slice until it covers the whole length
+                        output += (output[match_start:] * (length // distance + 1))[:length]
+                output.append(next_char)
+            # only the last tuple's null byte stands for no character
+            if data and data[-1] == self.SPECIAL_BYTE:
+                output.pop()
+            return output
+
+    def decompress_stream(self, source):
+        window = self.window()
+        history = bytearray()
+        first = True
+        for payload in iter_frames(source):
+            if first and len(payload) == DICTIONARY_FRAME.size and payload.startswith(DICTIONARY_MAGIC):
+                # the frames after it start from the dictionary
+                magic, dictionary_id = DICTIONARY_FRAME.unpack(payload)
+                if self.dictionary is None:
+                    raise ValueError(f"Data needs dictionary {dictionary_id:08x}")
+                self.dictionary.check(dictionary_id)
+                history = bytearray(self.dictionary_window())
+                first = False
+                continue
+            first = False
+            output = self.decompress_window(payload, history)
+            yield bytes(output[len(history):])
+            history = output[-window:]
+
+    def read_index(self, file) -> tuple[str, list[BlockEntry]]:
+        # The token format of the file and its block index
+        magic = file.read(len(CONTAINER_MAGIC))
+        file.seek(-len(magic), os.SEEK_CUR)
+        for token_format, format_magic in CONTAINER_MAGICS.items():
+            if magic == format_magic:
+                return token_format, read_index(file, format_magic)
+        if magic == DICTIONARY_MAGIC:
+            return PRIMED, read_index(file, DICTIONARY_MAGIC)
+        raise ValueError(f"Not an LZ77 file, unknown magic {magic!r}")
+
+    def decompress_block_at(self, path, offset, length, token_format=None) -> bytearray:
+        return self.decode_block(read_block(path, offset, length), token_format)
+
+    @instrument.timed("lz77.decompress")
+    def decompress(self, folder_path, input_file, source_path=None):
+        # Reads {input_file}.enc, or source_path when the tokens are
+        # elsewhere; returns the time taken in seconds
+        start_time = perf_counter()
+        path = source_path or join(folder_path, f"{input_file}.enc")
+        with open(path, 'rb') as f:
+            token_format, entries = self.read_index(f)
+
+        # Every block is decoded straight into its place in shared memory
+        total = sum(entry.size for entry in entries)
+        sink = create_shared(total)
+        try:
+            executor = choose_executor(total, self.max_workers)
+            instrument.pool_map(executor, _decompress_shared, \
+                [self] * len(entries), \
+                [path] * len(entries), \
+                [entry.offset for entry in entries], \
+                [entry.length for entry in entries], \
+                [sink.name] * len(entries), \
+                [entry.start for entry in entries], \
+                [token_format] * len(entries))
+            with OutputSink(join(folder_path, f"{input_file}.2"), total) as output:
+                output.write(sink.buf[:total])
+        finally:
+            release_shared(sink)
+        return perf_counter() - start_time
+
+    def extract(self, folder_path, input_file, start, stop) -> bytes:
+        # Uncompressed bytes [start, stop), only the blocks overlapping the
+        # range are decoded
+        path = join(folder_path, f"{input_file}.enc")
+        with open(path, 'rb') as f:
+            token_format, entries = self.read_index(f)
+        output = bytearray()
+        for entry in entries:
+            if entry.start + entry.size <= start or entry.start >= stop:
+                continue
+            block = self.decompress_block_at(path, entry.offset, entry.length, token_format)
+            output += block[max(start - entry.start, 0):stop - entry.start]
+        return bytes(output)
 
     def test(self, folder_path, input_file):
         comp_time = self.compress(folder_path, input_file)
         decomp_time = self.decompress(folder_path, input_file)
-        detailed_report("LZ77", f"{folder_path}{input_file}", comp_time, decomp_time)                
+        detailed_report("LZ77", join(folder_path, input_file), comp_time, decomp_time)                
 
 # class KMP_LZ77Compressor:
 
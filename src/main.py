@@ -1,21 +1,84 @@
-import huffman
-import lz_77
-import deflate
+import argparse
+import batch
+import benchmark
+import cache
+import dictionary
+import instrument
 import os
 import sys
 
 main_script_dir = os.path.dirname(os.path.abspath(__file__))
 TEXT_PATH = os.path.expanduser("~/Compression-Tester/text_encoded_files/")
 
-input_file = sys.argv[1]
+# python main.py test FILE [--codec deflate] runs one codec's test() on a
+#     file of --folder (default TEXT_PATH), like the old `main.py FILE`
+# python main.py bench [...] runs the benchmark matrix, see benchmark.py
+# python main.py batch SOURCE [...] compresses many files, see batch.py
+
+# Sampling period of --profile in seconds, and how many functions it lists
+PROFILE_INTERVAL = 0.001
+PROFILE_TOP = 15
+
+
+def run_test(args):
+    store = cache.CompressionCache(args.cache) if args.cache else None
+    preset = dictionary.load_dictionary(args.dictionary) if args.dictionary else None
+    compressor = batch.new_codec(args.codec, args.window, args.lookahead, args.blocks, args.level, store, preset)[0]
+    if args.metrics or args.profile:
+        instrument.enable(sample_interval=PROFILE_INTERVAL if args.profile else None)
+    compressor.test(args.folder, args.input_file)
+    metrics = instrument.disable()
+    if store is not None:
+        print("Cache: " + ", ".join(f"{name} {value}" for name, value in store.stats().items()))
+    if args.metrics == "json":
+        print(metrics.json())
+    elif args.metrics == "prometheus":
+        print(metrics.prometheus(), end="")
+    if args.profile:
+        for row in metrics.profiler.top(PROFILE_TOP):
+            print(f"{row['self']:>8}{row['total']:>8}  {row['function']}")
+        if args.profile is not True:
+            with open(args.profile, "w") as file:
+                file.write(metrics.profiler.collapsed())
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Compression tester")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    test = commands.add_parser("test", help="compress and decompress one file and print a report")
+    test.add_argument("input_file")
+    test.add_argument("--folder", default=TEXT_PATH)
+    test.add_argument("--codec", choices=sorted(benchmark.CODECS), default="deflate")
+    test.add_argument("--window", type=int, default=8192)
+    test.add_argument("--lookahead", type=int, default=20)
+    test.add_argument("--blocks", type=int, default=3)
+    test.add_argument("--level", type=int, choices=range(1, 10), help="compression level, picks the LZ77 parser")
+    test.add_argument("--cache", nargs="?", const=cache.DEFAULT_CACHE_DIR,
+                      help="reuse outputs of earlier runs on the same input, stored in this folder")
+    test.add_argument("--dictionary", help="preset dictionary file, see dictionary.py")
+    test.add_argument("--metrics", choices=("json", "prometheus"),
+                      help="print stage timers and counters of the run, see instrument.py")
+    test.add_argument("--profile", nargs="?", const=True,
+                      help="sample the run's stacks and list the hottest functions; with a file name the "
+                           "collapsed stacks are written there for flamegraph.pl or speedscope")
+    test.set_defaults(run=run_test)
+
+    bench = commands.add_parser("bench", help="run the benchmark matrix")
+    benchmark.add_arguments(bench)
+    bench.set_defaults(run=benchmark.run)
+
+    batch_command = commands.add_parser("batch", help="compress every file of globs, folders or a list on stdin")
+    batch.add_arguments(batch_command)
+    batch_command.set_defaults(run=batch.run)
+
+    # `main.py FILE` keeps working as a shorthand for `main.py test FILE`
+    if argv and argv[0] not in ("test", "bench", "batch", "-h", "--help"):
+        argv = ["test"] + argv
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    # huffman_compressor = huffman.HuffmanCompressor()
-    # huffman_compressor.compress_bin(TEXT_PATH, input_file)
-    # huffman_compressor = huffman.HuffmanCompressor()
-    # huffman_compressor.test(TEXT_PATH, input_file)
-    # lz_77_compressor = lz_77.LZ77Compressor(65536, 20, 1)
-    # lz_77_compressor.compress(TEXT_PATH, input_file)
-    # lz_77_compressor.test(TEXT_PATH, input_file)
-    deflate_compressor = deflate.DeflateCompressor(8192, 20, 3)
-    deflate_compressor.test(TEXT_PATH, input_file)
-    
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    sys.exit(args.run(args))
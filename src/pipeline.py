@@ -0,0 +1,52 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import instrument
+
+# Block pipeline over an executor: every item goes through a list of stage
+# functions, each call a separate task, so stage s of block k+1 runs while
+# stage s+1 of block k does. Between stages sit bounded queues of at most
+# depth tasks; a stage whose next queue is full holds its finished results
+# back, and items are only taken from the input while the first queue has
+# room, so a slow stage throttles everything before it instead of
+# buffering the whole input. Results come out in input order.
+
+PIPELINE_DEPTH = 2
+
+
+def run_pipeline(executor, stages, items, depth=PIPELINE_DEPTH):
+    # stages are picklable callables (module functions, bound methods,
+    # partials) when the executor runs processes; yields the output of the
+    # last stage for every item
+    tasks = [instrument.pool_task(executor, stage) for stage in stages]
+    last = len(tasks) - 1
+    queues = [deque() for _ in tasks]
+    items = iter(items)
+    exhausted = False
+    while True:
+        # from the last stage back, so results move on before new work
+        # fills the queues they move into
+        for index in range(last, -1, -1):
+            queue = queues[index]
+            while queue and queue[0].done():
+                if index == last:
+                    yield instrument.pool_result(tasks[index], queue.popleft().result())
+                elif len(queues[index + 1]) < depth:
+                    result = instrument.pool_result(tasks[index], queue.popleft().result())
+                    queues[index + 1].append(executor.submit(tasks[index + 1], result))
+                else:
+                    break
+        while not exhausted and len(queues[0]) < depth:
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+            else:
+                queues[0].append(executor.submit(tasks[0], item))
+        if exhausted and not any(queues):
+            return
+        # only the task at the head of a queue can move on; a finished head
+        # waits for room in the next queue, which the last stage's head
+        # (never held back) makes
+        running = [queue[0] for queue in queues if queue and not queue[0].done()]
+        if running:
+            wait(running, return_when=FIRST_COMPLETED)
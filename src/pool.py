@@ -0,0 +1,61 @@
+import atexit
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+
+# Long lived executors shared by every codec call in the process, so batch
+# jobs over many small files pay pool startup once. Block data moves through
+# multiprocessing.shared_memory; only segment names and offsets are pickled.
+
+# Below this many input bytes work runs on threads, process startup and
+# shared memory setup would cost more than the parallelism gains
+PROCESS_THRESHOLD = 1 << 20
+
+_executors = {}
+
+
+def get_executor(kind="process", max_workers=None):
+    key = (kind, max_workers)
+    executor = _executors.get(key)
+    if executor is None:
+        if kind == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        _executors[key] = executor
+    return executor
+
+
+def choose_executor(input_size, max_workers=None):
+    workers = max_workers or os.cpu_count() or 1
+    if input_size >= PROCESS_THRESHOLD and workers > 1:
+        return get_executor("process", max_workers)
+    return get_executor("thread", max_workers)
+
+
+def shutdown():
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+atexit.register(shutdown)
+
+
+def create_shared(size, data=None) -> shared_memory.SharedMemory:
+    # size 0 segments are not allowed
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    if data is not None:
+        shm.buf[:len(data)] = data
+    return shm
+
+
+def attach_shared(name) -> shared_memory.SharedMemory:
+    # Pool workers share the parent's resource tracker, so attaching does not
+    # hand ownership over; the creating process unlinks the segment
+    return shared_memory.SharedMemory(name=name)
+
+
+def release_shared(shm):
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,328 @@
+import math
+import struct
+import zlib
+
+from bitio import LSBBitWriter, reverse_bits
+from histogram import byte_histogram, incompressible
+from huffman import canonical_codes, code_lengths
+import instrument
+from lz_77 import GREEDY, LEVELS, MIN_MATCH, OPTIMAL, HashChain, count_tokens, match_graph, parse, shortest_path
+
+# Raw DEFLATE (RFC 1951) encoder, the output is readable by
+# zlib.decompress(data, -15). Input is cut into blocks of BLOCK_SIZE bytes,
+# every block is LZ77 parsed against a 32 KB window (greedy, lazy or
+# optimal, see lz_77.parse) and written as whichever of stored, fixed
+# Huffman or dynamic Huffman is estimated to be the smallest; a block that
+# samples as incompressible (histogram.incompressible) is stored without
+# being parsed. A preset
+# dictionary (zdict, as in zlib.compressobj) primes the window, and
+# zlib_header() / zlib_trailer() wrap the raw stream as RFC 1950 naming the
+# dictionary by its Adler-32, which zlib.decompressobj(zdict=...) checks.
+
+WINDOW_SIZE = 32768
+MAX_MATCH = 258
+BLOCK_SIZE = 1 << 15
+END_OF_BLOCK = 256
+MAX_CODE_LENGTH = 15
+MAX_CODE_LENGTH_CODE_LENGTH = 7
+
+STORED = 0
+FIXED = 1
+DYNAMIC = 2
+
+LENGTH_BASE = [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31,
+               35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258]
+LENGTH_EXTRA = [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2,
+                3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0]
+DISTANCE_BASE = [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193,
+                 257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145,
+                 8193, 12289, 16385, 24577]
+DISTANCE_EXTRA = [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6,
+                  7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13]
+CODE_LENGTH_ORDER = [16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15]
+
+FIXED_LITERAL_LENGTHS = [8] * 144 + [9] * 112 + [7] * 24 + [8] * 8
+FIXED_DISTANCE_LENGTHS = [5] * 30
+
+
+def _symbol_table(bases, extras, size):
+    # value -> (symbol, extra bit count, extra bits value)
+    table = [None] * size
+    for symbol, (base, extra) in enumerate(zip(bases, extras)):
+        for value in range(base, min(base + (1 << extra), size)):
+            table[value] = (symbol, extra, value - base)
+    return table
+
+
+LENGTH_SYMBOLS = _symbol_table(LENGTH_BASE, LENGTH_EXTRA, MAX_MATCH + 1)
+# 258 has its own symbol, not the last value of 227's range
+LENGTH_SYMBOLS[MAX_MATCH] = (28, 0, 0)
+DISTANCE_SYMBOLS = _symbol_table(DISTANCE_BASE, DISTANCE_EXTRA, WINDOW_SIZE + 1)
+
+
+def writer_codes(lengths):
+    # (bit reversed code, length) per symbol, ready for LSBBitWriter.write
+    return [(reverse_bits(code, length), length) for code, length in zip(canonical_codes(lengths), lengths)]
+
+
+FIXED_LITERAL_CODES = writer_codes(FIXED_LITERAL_LENGTHS)
+FIXED_DISTANCE_CODES = writer_codes(FIXED_DISTANCE_LENGTHS)
+
+
+def rle_code_lengths(lengths):
+    # Code length alphabet (RFC 1951 3.2.7) as (symbol, extra bits, extra value)
+    out = []
+    i = 0
+    n = len(lengths)
+    while i < n:
+        length = lengths[i]
+        run = 1
+        while i + run < n and lengths[i + run] == length:
+            run += 1
+        if length == 0 and run >= 3:
+            run = min(run, 138)
+            out.append((18, 7, run - 11) if run >= 11 else (17, 3, run - 3))
+            i += run
+        elif length != 0 and run >= 4:
+            repeat = min(run - 1, 6)
+            out.append((length, 0, 0))
+            out.append((16, 2, repeat - 3))
+            i += 1 + repeat
+        else:
+            out.append((length, 0, 0))
+            i += 1
+    return out
+
+
+class DynamicHeader:
+    # Code lengths of a dynamic block and the header that transmits them
+    def __init__(self, literal_frequencies, distance_frequencies):
+        self.literal_lengths = code_lengths(literal_frequencies, MAX_CODE_LENGTH)
+        self.distance_lengths = code_lengths(distance_frequencies, MAX_CODE_LENGTH)
+        self.hlit = max(257, _used_prefix(self.literal_lengths))
+        self.hdist = max(1, _used_prefix(self.distance_lengths))
+        self.rle = rle_code_lengths(self.literal_lengths[:self.hlit] + self.distance_lengths[:self.hdist])
+        cl_frequencies = [0] * 19
+        for symbol, extra, value in self.rle:
+            cl_frequencies[symbol] += 1
+        self.cl_lengths = code_lengths(cl_frequencies, MAX_CODE_LENGTH_CODE_LENGTH)
+        self.hclen = max(4, _used_prefix([self.cl_lengths[symbol] for symbol in CODE_LENGTH_ORDER]))
+
+    def bits(self) -> int:
+        return 14 + 3 * self.hclen + sum(self.cl_lengths[symbol] + extra for symbol, extra, value in self.rle)
+
+    def write(self, writer):
+        writer.write(self.hlit - 257, 5)
+        writer.write(self.hdist - 1, 5)
+        writer.write(self.hclen - 4, 4)
+        for symbol in CODE_LENGTH_ORDER[:self.hclen]:
+            writer.write(self.cl_lengths[symbol], 3)
+        cl_codes = writer_codes(self.cl_lengths)
+        for symbol, extra, value in self.rle:
+            writer.write(*cl_codes[symbol])
+            if extra:
+                writer.write(value, extra)
+
+
+def _used_prefix(lengths):
+    count = len(lengths)
+    while count and lengths[count - 1] == 0:
+        count -= 1
+    return count
+
+
+def code_cost(frequencies, lengths):
+    return sum(freq * length for freq, length in zip(frequencies, lengths))
+
+
+def symbol_costs(literal_lengths, distance_lengths, max_length, window):
+    # Bits per literal, per match length and per distance (extra bits
+    # included) under the given code lengths, the cost model of the optimal
+    # parse. Unused symbols are priced as if they got a 15 bit code.
+    def bits(length):
+        return length or MAX_CODE_LENGTH
+    literal_cost = [bits(literal_lengths[byte]) for byte in range(256)]
+    length_cost = [0] * MIN_MATCH + [bits(literal_lengths[257 + LENGTH_SYMBOLS[length][0]]) + LENGTH_SYMBOLS[length][1]
+                                     for length in range(MIN_MATCH, max_length + 1)]
+    distance_cost = [0] + [bits(distance_lengths[DISTANCE_SYMBOLS[distance][0]]) + DISTANCE_SYMBOLS[distance][1]
+                           for distance in range(1, window + 1)]
+    return literal_cost, length_cost, distance_cost
+
+
+def estimated_lengths(frequencies):
+    # Ideal code lengths -log2(p), rounded, for the first optimal pass
+    total = sum(frequencies)
+    return [min(MAX_CODE_LENGTH, max(1, round(math.log2(total / freq)))) if freq else 0 for freq in frequencies]
+
+
+class DeflateEncoder:
+    # Incremental encoder with the same shape as zlib.compressobj: compress()
+    # returns whatever whole bytes are ready, flush() ends the stream
+    def __init__(self, window=WINDOW_SIZE, max_length=MAX_MATCH, max_chain=128, good_length=MAX_MATCH,
+                 block_size=BLOCK_SIZE, level=None, parser=GREEDY, zdict=b'', stored_blocks=True):
+        self.window = min(window, WINDOW_SIZE)
+        self.max_length = min(max_length, MAX_MATCH)
+        self.max_chain = max_chain
+        self.good_length = good_length
+        self.parser = parser
+        # a level (1-9, see lz_77.LEVELS) overrides parser, max_chain and good_length
+        if level is not None:
+            self.parser, self.max_chain, self.good_length = LEVELS[level]
+        # a stored block holds at most 65535 bytes
+        self.block_size = min(block_size, 65535)
+        self.writer = LSBBitWriter()
+        # matches may reach into the dictionary as if it preceded the data
+        self.history = bytes(zdict)[-self.window:]
+        # history that is still the dictionary alone, see HashChain.prime
+        self.primed = len(self.history)
+        self.pending = bytearray()
+        self.stored_blocks = stored_blocks
+        self.block_types = [0, 0, 0]
+
+    def compress(self, data) -> bytes:
+        self.pending += data
+        # keep the last block back so flush() can mark it final
+        while len(self.pending) > self.block_size:
+            block = bytes(self.pending[:self.block_size])
+            del self.pending[:self.block_size]
+            self.write_block(block, final=False)
+        return self.writer.take()
+
+    def flush(self) -> bytes:
+        self.write_block(bytes(self.pending), final=True)
+        self.pending.clear()
+        self.writer.align()
+        return self.writer.take()
+
+    def tokenize(self, data, start):
+        # Parses data[start:], returns the tokens (a literal byte or a
+        # (length, distance) pair), symbol frequencies and extra bit count
+        chain = HashChain(data, self.window, self.max_length, self.max_chain, self.good_length)
+        if self.primed:
+            chain.prime(self.primed)
+            self.primed = 0
+        if self.parser != OPTIMAL:
+            with instrument.stage("match_finding"):
+                tokens = parse(chain, start, self.parser)
+        else:
+            with instrument.stage("match_finding"):
+                matches = match_graph(chain, start)
+            # Two passes: the first prices literals by their frequency in
+            # the block and matches by the fixed codes, the second by the
+            # code lengths the first parse would get
+            with instrument.stage("token_emit"):
+                literal_lengths = estimated_lengths(byte_histogram(memoryview(data)[start:])) + \
+                    FIXED_LITERAL_LENGTHS[256:]
+                costs = symbol_costs(literal_lengths, FIXED_DISTANCE_LENGTHS, self.max_length, self.window)
+                tokens, literal_frequencies, distance_frequencies, extra_bits = self.count(
+                    shortest_path(data, start, matches, *costs))
+                costs = symbol_costs(code_lengths(literal_frequencies, MAX_CODE_LENGTH),
+                                     code_lengths(distance_frequencies, MAX_CODE_LENGTH), self.max_length, self.window)
+                tokens = shortest_path(data, start, matches, *costs)
+        if instrument.enabled():
+            count_tokens(tokens, chain)
+        return self.count(tokens)
+
+    def count(self, tokens):
+        literal_frequencies = [0] * 286
+        distance_frequencies = [0] * 30
+        extra_bits = 0
+        for token in tokens:
+            if type(token) is int:
+                literal_frequencies[token] += 1
+                continue
+            length, distance = token
+            symbol, extra, value = LENGTH_SYMBOLS[length]
+            literal_frequencies[257 + symbol] += 1
+            extra_bits += extra
+            symbol, extra, value = DISTANCE_SYMBOLS[distance]
+            distance_frequencies[symbol] += 1
+            extra_bits += extra
+        literal_frequencies[END_OF_BLOCK] += 1
+        return tokens, literal_frequencies, distance_frequencies, extra_bits
+
+    def write_block(self, block, final):
+        data = self.history + block
+        if self.stored_blocks and incompressible(block):
+            self.history = data[-self.window:]
+            # the history no longer is the dictionary alone
+            self.primed = 0
+            self.block_types[STORED] += 1
+            instrument.count("stored_blocks")
+            with instrument.stage("bit_packing"):
+                self.write_stored(block, final)
+            return
+        tokens, literal_frequencies, distance_frequencies, extra_bits = self.tokenize(data, len(self.history))
+        self.history = data[-self.window:]
+
+        with instrument.stage("tree_build"):
+            header = DynamicHeader(literal_frequencies, distance_frequencies)
+        costs = [
+            # stored: 3 header bits, padding to a byte, LEN and NLEN, raw data
+            3 + (-(self.writer.acc_bits + 3)) % 8 + 32 + 8 * len(block),
+            3 + code_cost(literal_frequencies, FIXED_LITERAL_LENGTHS)
+            + code_cost(distance_frequencies, FIXED_DISTANCE_LENGTHS) + extra_bits,
+            3 + header.bits() + code_cost(literal_frequencies, header.literal_lengths)
+            + code_cost(distance_frequencies, header.distance_lengths) + extra_bits,
+        ]
+        block_type = costs.index(min(costs))
+        self.block_types[block_type] += 1
+
+        writer = self.writer
+        with instrument.stage("bit_packing"):
+            if block_type == STORED:
+                self.write_stored(block, final)
+                return
+            writer.write(1 if final else 0, 1)
+            writer.write(block_type, 2)
+            if block_type == FIXED:
+                self.write_tokens(tokens, FIXED_LITERAL_CODES, FIXED_DISTANCE_CODES)
+            else:
+                header.write(writer)
+                self.write_tokens(tokens, writer_codes(header.literal_lengths), writer_codes(header.distance_lengths))
+
+    def write_stored(self, block, final):
+        self.writer.write(1 if final else 0, 1)
+        self.writer.write(STORED, 2)
+        self.writer.write_raw(struct.pack('<HH', len(block), len(block) ^ 0xFFFF))
+        self.writer.write_raw(block)
+
+    def write_tokens(self, tokens, literal_codes, distance_codes):
+        write = self.writer.write
+        for token in tokens:
+            if type(token) is int:
+                write(*literal_codes[token])
+                continue
+            length, distance = token
+            symbol, extra, value = LENGTH_SYMBOLS[length]
+            write(*literal_codes[257 + symbol])
+            if extra:
+                write(value, extra)
+            symbol, extra, value = DISTANCE_SYMBOLS[distance]
+            write(*distance_codes[symbol])
+            if extra:
+                write(value, extra)
+        write(*literal_codes[END_OF_BLOCK])
+
+
+def zlib_header(zdict=None) -> bytes:
+    # 32 KB window deflate, default level, FDICT and the dictionary's
+    # Adler-32 when there is one; FCHECK makes the first 16 bits divisible
+    # by 31
+    cmf = 0x78
+    flg = 0x80 | (0x20 if zdict is not None else 0)
+    flg |= -(cmf << 8 | flg) % 31
+    header = bytes([cmf, flg])
+    if zdict is not None:
+        header += struct.pack('>I', zlib.adler32(zdict))
+    return header
+
+
+def zlib_trailer(adler) -> bytes:
+    # Adler-32 of the uncompressed data
+    return struct.pack('>I', adler)
+
+
+def deflate(data, **options) -> bytes:
+    encoder = DeflateEncoder(**options)
+    return encoder.compress(data) + encoder.flush()
@@ -0,0 +1,94 @@
+import struct
+
+import instrument
+
+# Streaming support shared by the codecs. A source is either a file-like
+# object opened in binary mode or any iterable of bytes-like chunks; every
+# codec turns it into an iterator of output chunks while holding at most one
+# block (plus the LZ77 window) in memory.
+#
+# Stream format: a sequence of frames, each one
+#     4 bytes big endian payload length
+#     payload (one independently decodable block of the codec)
+
+READ_SIZE = 1 << 16
+FRAME_HEADER = struct.Struct('>I')
+
+
+def iter_chunks(source, read_size=READ_SIZE):
+    if hasattr(source, "read"):
+        while True:
+            with instrument.stage("io"):
+                chunk = source.read(read_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+def iter_blocks(source, block_size, first_size=None):
+    # Regroups arbitrary chunks into blocks of exactly block_size bytes, the
+    # last block may be shorter. With first_size the blocks start that small
+    # and double up to block_size, so the first one is out sooner.
+    size = first_size or block_size
+    buffer = bytearray()
+    for chunk in iter_chunks(source, size):
+        if not buffer and len(chunk) == size:
+            yield bytes(chunk)
+            size = min(2 * size, block_size)
+            continue
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+            size = min(2 * size, block_size)
+    if buffer:
+        yield bytes(buffer)
+
+
+def frame(payload) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def iter_frames(source):
+    # Yields frame payloads however the stream happens to be chunked
+    buffer = bytearray()
+    for chunk in iter_chunks(source):
+        buffer += chunk
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            yield bytes(buffer[offset + FRAME_HEADER.size:end])
+            offset = end
+        del buffer[:offset]
+    if buffer:
+        raise ValueError(f"Truncated stream: {len(buffer)} bytes left after the last frame")
+
+
+class StreamCodec:
+    # Subclasses implement compress_stream and decompress_stream as generators
+    # of output chunks
+
+    def compress_stream(self, source):
+        raise NotImplementedError
+
+    def decompress_stream(self, source):
+        raise NotImplementedError
+
+    def compress_file(self, input_path, output_path):
+        with open(input_path, 'rb') as source, open(output_path, 'wb') as sink:
+            for chunk in self.compress_stream(source):
+                with instrument.stage("io"):
+                    sink.write(chunk)
+
+    def decompress_file(self, input_path, output_path):
+        with open(input_path, 'rb') as source, open(output_path, 'wb') as sink:
+            for chunk in self.decompress_stream(source):
+                with instrument.stage("io"):
+                    sink.write(chunk)
@@ -0,0 +1,153 @@
+from array import array
+
+# Compact LZ77 token format. A block is a sequence of
+#     varint  number of literals that follow
+#     the literal bytes
+#     varint  match length, 0 only after the last literals of the block
+#     varint  match distance, left out when the length is 0
+# Varints are little endian base 128 (7 bits per byte, the high bit set on
+# every byte but the last), so a length past 255 or a distance past 65535
+# costs a byte more instead of being cut, and a literal costs one byte plus
+# its share of the run count. Literals are counted rather than marked, so
+# every byte value, NUL included, is a literal like any other.
+
+
+def varint(value) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_varint(data, pos) -> tuple[int, int]:
+    # Returns the value and the position just past it
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class TokenBuffer:
+    # Parser output kept in columns instead of one object per token: the
+    # literal bytes back to back, and for every match the number of literals
+    # before it, its length and its distance. Parsers append to it like to
+    # a list of tokens (a literal byte as int or a (length, distance) match).
+    def __init__(self):
+        self.literals = bytearray()
+        self.runs = array('I')
+        self.lengths = array('I')
+        self.distances = array('I')
+        # literals since the last match
+        self.pending = 0
+
+    def append(self, token):
+        if type(token) is int:
+            self.literals.append(token)
+            self.pending += 1
+        else:
+            self.runs.append(self.pending)
+            self.lengths.append(token[0])
+            self.distances.append(token[1])
+            self.pending = 0
+
+    def extend(self, literals):
+        # A run of literal bytes
+        self.literals += literals
+        self.pending += len(literals)
+
+    def encode(self) -> bytearray:
+        out = bytearray()
+        literals = memoryview(self.literals)
+        offset = 0
+        for run, length, distance in zip(self.runs, self.lengths, self.distances):
+            # one byte values are the common case, skip the call for them
+            if run < 0x80:
+                out.append(run)
+            else:
+                out += varint(run)
+            if run:
+                out += literals[offset:offset + run]
+                offset += run
+            if length < 0x80:
+                out.append(length)
+            else:
+                out += varint(length)
+            if distance < 0x4000:
+                if distance >= 0x80:
+                    out.append((distance & 0x7F) | 0x80)
+                    distance >>= 7
+                out.append(distance)
+            else:
+                out += varint(distance)
+        out += varint(self.pending)
+        out += literals[offset:]
+        out.append(0)
+        return out
+
+
+def literal_block(data) -> bytearray:
+    # A block of data as one run of literals, the stored block of the format:
+    # at most 6 bytes over the data, and decoding is a single copy
+    out = bytearray(varint(len(data)))
+    out += data
+    out.append(0)
+    return out
+
+
+def decode_tokens(data, history=b'') -> bytearray:
+    # Decodes a compact token block into bytes, back references may reach
+    # into history
+    # indexing bytes is cheaper than indexing a memoryview
+    data = bytes(data)
+    output = bytearray(history)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        run = data[pos]
+        if run < 0x80:
+            pos += 1
+        else:
+            run, pos = read_varint(data, pos)
+        if run:
+            output += data[pos:pos + run]
+            pos += run
+        length = data[pos]
+        if length < 0x80:
+            pos += 1
+        else:
+            length, pos = read_varint(data, pos)
+        if not length:
+            continue
+        distance = data[pos]
+        if distance < 0x80:
+            pos += 1
+        elif data[pos + 1] < 0x80:
+            # most distances take two bytes
+            distance = (distance & 0x7F) | (data[pos + 1] << 7)
+            pos += 2
+        else:
+            distance, pos = read_varint(data, pos)
+        if distance >= length:
+            match_start = len(output) - distance
+            output += output[match_start:match_start + length]
+        else:
+            # overlapping match, the last `distance` bytes repeat
+            output += (output[-distance:] * (length // distance + 1))[:length]
+    return output
+
+
+def compact_costs(byte_cost, max_length, window) -> tuple[list[float], list[float], list[float]]:
+    # Literal, length and distance costs in bits for the optimal parser when
+    # every output byte costs byte_cost[value] bits; a match also pays for
+    # the run count that starts the next sequence, priced as a 0
+    literal_cost = list(byte_cost)
+    length_cost = [sum(byte_cost[byte] for byte in varint(length)) + byte_cost[0] for length in range(max_length + 1)]
+    distance_cost = [sum(byte_cost[byte] for byte in varint(distance)) for distance in range(window + 1)]
+    return literal_cost, length_cost, distance_cost